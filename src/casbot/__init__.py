@@ -1,13 +1,15 @@
 from casbot.io import help, search
-from casbot.model import Model
+from casbot.model import Model, discoverCalculations
 from casbot.calculation import Calculation, createCalculations, processCalculations, groupDensityCalculations
 from casbot.settings import setting, createSettings, createVariableSettings, getSettings
 from casbot.data import createDirectories
+from casbot.instrument import collectStats, startStats, stopStats, resetStats, getStats, printStats
 
 
 __all__ = ['help', 'search',
-           'Model',
+           'Model', 'discoverCalculations',
            'Calculation', 'createCalculations', 'processCalculations',
            'setting', 'createSettings', 'createVariableSettings', 'getSettings',
            'createDirectories',
-           'groupDensityCalculations']
+           'groupDensityCalculations',
+           'collectStats', 'startStats', 'stopStats', 'resetStats', 'getStats', 'printStats']
@@ -0,0 +1,10 @@
+from casbot.bench.generate import writeCellFile, writeParamFile, writeCastepFile, writeFixtures
+from casbot.bench.benchmarks import benchReadSettings, benchCreate,\
+    benchGetResult, benchGetStatus, benchCreateCalculations, benchCheck, benchSaveLoad, benchGroupDensity,\
+    runBenchmarks
+
+
+__all__ = ['writeCellFile', 'writeParamFile', 'writeCastepFile', 'writeFixtures',
+           'benchReadSettings', 'benchCreate',
+           'benchGetResult', 'benchGetStatus', 'benchCreateCalculations', 'benchCheck', 'benchSaveLoad', 'benchGroupDensity',
+           'runBenchmarks']
@@ -0,0 +1,289 @@
+from casbot.bench.generate import writeCastepFile, writeCellFile, writeFixtures
+from casbot.calculation import Calculation, createCalculations, groupDensityCalculations, processCalculations
+from casbot.data import getFileLines
+from casbot.model import Model
+from casbot.results import getResult, resultKnown, NMRresults, EFGresults, hyperfineResults, NMR
+from casbot.settings import createSettings, readSettings
+
+from contextlib import redirect_stderr, redirect_stdout
+from copy import deepcopy
+from datetime import datetime
+from importlib.metadata import version, PackageNotFoundError
+from io import StringIO
+from json import dump as jsonDump
+from numpy import eye, __version__ as numpyVersion
+from pathlib import Path
+from platform import python_version as pythonVersion
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+
+def timeIt(function, *args, repeats=3, **kwargs):
+    """ Returns the best time (in seconds) of calling the function a number of times """
+
+    assert isinstance(repeats, int) and repeats > 0
+
+    times = []
+
+    for _ in range(repeats):
+        start = perf_counter()
+        function(*args, **kwargs)
+        times.append(perf_counter() - start)
+
+    return min(times)
+
+
+def benchReadSettings(atoms=(500, 5000, 50000), repeats=3, directory=None):
+    """ This function times readSettings on synthetic cell files
+        of increasing numbers of atoms """
+
+    assert isinstance(atoms, (list, tuple))
+    assert all(isinstance(n, int) and n > 0 for n in atoms)
+
+    results = {}
+
+    with TemporaryDirectory() as tmpDirectory:
+        directory = tmpDirectory if directory is None else directory
+
+        assert isinstance(directory, str)
+
+        for n in atoms:
+            cellFile = writeCellFile(file_=f'{Path(directory)}/bench_{n}.cell', atoms=n)
+
+            seconds = timeIt(readSettings, file_=cellFile, repeats=repeats)
+
+            results[n] = seconds
+
+            print(f'readSettings  {n:>8d} atoms  {seconds:>10.4f} s  {n / seconds:>12.0f} atoms/s')
+
+    return results
+
+
+def benchCreate(calculations=200, uniqueSettings=(1, 10, 100), atoms=2000, workers=1, directory=None):
+    """ This function times Model.create on a sweep of calculations that
+        share a large positions block between them, with an increasing
+        number of distinct positions blocks. As each distinct setting is
+        only formatted once, the time should scale with the number of
+        unique settings rather than the number of calculations. """
+
+    assert isinstance(calculations, int) and calculations > 0
+    assert isinstance(uniqueSettings, (list, tuple))
+    assert all(isinstance(n, int) and 0 < n <= calculations for n in uniqueSettings)
+    assert isinstance(atoms, int) and atoms > 0
+
+    results = {}
+
+    with TemporaryDirectory() as tmpDirectory:
+        directory = tmpDirectory if directory is None else directory
+
+        assert isinstance(directory, str)
+
+        settings = readSettings(file_=writeCellFile(file_=f'{Path(directory)}/bench.cell', atoms=atoms))
+        settings += [setting for setting in createSettings('defaults') if setting.key not in [s.key for s in settings]]
+
+        for n in uniqueSettings:
+            # Each calculation gets its own copy of the settings (as in createCalculations) but only n distinct rotations.
+            distinctSettings = []
+
+            for i in range(n):
+                calculation = Calculation(settings=deepcopy(settings))
+
+                if i > 0:
+                    calculation.rotate(axis=[1, 1, 1], angle=360.0 * i / n, setting='positions_frac')
+
+                distinctSettings.append(calculation.settings)
+
+            model = Model([Calculation(directory=f'{Path(directory)}/unique_{n}/{num:05d}/',
+                                       settings=deepcopy(distinctSettings[num % n]))
+                           for num in range(calculations)])
+
+            start = perf_counter()
+
+            with redirect_stdout(StringIO()):
+                model.create(workers=workers)
+
+            seconds = perf_counter() - start
+
+            results[n] = seconds
+
+            print(f'Model.create  {calculations:>6d} calculations  {n:>6d} unique  {seconds:>10.4f} s')
+
+    return results
+
+
+def getFixtureModel(directory=None, **kwargs):
+    """ This function writes fixtures (see writeFixtures) and returns a model of them """
+
+    directories = writeFixtures(directory=directory, **kwargs)
+
+    with redirect_stdout(StringIO()):
+        calculations = [c for d in directories for c in processCalculations(d)]
+
+    return Model(calculations)
+
+
+def benchGetResult(atoms=(50, 500), families=('nmr', 'efg', 'hyperfine'), repeats=3, directory=None):
+    """ This function times getting every result out of the lines of
+        synthetic castep files of increasing numbers of atoms """
+
+    assert isinstance(atoms, (list, tuple))
+    assert all(isinstance(n, int) and n > 0 for n in atoms)
+
+    resultsToGet = [r for r in resultKnown if r not in NMRresults or 'nmr' in families]
+    resultsToGet = [r for r in resultsToGet if r not in EFGresults or 'efg' in families]
+    resultsToGet = [r for r in resultsToGet if r not in hyperfineResults or 'hyperfine' in families]
+
+    results = {}
+
+    with TemporaryDirectory() as tmpDirectory:
+        directory = tmpDirectory if directory is None else directory
+
+        assert isinstance(directory, str)
+
+        for n in atoms:
+            castepFile = writeCastepFile(file_=f'{Path(directory)}/bench_{n}.castep',
+                                         atomElements=[('H', 'C', 'N', 'O')[i % 4] for i in range(n)],
+                                         families=families)
+
+            lines = getFileLines(file_=castepFile)
+
+            seconds = timeIt(lambda: [getResult(resultToGet=r, lines=lines) for r in resultsToGet], repeats=repeats)
+
+            results[n] = seconds
+
+            print(f'getResult     {n:>8d} atoms  {len(resultsToGet):>3d} results  {seconds:>10.4f} s')
+
+    return results
+
+
+def benchGetStatus(calculations=100, atoms=50, scfCycles=10, continuations=0, repeats=3, directory=None):
+    """ This function times getting the status of every calculation
+        of a directory of fixtures with a mix of statuses """
+
+    with TemporaryDirectory() as tmpDirectory:
+        directory = tmpDirectory if directory is None else directory
+
+        model = getFixtureModel(directory=directory, calculations=calculations, atoms=atoms,
+                                scfCycles=scfCycles, continuations=continuations)
+
+        seconds = timeIt(lambda: [c.getStatus() for c in model.calculations], repeats=repeats)
+
+    print(f'getStatus     {calculations:>6d} calculations  {seconds:>10.4f} s')
+
+    return seconds
+
+
+def benchCreateCalculations(repeats=3):
+    """ This function times making a sweep of calculations from shortcuts """
+
+    seconds = timeIt(createCalculations, 'halides', 'soc', 'zbfield', settings=['ncp'],
+                     directories=['halides', 'soc', 'bfield'], repeats=repeats)
+
+    print(f'createCalculations  {seconds:>10.4f} s')
+
+    return seconds
+
+
+def benchCheck(calculations=100, atoms=50, scfCycles=10, continuations=0, repeats=3, directory=None):
+    """ This function times Model.check on a directory of fixtures
+        with a mix of statuses """
+
+    with TemporaryDirectory() as tmpDirectory:
+        directory = tmpDirectory if directory is None else directory
+
+        model = getFixtureModel(directory=directory, calculations=calculations, atoms=atoms,
+                                scfCycles=scfCycles, continuations=continuations)
+
+        with redirect_stdout(StringIO()):
+            seconds = timeIt(model.check, repeats=repeats)
+
+    print(f'Model.check   {calculations:>6d} calculations  {seconds:>10.4f} s')
+
+    return seconds
+
+
+def benchSaveLoad(calculations=100, atoms=50, families=('nmr', 'efg', 'hyperfine'), repeats=3, directory=None):
+    """ This function times saving and loading an analysed model of
+        completed fixtures, both pickled and columnar (and lazily) """
+
+    results = {}
+
+    with TemporaryDirectory() as tmpDirectory:
+        directory = tmpDirectory if directory is None else directory
+
+        model = getFixtureModel(directory=f'{Path(directory)}/fixtures', calculations=calculations, atoms=atoms,
+                                families=families, statuses=('completed',))
+
+        with redirect_stdout(StringIO()), redirect_stderr(StringIO()):
+            model.analyse('nmr', 'efg', 'hyperfine', 'forces', 'spin density')
+
+            results['save'] = timeIt(model.save, file=f'{Path(directory)}/model.pkl', overwrite=True, repeats=repeats)
+            results['load'] = timeIt(Model.load, file=f'{Path(directory)}/model.pkl', repeats=repeats)
+
+            results['saveColumnar'] = timeIt(model.save, file=f'{Path(directory)}/model', overwrite=True, columnar=True, repeats=repeats)
+            results['loadColumnar'] = timeIt(Model.load, file=f'{Path(directory)}/model', repeats=repeats)
+            results['loadLazy'] = timeIt(Model.load, file=f'{Path(directory)}/model', lazy=True, repeats=repeats)
+
+    for name, seconds in results.items():
+        print(f'Model.{name:<13s} {calculations:>6d} calculations  {seconds:>10.4f} s')
+
+    return results
+
+
+def benchGroupDensity(groups=300, atoms=10, repeats=3):
+    """ This function times grouping x, y and z density calculations with
+        hyperfine tensors, and then summing their Fermi tensors """
+
+    calculations = []
+
+    for group in range(groups):
+        for axis in 'xyz':
+            calculation = Calculation(directory=f'density_{group:05d}/{axis}/', name='bench', settings=[])
+
+            calculation.hyperfineFermiTensors = [NMR(key='hyperfine_fermi', value=eye(3) * (group + ion), unit='MHz',
+                                                     element='H', ion=str(ion + 1))
+                                                 for ion in range(atoms)]
+
+            calculations.append(calculation)
+
+    seconds = timeIt(lambda: [c.hyperfineFermiTensors for c in groupDensityCalculations(calculations=calculations)],
+                     repeats=repeats)
+
+    print(f'groupDensityCalculations  {groups:>6d} groups  {seconds:>10.4f} s')
+
+    return seconds
+
+
+def runBenchmarks(file_=None, repeats=3):
+    """ This function runs all of the benchmarks and returns the times,
+        along with the versions they were run with. If a file is given
+        then they are also written there as JSON, so they can be compared
+        between versions. """
+
+    try:
+        casbotVersion = version('casbot')
+    except PackageNotFoundError:
+        casbotVersion = None
+
+    results = {'casbot': casbotVersion,
+               'python': pythonVersion(),
+               'numpy': numpyVersion,
+               'date': datetime.now().isoformat(timespec='seconds'),
+               'benchmarks': {'readSettings': benchReadSettings(repeats=repeats),
+                              'create': benchCreate(),
+                              'getResult': benchGetResult(repeats=repeats),
+                              'getStatus': benchGetStatus(repeats=repeats),
+                              'createCalculations': benchCreateCalculations(repeats=repeats),
+                              'check': benchCheck(repeats=repeats),
+                              'saveLoad': benchSaveLoad(repeats=repeats),
+                              'groupDensityCalculations': benchGroupDensity(repeats=repeats)}}
+
+    if file_ is not None:
+        assert isinstance(file_, str)
+
+        with open(file_, 'w') as f:
+            jsonDump(results, f, indent=2)
+
+        print(f'Benchmarks written to {file_}')
+
+    return results
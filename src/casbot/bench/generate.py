@@ -0,0 +1,312 @@
+from casbot.data import elements
+from casbot.settings import getSettings, readSettings
+
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from numpy.random import default_rng
+from pathlib import Path
+
+
+def writeCellFile(file_=None, atoms=1000, species=('H', 'C', 'N', 'O'), seed=0):
+    """ This function writes a synthetic cell file with a cubic lattice
+        and a positions_frac block of the given number of atoms. The
+        same seed always gives the same file. """
+
+    assert isinstance(file_, str)
+    assert isinstance(atoms, int) and atoms > 0
+    assert isinstance(species, (list, tuple)) and len(species) > 0
+    assert all(isinstance(s, str) and s.strip().lower() in elements for s in species)
+    assert isinstance(seed, int)
+
+    rng = default_rng(seed)
+
+    elementsOut = rng.choice(species, size=atoms)
+    positions = rng.random((atoms, 3))
+
+    lines = ['%block lattice_cart',
+             'ANG',
+             '  20.0   0.0   0.0',
+             '   0.0  20.0   0.0',
+             '   0.0   0.0  20.0',
+             '%endblock lattice_cart',
+             '',
+             '%block positions_frac']
+
+    lines += [f'{element:<3s}  {x:>15.12f}   {y:>15.12f}   {z:>15.12f}' for element, (x, y, z) in zip(elementsOut, positions)]
+
+    lines += ['%endblock positions_frac',
+              '',
+              'kpoint_mp_spacing : 0.05  1/ang',
+              'fix_com : true',
+              '',
+              '%block cell_constraints',
+              '0   0   0',
+              '0   0   0',
+              '%endblock cell_constraints']
+
+    Path(file_).parent.mkdir(parents=True, exist_ok=True)
+
+    with open(file_, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    return file_
+
+
+# Families of tensors that can go in a castep file, with the line heading each tensor.
+castepFamilies = {'nmr': [('Core', 'Shielding'), ('Bare', 'Shielding'), ('Dia', 'Shielding'),
+                          ('Para', 'Shielding'), ('Total', 'Shielding')],
+                  'efg': [('Bare', 'tensor'), ('Ion', 'tensor'), ('Aug', 'tensor'), ('Aug2', 'tensor'), ('Total', 'tensor')],
+                  'hyperfine': [('d_bare', 'tensor'), ('d_aug', 'tensor'), ('d_aug2', 'tensor'), ('Dipolar', 'tensor'),
+                                ('Fermi', 'tensor'), ('ZFC', 'tensor'), ('Total', 'tensor')]}
+
+fixtureStatuses = ('completed', 'running', 'submitted', 'errored', 'created')
+
+# All generated runs start from here so that files are the same every time.
+fixtureStartTime = datetime(2024, 1, 1, 12, 0, 0, tzinfo=timezone.utc)
+
+
+def writeParamFile(file_=None, task='magres'):
+    """ This function writes a small param file for the given task """
+
+    assert isinstance(file_, str)
+    assert isinstance(task, str)
+
+    lines = [f'task : {task}',
+             'xcfunctional : PBE',
+             'cut_off_energy : 700 eV',
+             'fix_occupancy : true',
+             'iprint : 3']
+
+    Path(file_).parent.mkdir(parents=True, exist_ok=True)
+
+    with open(file_, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    return file_
+
+
+def getCastepRunLines(rng=None, atomElements=None, families=(), scfCycles=10, completed=True, startTime=None):
+    """ This function makes the lines of one castep run: the header, the SCF
+        cycles, the spin density and forces, and the tensors of each family.
+        Only completed runs have the timings at the end. """
+
+    ions = Counter()
+    labels = []
+
+    for element in atomElements:
+        ions[element] += 1
+        labels.append((element, ions[element]))
+
+    lines = [' +-------------------------------------------------+',
+             ' |      CCC   AA    SSS  TTTTT  EEEEE  PPPP        |',
+             ' |     C     A  A  S       T    E      P   P       |',
+             ' |     C     AAAA   SS     T    EEE    PPPP        |',
+             ' |     C     A  A     S    T    E      P           |',
+             ' |      CCC  A  A  SSS     T    EEEEE  P           |',
+             ' +-------------------------------------------------+',
+             '',
+             f' Run started: {startTime.strftime("%a, %d %b %Y %H:%M:%S %z")}',
+             '',
+             f'                           Total number of ions in cell = {len(atomElements):>6d}',
+             '',
+             '------------------------------------------------------------------------ <-- SCF',
+             'SCF loop      Energy           Fermi           Energy gain       Timer   <-- SCF',
+             '                               energy          per atom          (sec)   <-- SCF',
+             '------------------------------------------------------------------------ <-- SCF']
+
+    energy = -100.0 * len(atomElements)
+
+    for cycle in range(1, scfCycles + 1):
+        gain = rng.random() * 10.0 ** -cycle
+        energy -= gain
+        lines.append(f'{cycle:>6d}  {energy:>16.8E}  {rng.random():>15.8E}  {gain:>16.8E}  {cycle * 1.5:>9.2f}  <-- SCF')
+
+    lines += ['------------------------------------------------------------------------ <-- SCF',
+              '',
+              f'Final energy, E             =  {energy:>18.9f}     eV',
+              '',
+              f'Integrated Spin Density     =  {rng.random():>12.5E} hbar/2',
+              '',
+              ' ******************************** Forces ********************************',
+              ' *                                                                      *',
+              ' *                     Cartesian components (eV/A)                      *',
+              ' * -------------------------------------------------------------------- *',
+              ' *                         x                    y                    z  *',
+              ' *                                                                      *']
+
+    forces = rng.normal(scale=0.01, size=(len(labels), 3))
+
+    lines += [f' * {element:<3s} {ion:>6d}   {fx:>18.5f}   {fy:>18.5f}   {fz:>18.5f}  *'
+              for (element, ion), (fx, fy, fz) in zip(labels, forces)]
+
+    lines += [' *                                                                      *',
+              ' ************************************************************************',
+              '']
+
+    for family in families:
+        for word, kind in castepFamilies[family]:
+            tensors = rng.normal(size=(len(labels), 3, 3))
+
+            for (element, ion), tensor in zip(labels, tensors):
+                lines += [f'  {element:<3s} {ion:>4d}  {word}  {kind}',
+                          '']
+                lines += [f'        {x:>12.5E}   {y:>12.5E}   {z:>12.5E}' for x, y, z in tensor]
+                lines.append('')
+
+    if completed:
+        lines += ['Initialisation time =          0.50 s',
+                  f'Calculation time    = {scfCycles * 1.5 - 0.1:>12.2f} s',
+                  'Finalisation time   =          0.10 s',
+                  f'Total time          = {scfCycles * 1.5 + 0.5:>12.2f} s',
+                  f'Peak Memory Use     = {100000 + 1000 * len(atomElements):>8d} kB',
+                  '',
+                  f'Overall parallel efficiency rating: Very good ({80 + int(rng.integers(20))}%)',
+                  '']
+
+    return lines
+
+
+def writeCastepFile(file_=None, atomElements=None, families=('nmr',), scfCycles=10, continuations=0, completed=True, seed=0):
+    """ This function writes a synthetic castep file for the atoms, with the
+        tensors of each family. Each continuation is a run before the final
+        one (as when a calculation is continued), so the file is that many
+        times longer. The same seed always gives the same file. """
+
+    assert isinstance(file_, str)
+    assert isinstance(atomElements, (list, tuple)) and len(atomElements) > 0
+    assert isinstance(families, (list, tuple))
+    assert all(family in castepFamilies for family in families), f'Families should be from {", ".join(castepFamilies)}'
+    assert isinstance(scfCycles, int) and scfCycles > 0
+    assert isinstance(continuations, int) and continuations >= 0
+    assert isinstance(completed, bool)
+    assert isinstance(seed, int)
+
+    rng = default_rng(seed)
+
+    lines = []
+
+    for run in range(continuations + 1):
+        final = run == continuations
+
+        lines += getCastepRunLines(rng=rng, atomElements=atomElements, families=families, scfCycles=scfCycles,
+                                   completed=completed or not final,
+                                   startTime=fixtureStartTime + timedelta(hours=run))
+
+    Path(file_).parent.mkdir(parents=True, exist_ok=True)
+
+    with open(file_, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    return file_
+
+
+def writeGeomFile(file_=None, atomElements=None, steps=10, dynamics=False, seed=0):
+    """ This function writes a synthetic geom file of the atoms with the
+        given number of steps. If dynamics then it is as from a variable cell
+        molecular dynamics run, with the temperature, pressure, lattice
+        velocities and atom velocities as well (<-- T, P, hv and V lines).
+        The same seed always gives the same file. """
+
+    assert isinstance(file_, str)
+    assert isinstance(atomElements, (list, tuple)) and len(atomElements) > 0
+    assert isinstance(steps, int) and steps > 0
+    assert isinstance(dynamics, bool)
+    assert isinstance(seed, int)
+
+    rng = default_rng(seed)
+
+    ions = Counter()
+    labels = []
+
+    for element in atomElements:
+        ions[element] += 1
+        labels.append((element, ions[element]))
+
+    lines = [' BEGIN header',
+             '  ',
+             ' END header',
+             '  ']
+
+    for step in range(steps):
+        # Molecular dynamics steps are labelled by their time rather than a number.
+        lines.append(f'{step * 41.341374575751:>24.16E}' if dynamics else f'{step:>24d}')
+
+        energies = -100.0 + rng.random(3 if dynamics else 2)
+        lines.append(''.join(f'{energy:>24.16E}' for energy in energies) + '  <-- E')
+
+        if dynamics:
+            lines.append(f'{rng.random() * 1e-3:>24.16E}  <-- T')
+            lines.append(f'{rng.random() * 1e-4:>24.16E}  <-- P')
+
+        # A cubic lattice of 20 Ang (in Bohr) with a little noise, then small lattice velocities and stresses.
+        for tag in ('h', 'hv', 'S') if dynamics else ('h', 'S'):
+            values = rng.random((3, 3)) * 1e-4
+
+            if tag == 'h':
+                values += [[37.79452, 0.0, 0.0], [0.0, 37.79452, 0.0], [0.0, 0.0, 37.79452]]
+
+            lines += [''.join(f'{value:>24.16E}' for value in row) + f'  <-- {tag}' for row in values]
+
+        for tag in ('R', 'V', 'F') if dynamics else ('R', 'F'):
+            values = rng.random((len(labels), 3)) * (37.79452 if tag == 'R' else 1e-3)
+
+            lines += [f' {element:<3s} {ion:>6d}' + ''.join(f'{value:>24.16E}' for value in row) + f'  <-- {tag}'
+                      for (element, ion), row in zip(labels, values)]
+
+        lines.append('  ')
+
+    Path(file_).parent.mkdir(parents=True, exist_ok=True)
+
+    with open(file_, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    return file_
+
+
+def writeFixtures(directory=None, calculations=10, atoms=50, species=('H', 'C', 'N', 'O'), families=('nmr',),
+                  scfCycles=10, continuations=0, statuses=fixtureStatuses, seed=0):
+    """ This function writes a directory of calculations as they would be
+        part way through a project. Each calculation gets the status next in
+        line from statuses: created ones only have cell and param files,
+        submitted ones a sub file too, running ones an unfinished castep file,
+        errored ones an err file and completed ones a finished castep file.
+        Returns the directories of the calculations. """
+
+    assert isinstance(directory, str)
+    assert isinstance(calculations, int) and calculations > 0
+    assert isinstance(statuses, (list, tuple)) and len(statuses) > 0
+    assert all(status in fixtureStatuses for status in statuses), f'Statuses should be from {", ".join(fixtureStatuses)}'
+
+    directories = []
+
+    for num in range(calculations):
+        calcDirectory = f'{Path(directory)}/{num:05d}/'
+        status = statuses[num % len(statuses)]
+
+        cellFile = writeCellFile(file_=f'{calcDirectory}bench.cell', atoms=atoms, species=species, seed=seed + num)
+
+        positions = getSettings('positions_frac', settings=readSettings(file_=cellFile))
+
+        atomElements = positions.getElements()
+
+        # Castep names its output after the cell file.
+        name = positions.findName()
+        Path(cellFile).rename(f'{calcDirectory}{name}.cell')
+
+        writeParamFile(file_=f'{calcDirectory}{name}.param')
+
+        if status != 'created':
+            with open(f'{calcDirectory}{name}.sub', 'w') as f:
+                f.write(f'{name} calculation queued at {(fixtureStartTime - timedelta(minutes=num + 1)).strftime("%Y-%m-%d %H:%M:%S.%f")}\n')
+
+        if status in ('running', 'errored', 'completed'):
+            writeCastepFile(file_=f'{calcDirectory}{name}.castep', atomElements=atomElements, families=families,
+                            scfCycles=scfCycles, continuations=continuations, completed=status == 'completed', seed=seed + num)
+
+        if status == 'errored':
+            with open(f'{calcDirectory}{name}.0001.err', 'w') as f:
+                f.write('Error in SCF: electronic minimisation did not converge\n')
+
+        directories.append(str(Path(calcDirectory)))
+
+    return directories
@@ -1,24 +1,262 @@
 from casbot.data import assertCount, createDirectories,\
     pi, getElement,\
-    getFileLines,\
+    findFile, getFileLines, getRunIndex, getRunLines, isDirectory, listDirectory, openFile, stripCompression,\
     serialDefault, bashAliasesFileDefault, notificationAliasDefault, queueFileDefault,\
     PrintColors
-from casbot.settings import Setting, createSettings, createVariableSettings, getSettings, getSettingLines, readSettings, StrBlock # TODO: profiling
-from casbot.results import getResult
+from casbot.settings import Setting, createSettings, createVariableSettings, getSettings, getSettingLines, readSettings, toHashable, StrBlock # TODO: profiling
+from casbot.results import getBands, getGeometry, getProfile, getRunSummary, getSCF, readDensity, getResult, NMR, Result
 
+from collections import Counter
 from copy import deepcopy
 from datetime import datetime
 from dateutil import parser
-from fnmatch import filter
+from fnmatch import filter, fnmatch
+from hashlib import sha256
 from itertools import product
-from numpy import array, asarray, cos, dot, floor, sin, sqrt
-from os import chdir, getcwd, listdir
+from numpy import array, asarray, cos, dot, floor, isnan, sin, sqrt
+from os import chdir, getcwd, scandir
 from pathlib import Path
+from random import Random
 #from re import search
 from subprocess import run as subProcessRun
 
 
-def createCalculations(*variables, settings=None, directories=None, defaults=True):
+sweepModes = ('product', 'zip', 'random', 'latin', 'pairwise')
+
+# Candidate combinations tried for each one chosen in the pairwise mode.
+pairwiseCandidates = 20
+
+
+def getPairs(shape=None, index=None):
+    """ This function returns the pairs of values, (i, a, j, b) for value a of
+        variable i and value b of variable j, that a combination covers """
+
+    return [(i, index[i], j, index[j]) for i in range(len(shape)) for j in range(i + 1, len(shape))]
+
+
+def getOrthogonalArrayIndices(shape=None):
+    """ This function makes the combinations of an orthogonal array of
+        strength 2, where every pair of values is together exactly once, from
+        the p**2 rows (a, b, a + b, a + 2b, ...) mod p for the smallest prime p
+        that is at least the number of values of every variable and one less
+        than the number of variables. Values a variable doesn't have are
+        left free, and rows whose free values don't clash are merged. """
+
+    p = max(max(shape), len(shape) - 1, 2)
+
+    while any(p % d == 0 for d in range(2, int(p ** 0.5) + 1)):
+        p += 1
+
+    rows = []
+
+    for a in range(p):
+        for b in range(p):
+            row = [value if value < n else None for value, n in zip([a] + [(a * m + b) % p for m in range(p)], shape)]
+
+            # Rows with less than two values left don't cover any pairs.
+            if sum(value is not None for value in row) >= 2:
+                rows.append(row)
+
+    merged = []
+
+    for row in sorted(rows, key=lambda r: r.count(None)):
+        for other in merged:
+            if None in row and all(x is None or y is None or x == y for x, y in zip(row, other)):
+                other[:] = [y if x is None else x for x, y in zip(row, other)]
+                break
+        else:
+            merged.append(row)
+
+    return [tuple(0 if value is None else value for value in row) for row in merged]
+
+
+def getGreedyPairwiseIndices(shape=None, rng=None):
+    """ This function makes combinations covering every pair of values one
+        at a time as in AETG, trying a few candidates starting from a pair
+        not covered yet and keeping the one covering the most pairs """
+
+    uncovered = {(i, a, j, b) for i in range(len(shape)) for j in range(i + 1, len(shape))
+                 for a in range(shape[i]) for b in range(shape[j])}
+
+    indices = []
+
+    while uncovered:
+        best, bestCovered = None, None
+
+        # Sorted so that the same seed gives the same combinations.
+        remaining = sorted(uncovered)
+
+        for _ in range(pairwiseCandidates):
+            i, a, j, b = rng.choice(remaining)
+
+            index = {i: a, j: b}
+
+            others = [k for k in range(len(shape)) if k not in index]
+            rng.shuffle(others)
+
+            for k in others:
+                counts = [sum((min(k, m), c if k < m else v, max(k, m), v if k < m else c) in uncovered
+                              for m, v in index.items()) for c in range(shape[k])]
+
+                most = max(counts)
+
+                index[k] = rng.choice([c for c, count in enumerate(counts) if count == most])
+
+            index = tuple(index[k] for k in range(len(shape)))
+
+            covered = set(getPairs(shape=shape, index=index)) & uncovered
+
+            if bestCovered is None or len(covered) > len(bestCovered):
+                best, bestCovered = index, covered
+
+        indices.append(best)
+        uncovered -= bestCovered
+
+    return indices
+
+
+def prunePairwiseIndices(shape=None, indices=None):
+    """ This function removes repeated combinations and those whose pairs are
+        all covered by other combinations, most covered first """
+
+    indices = sorted(set(indices))
+
+    covers = Counter(pair for index in indices for pair in getPairs(shape=shape, index=index))
+
+    kept = []
+
+    for index in sorted(indices, key=lambda index: -sum(covers[pair] for pair in getPairs(shape=shape, index=index))):
+        pairs = getPairs(shape=shape, index=index)
+
+        if all(covers[pair] > 1 for pair in pairs):
+            for pair in pairs:
+                covers[pair] -= 1
+        else:
+            kept.append(index)
+
+    return sorted(kept)
+
+
+def getSweepIndices(shape=None, mode='product', samples=None, seed=None):
+    """ This function chooses which combinations of the variable settings to
+        make calculations of, given the number of values of each variable.
+        Returns a list of tuples of the index of the value of each variable.
+        product     every combination
+        zip         the first values together, then the second values, etc.
+        random      samples combinations drawn at random (without repeats)
+        latin       samples combinations as a Latin hypercube, so each value
+                    of each variable is used as evenly as possible (repeated
+                    combinations are redrawn, so there are always samples)
+        pairwise    enough combinations for every pair of values of any two
+                    variables to be together at least once, the fewer of an
+                    orthogonal array and a greedy (AETG) construction
+        Pairwise needs the fewest possible, n**2, when every variable has the
+        same prime number n of values and there are at most n + 1 variables
+        (e.g. 49 for eight 7-value variables). Otherwise it can be around a
+        fifth more than the fewest possible, e.g. 119 combinations for five
+        10-value variables where about 100 are needed.
+        The combinations are in the order they would be in the product. """
+
+    assert isinstance(shape, (list, tuple))
+    assert all(isinstance(n, int) and n > 0 for n in shape)
+    assert isinstance(mode, str)
+
+    mode = mode.strip().lower()
+
+    assert mode in sweepModes, f'Mode {mode} not recognised, use one of {", ".join(sweepModes)}'
+
+    if mode in ('random', 'latin'):
+        assert isinstance(samples, int) and samples > 0, f'Number of samples needed for {mode} mode'
+
+        total = 1
+
+        for n in shape:
+            total *= n
+
+        assert samples <= total, f'Cannot draw {samples} samples from {total} combinations'
+
+    else:
+        assert samples is None, f'Number of samples not used in {mode} mode'
+
+    rng = Random(seed)
+
+    if mode == 'product':
+        return list(product(*map(range, shape)))
+
+    elif mode == 'zip':
+        assert len(set(shape)) <= 1, 'Variables must have the same number of values to zip them'
+
+        return [(n,) * len(shape) for n in range(shape[0] if shape else 1)]
+
+    elif mode == 'random':
+        indices = []
+
+        # Drawn from the flattened product so that there are no repeats and nothing the size of the product is made.
+        for flat in sorted(rng.sample(range(total), samples)):
+            index = []
+
+            for n in reversed(shape):
+                flat, i = divmod(flat, n)
+                index.append(i)
+
+            indices.append(tuple(reversed(index)))
+
+        return indices
+
+    elif mode == 'latin':
+        if not shape:
+            return [()]
+
+        columns = []
+
+        # Each variable has its values spread over the samples in a random order, one stratum per sample.
+        for n in shape:
+            strata = list(range(samples))
+            rng.shuffle(strata)
+
+            columns.append([int((stratum + rng.random()) * n / samples) for stratum in strata])
+
+        indices = set(zip(*columns))
+
+        # With more samples than some of the values there can be repeats, which would share a directory. These are
+        # redrawn from the least used values of each variable, allowing more of them the more often this fails.
+        uses = [Counter(index[k] for index in indices) for k in range(len(shape))]
+
+        fails = 0
+
+        while len(indices) < samples:
+            slack = fails // 10
+
+            index = tuple(rng.choice([c for c in range(n) if uses[k][c] <= min(uses[k][v] for v in range(n)) + slack])
+                          for k, n in enumerate(shape))
+
+            if index in indices:
+                fails += 1
+                continue
+
+            indices.add(index)
+
+            for k, c in enumerate(index):
+                uses[k][c] += 1
+
+            fails = 0
+
+        return sorted(indices)
+
+    # Pairwise.
+    if len(shape) < 2:
+        return list(product(*map(range, shape)))
+
+    return min(prunePairwiseIndices(shape=shape, indices=getOrthogonalArrayIndices(shape=shape)),
+               prunePairwiseIndices(shape=shape, indices=getGreedyPairwiseIndices(shape=shape, rng=rng)), key=len)
+
+
+def createCalculations(*variables, settings=None, directories=None, defaults=True, mode='product', samples=None, seed=None):
+    """ This function creates the calculations of every combination of the
+        variable settings, or of those chosen by the mode (see
+        getSweepIndices) with samples and seed for the random modes. Each
+        calculation has the same directory it would have in the product. """
+
     if settings is None:
         settings = []
     else:
@@ -33,6 +271,8 @@ def createCalculations(*variables, settings=None, directories=None, defaults=Tru
 
     variableSettings = createVariableSettings(*variables)
 
+    sweepIndices = getSweepIndices(shape=[len(varSetts) for varSetts in variableSettings], mode=mode, samples=samples, seed=seed)
+
     # Now that we have dealt with the variable cells/params of the calculations, we now work on the general cells/params.
     settings = createSettings(*settings)
 
@@ -80,8 +320,13 @@ def createCalculations(*variables, settings=None, directories=None, defaults=Tru
     # Combinations will expand out the varSettingsProcessed and create every possible combination of the variable settings.
     # E.g. If we have argument1=['HF', 'HCl'] and argument2=[Cell(bField=1.0T), Cell(bField=2.0T)]
     # Then combinations will be: [(HF, bField 1.0T), (HF, bField 2.0T), (HCl, bField 1.0T), (HCl, bField 2.0T)]
-    variables = list(product(*variableSettings))
-    directoryNames = list(product(*directoryNames))
+    # Other modes only take some of these combinations, e.g. zip would be: [(HF, bField 1.0T), (HCl, bField 2.0T)]
+    if variableSettings:
+        variables = [tuple(varSetts[n] for varSetts, n in zip(variableSettings, index)) for index in sweepIndices]
+        directoryNames = [tuple(dirNames[n] for dirNames, n in zip(directoryNames, index)) for index in sweepIndices]
+    else:
+        variables = list(product(*variableSettings))
+        directoryNames = list(product(*directoryNames))
 
     if defaults:
         specifiedKeys = []
@@ -161,76 +406,130 @@ def processCalculations(*directories, parent=''):
     calculations = []
 
     for directory in directories:
-        assert Path(directory).is_dir(), f'Cannot find directory {directory}'
+        assert isDirectory(directory=directory), f'Cannot find directory {directory}'
 
-        prefix = None
-        cellPrefix = None
-        paramPrefix = None
+        calculations.append(readCalculation(directory=directory, fileNames=listDirectory(directory=directory)))
 
-        # Get settings from cell file.
-        cellFiles = filter(listdir(directory), '*.cell')
-        cellFiles = [f for f in cellFiles if not f.endswith('-out.cell')]
+    return calculations
 
-        cells = []
 
-        if len(cellFiles) == 1:
-            cellPrefix = cellFiles[0][:-5] # Removes '.cell'
-            cells = readSettings(file_=f'{directory}{cellFiles[0]}')
+def findCalculationDirectories(root=None, pattern='*'):
+    """ This function walks the tree under root for the directories with a
+        cell or param file in, listing each directory only once. The path of
+        a directory relative to root has to match the pattern, e.g. 'nmr/*'.
+        Returns the sorted directories along with the names of their files. """
 
-        elif len(cellFiles) > 1:
-            raise NameError(f'Too many cell files to read in directory {directory}')
+    assert isinstance(root, str)
+    assert isinstance(pattern, str)
 
-        else:
-            print(f'*** Caution: no cell file found in {directory}')
+    root = root.rstrip('/') or '/'
 
-        # Now do param file.
-        paramFiles = filter(listdir(directory), '*.param')
-        params = []
+    assert Path(root).is_dir(), f'Cannot find directory {root}'
 
-        if len(paramFiles) == 1:
-            paramPrefix = paramFiles[0][:-6]  # Removes '.param'
-            params = readSettings(file_=f'{directory}{paramFiles[0]}')
+    found = []
 
-        elif len(paramFiles) > 1:
-            raise NameError(f'Too many param files to read in directory {directory}')
+    toWalk = [root]
 
-        else:
-            print(f'*** Caution: no param file found in {directory}')
+    while toWalk:
+        directory = toWalk.pop()
+
+        try:
+            entries = list(scandir(directory))
+        except OSError:
+            print(f'*** Caution: cannot read directory {directory} ***')
+            continue
 
-        # Check cell and param prefixes are the same.
-        if cellPrefix is not None and paramPrefix is not None:
-            assert paramPrefix == cellPrefix, \
-                f'Different prefixes for cell and param files: {cellPrefix}.cell, {paramPrefix}.param'
-            prefix = cellPrefix
+        fileNames = []
 
-        elif cellPrefix is not None:
-            prefix = cellPrefix
+        for entry in entries:
+            # Symbolic links to directories are not followed in case they loop.
+            if entry.is_dir(follow_symlinks=False):
+                toWalk.append(entry.path)
 
-        elif paramPrefix is not None:
-            prefix = paramPrefix
+            elif entry.is_file():
+                fileNames.append(entry.name)
 
-        # Group cell and param settings together.
-        settings = cells + params
+        uncompressed = [stripCompression(file_=name) for name in fileNames]
 
-        # Create new calculation.
-        newCalculation = Calculation(name=prefix,
-                                     directory=directory,
-                                     settings=settings)
+        if not any((name.endswith('.cell') and not name.endswith('-out.cell')) or name.endswith('.param') for name in uncompressed):
+            continue
 
-        # And add it to the list!
-        calculations.append(newCalculation)
+        if fnmatch(Path(directory).relative_to(root).as_posix(), pattern):
+            found.append((f'{directory}/', fileNames))
 
-    return calculations
+    return sorted(found)
+
+
+def readCalculation(directory=None, fileNames=None):
+    """ This function makes a calculation from the cell and param files
+        amongst the names of the files in its directory """
+
+    assert isinstance(directory, str)
+    assert isinstance(fileNames, list)
+
+    prefix = None
+    cellPrefix = None
+    paramPrefix = None
+
+    # Compressed cell and param files are found by their uncompressed names.
+    fileNames = sorted(set(stripCompression(file_=f) for f in fileNames))
+
+    # Get settings from cell file.
+    cellFiles = filter(fileNames, '*.cell')
+    cellFiles = [f for f in cellFiles if not f.endswith('-out.cell')]
+
+    cells = []
+
+    if len(cellFiles) == 1:
+        cellPrefix = cellFiles[0][:-5] # Removes '.cell'
+        cells = readSettings(file_=f'{directory}{cellFiles[0]}')
+
+    elif len(cellFiles) > 1:
+        raise NameError(f'Too many cell files to read in directory {directory}')
+
+    else:
+        print(f'*** Caution: no cell file found in {directory}')
+
+    # Now do param file.
+    paramFiles = filter(fileNames, '*.param')
+    params = []
+
+    if len(paramFiles) == 1:
+        paramPrefix = paramFiles[0][:-6]  # Removes '.param'
+        params = readSettings(file_=f'{directory}{paramFiles[0]}')
+
+    elif len(paramFiles) > 1:
+        raise NameError(f'Too many param files to read in directory {directory}')
+
+    else:
+        print(f'*** Caution: no param file found in {directory}')
+
+    # Check cell and param prefixes are the same.
+    if cellPrefix is not None and paramPrefix is not None:
+        assert paramPrefix == cellPrefix, \
+            f'Different prefixes for cell and param files: {cellPrefix}.cell, {paramPrefix}.param'
+        prefix = cellPrefix
+
+    elif cellPrefix is not None:
+        prefix = cellPrefix
+
+    elif paramPrefix is not None:
+        prefix = paramPrefix
+
+    # Group cell and param settings together.
+    settings = cells + params
+
+    # Create new calculation.
+    return Calculation(name=prefix,
+                       directory=directory,
+                       settings=settings)
 
 
 def groupDensityCalculations(calculations=None):
     assert isinstance(calculations, list)
     assert all(isinstance(c, Calculation) for c in calculations)
 
-    # calculations = sorted(self.calculations, key=lambda c: c.directory)
-    # calculations = deepcopy(calculations)
-
-    calculations = deepcopy(calculations)
+    # The calculations aren't copied - each xyz group is a view onto its x, y and z calculations.
 
     # We need to group together any xyz density-type calculations so they can be combined.
     # Let's set up the groups and a temp variable to hold each group.
@@ -279,7 +578,7 @@ def groupDensityCalculations(calculations=None):
             group = []
 
     if any([len(group) not in [1, 3] for group in groups]):
-        return calculations
+        return list(calculations)
 
     calculations = []
 
@@ -292,101 +591,97 @@ def groupDensityCalculations(calculations=None):
             continue
 
         # Otherwise, let's combine the three density calculations into one.
-        # We will combine y and z into x.
+        calculations.append(DensityGroup(*group))
 
-        cX, cY, cZ = group
+    return calculations
 
-        if cX.name == cY.name == cZ.name:
-            pass
-        else:
-            if cX.name is not None:
-                cX.name = f'x:{cX.name} '
 
-            if cY.name is not None:
-                cX.name += f'y:{cY.name} '
+def sumTensors(*tensorLists):
+    """ This function sums lists of tensors element-wise, adding the stacked
+        arrays of each list together in one go rather than tensor by tensor """
 
-            if cZ.name is not None:
-                cX.name += f'z:{cZ.name} '
-
-        if cX.name is not None:
-            cX.name = cX.name.strip()
-
-        cX.directory = f'{cX.directory[:-2]}xyz/'
-
-        hyperfineDipolarBareTensors = [tensorX + tensorY + tensorZ
-                                       for tensorX, tensorY, tensorZ in zip(cX.hyperfineDipolarBareTensors,
-                                                                            cY.hyperfineDipolarBareTensors,
-                                                                            cZ.hyperfineDipolarBareTensors)]
-
-        hyperfineDipolarAugTensors = [tensorX + tensorY + tensorZ
-                                      for tensorX, tensorY, tensorZ in zip(cX.hyperfineDipolarAugTensors,
-                                                                           cY.hyperfineDipolarAugTensors,
-                                                                           cZ.hyperfineDipolarAugTensors)]
-
-        hyperfineDipolarAug2Tensors = [tensorX + tensorY + tensorZ
-                                       for tensorX, tensorY, tensorZ in zip(cX.hyperfineDipolarAug2Tensors,
-                                                                            cY.hyperfineDipolarAug2Tensors,
-                                                                            cZ.hyperfineDipolarAug2Tensors)]
-
-        hyperfineDipolarTensors = [tensorX + tensorY + tensorZ
-                                   for tensorX, tensorY, tensorZ in zip(cX.hyperfineDipolarTensors,
-                                                                        cY.hyperfineDipolarTensors,
-                                                                        cZ.hyperfineDipolarTensors)]
-
-        hyperfineFermiTensors = [tensorX + tensorY + tensorZ
-                                 for tensorX, tensorY, tensorZ in zip(cX.hyperfineFermiTensors,
-                                                                      cY.hyperfineFermiTensors,
-                                                                      cZ.hyperfineFermiTensors)]
-
-        hyperfineZFCTensors = [tensorX + tensorY + tensorZ
-                               for tensorX, tensorY, tensorZ in zip(cX.hyperfineZFCTensors,
-                                                                    cY.hyperfineZFCTensors,
-                                                                    cZ.hyperfineZFCTensors)]
-
-        hyperfineTotalTensors = [tensorX + tensorY + tensorZ
-                                 for tensorX, tensorY, tensorZ in zip(cX.hyperfineTotalTensors,
-                                                                      cY.hyperfineTotalTensors,
-                                                                      cZ.hyperfineTotalTensors)]
-
-        cX.hyperfineDipolarBareTensors = hyperfineDipolarBareTensors
-        cX.hyperfineDipolarAugTensors = hyperfineDipolarAugTensors
-        cX.hyperfineDipolarAug2Tensors = hyperfineDipolarAug2Tensors
-        cX.hyperfineDipolarTensors = hyperfineDipolarTensors
-        cX.hyperfineFermiTensors = hyperfineFermiTensors
-        cX.hyperfineZFCTensors = hyperfineZFCTensors
-        cX.hyperfineTotalTensors = hyperfineTotalTensors
-
-        calculations.append(cX)
+    tensorLists = [tensors[:min(len(tensors) for tensors in tensorLists)] for tensors in tensorLists]
 
-    return calculations
+    first = tensorLists[0]
+
+    if not first:
+        return []
+
+    for tensors in tensorLists[1:]:
+        for tensorA, tensorB in zip(first, tensors):
+            assert tensorA.key == tensorB.key, 'Cannot add different NMR tensors'
+            assert tensorA.unit == tensorB.unit, 'Cannot add tensors of different units'
+            assert tensorA.element == tensorB.element, 'Cannot add tensors relating to different elements'
+            assert tensorA.ion == tensorB.ion, 'Cannot add tensors relating to different ions'
+
+    values = sum(array([tensor.value for tensor in tensors]) for tensors in tensorLists)
+
+    return [NMR(key=tensor.key, value=value, unit=tensor.unit, element=tensor.element, ion=tensor.ion)
+            for tensor, value in zip(first, values)]
+
+
+class StoredResult:
+    """ A result of a calculation which, if the calculation was loaded lazily
+        from a columnar model store, is only read in when first accessed.
+        Once read (or set by analyse) the result is an ordinary attribute. """
+
+    def __init__(self, default=None):
+        self.default = default
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+
+        store = instance.__dict__.get('resultStore', None)
+
+        if store is None:
+            return self.default
+
+        value = store.getResult(name=self.name, index=instance.resultIndex)
+
+        # Now it is an instance attribute we won't come back here.
+        instance.__dict__[self.name] = value
+
+        return value
 
 
 class Calculation:
-    nmrCoreTensors = []
-    nmrBareTensors = []
-    nmrDiaTensors = []
-    nmrParaTensors = []
-    nmrTotalTensors = []
+    nmrCoreTensors = StoredResult(default=[])
+    nmrBareTensors = StoredResult(default=[])
+    nmrDiaTensors = StoredResult(default=[])
+    nmrParaTensors = StoredResult(default=[])
+    nmrTotalTensors = StoredResult(default=[])
+
+    efgBareTensors = StoredResult(default=[])
+    efgIonTensors = StoredResult(default=[])
+    efgAugTensors = StoredResult(default=[])
+    efgAug2Tensors = StoredResult(default=[])
+    efgTotalTensors = StoredResult(default=[])
 
-    efgBareTensors = []
-    efgIonTensors = []
-    efgAugTensors = []
-    efgAug2Tensors = []
-    efgTotalTensors = []
+    hyperfineDipolarBareTensors = StoredResult(default=[])
+    hyperfineDipolarAugTensors = StoredResult(default=[])
+    hyperfineDipolarAug2Tensors = StoredResult(default=[])
+    hyperfineDipolarTensors = StoredResult(default=[])
+    hyperfineFermiTensors = StoredResult(default=[])
+    hyperfineZFCTensors = StoredResult(default=[])
+    hyperfineTotalTensors = StoredResult(default=[])
 
-    hyperfineDipolarBareTensors = []
-    hyperfineDipolarAugTensors = []
-    hyperfineDipolarAug2Tensors = []
-    hyperfineDipolarTensors = []
-    hyperfineFermiTensors = []
-    hyperfineZFCTensors = []
-    hyperfineTotalTensors = []
+    forces = StoredResult(default=[])
 
-    forces = []
+    spinDensity = StoredResult(default=None)
 
-    spinDensity = None
+    positionsFrac = StoredResult(default=None)
 
-    positionsFrac = None
+    bands = StoredResult(default=None)
+
+    geometry = StoredResult(default=None)
+
+    resultStore = None
+    resultIndex = None
 
     def __init__(self, directory=None, settings=None, name=None):
         if directory is not None:
@@ -411,6 +706,17 @@ class Calculation:
 
         self.expectedSecToFinish = None
 
+    def __getstate__(self):
+        # Copies of the calculation shouldn't depend on the model store.
+        self.loadResults()
+
+        state = dict(self.__dict__)
+
+        state.pop('resultStore', None)
+        state.pop('resultIndex', None)
+
+        return state
+
     def __str__(self):
         string = 'Calculation ->'
 
@@ -452,6 +758,10 @@ class Calculation:
 
         FORCES = {'forces'}
 
+        BANDS = {'bands', 'band', 'band_structure', 'bandstructure', 'eigenvalues'}
+
+        GEOMETRY = {'geom', 'geometry', 'trajectory', 'geometry_optimisation', 'geometryoptimisation', 'molecular_dynamics', 'moleculardynamics', 'md'}
+
         SPINDENSITY = {'spin density', 'spin_density', 'spindensity'}
 
         POSFRACS = {'pos frac', 'pos fracs', 'position frac', 'position fracs', 'positions frac', 'positions fracs',
@@ -491,6 +801,12 @@ class Calculation:
             if toAnalyse.intersection(FORCES) and self.forces:
                 toAnalyse -= FORCES
 
+            if toAnalyse.intersection(BANDS) and self.bands is not None:
+                toAnalyse -= BANDS
+
+            if toAnalyse.intersection(GEOMETRY) and self.geometry is not None:
+                toAnalyse -= GEOMETRY
+
         # If there is no work to do then return.
         if len(toAnalyse) == 0:
             return
@@ -507,8 +823,10 @@ class Calculation:
         outSettings = None  # -out.cell file.
 
         if toAnalyse.intersection(NMR) or toAnalyse.intersection(EFG) or toAnalyse.intersection(HYPERFINE) or toAnalyse.intersection(SPINDENSITY) or toAnalyse.intersection(FORCES):
-            castepLines = getFileLines(file_=f'{self.directory}{self.name}.castep')
-            castepLines = self.getFinalRunLines(lines=castepLines)
+            castepLines = getRunLines(file_=f'{self.directory}{self.name}.castep')
+
+        if toAnalyse.intersection(BANDS):
+            bandsLines = getFileLines(file_=f'{self.directory}{self.name}.bands')
 
         if toAnalyse.intersection(POSFRACS):
             outSettings = readSettings(file_=f'{self.directory}{self.name}-out.cell')
@@ -558,6 +876,20 @@ class Calculation:
 
             toAnalyse -= POSFRACS
 
+        if toAnalyse.intersection(BANDS):
+            self.bands = getBands(lines=bandsLines)
+
+            toAnalyse -= BANDS
+
+        if toAnalyse.intersection(GEOMETRY):
+            assert findFile(file_=f'{self.directory}{self.name}.geom') is not None, f'Cannot find file {self.directory}{self.name}.geom'
+
+            # Trajectories can be large so the file is streamed rather than read in.
+            with openFile(file_=f'{self.directory}{self.name}.geom') as geomLines:
+                self.geometry = getGeometry(lines=geomLines)
+
+            toAnalyse -= GEOMETRY
+
         if toAnalyse:
             print(f'Skipping result{"" if len(toAnalyse) == 1 else "s"} {", ".join(toAnalyse)} as do not know how to analyse (yet)')
 
@@ -659,7 +991,11 @@ class Calculation:
 
         print(string)
 
-    def create(self, force=False, passive=False):
+    def create(self, force=False, passive=False, cache=None):
+        """ This function writes the cell and param files of the calculation
+            into its directory. Returns whether it was created, as it is
+            skipped if passive and the directory exists already. """
+
         assert isinstance(force, bool)
         assert isinstance(passive, bool)
 
@@ -674,7 +1010,7 @@ class Calculation:
         if directory.exists():
             if passive:
                 print(f'Skipping creation of calculation for {self.name} in {directory}')
-                return
+                return False
 
             elif not force:
                 raise FileExistsError('Directory for calculation already exists - use force=True to overwrite or passive=True to ignore')
@@ -684,6 +1020,24 @@ class Calculation:
         except FileExistsError:
             raise FileExistsError(f'Directory {directory} exists but is a file')
 
+        # Work out CASTEP prefix intelligently if calculation does not have a name
+        self.setName(strict=True)
+
+        # Each file is rendered in memory first so that it is written with a single call.
+        for extension, contents in self.getInputFiles(cache=cache).items():
+            with open(f'{directory}/{self.name}.{extension}', 'w') as f:
+                f.write(contents)
+
+        print(f'Created calculation for {self.name} in {directory}')
+
+        return True
+
+    def getInputFiles(self, cache=None):
+        """ This function renders the cell and param files of the calculation,
+            returning a dictionary of file extension to file contents. A cache
+            (dictionary) can be shared between calculations so that settings
+            common to them are only formatted once. """
+
         cells = [setting for setting in self.settings if setting.file == 'cell']
         params = [setting for setting in self.settings if setting.file == 'param']
 
@@ -693,39 +1047,76 @@ class Calculation:
         assert len(cells) + len(params) == len(self.settings), \
             'Setting in calculation cannot be categorised as a cell or param'
 
-        # Work out CASTEP prefix intelligently if calculation does not have a name
-        self.setName(strict=True)
+        files = {}
 
         if len(cells) > 0:
-            cellFile = f'{directory}/{self.name}.cell'
+            lines = []
 
-            with open(cellFile, 'w') as f:
-                for cell in cells:
+            for cell in cells:
+                lines += getSettingLines(sttng=cell, maxSettingLength=0, cache=cache)
+                lines.append('')
 
-                    for line in getSettingLines(sttng=cell, maxSettingLength=0):
-                        f.write(f'{line}\n')
-
-                    f.write('\n')
+            files['cell'] = '\n'.join(lines) + '\n'
 
         if len(params) > 0:
-            paramFile = f'{directory}/{self.name}.param'
-
             longestParam = max([len(param.key) for param in params])
 
             currentPriorityLevel = floor(params[0].priority)
 
-            with open(paramFile, 'w') as f:
-                for param in params:
+            lines = []
 
-                    # If we're at a new priority level then add a line
-                    if currentPriorityLevel != floor(param.priority):
-                        f.write('\n')
-                        currentPriorityLevel = floor(param.priority)
+            for param in params:
 
-                    for line in getSettingLines(sttng=param, maxSettingLength=longestParam):
-                        f.write(f'{line}\n')
+                # If we're at a new priority level then add a line
+                if currentPriorityLevel != floor(param.priority):
+                    lines.append('')
+                    currentPriorityLevel = floor(param.priority)
 
-        print(f'Created calculation for {self.name} in {directory}')
+                lines += getSettingLines(sttng=param, maxSettingLength=longestParam, cache=cache)
+
+            files['param'] = '\n'.join(lines) + '\n'
+
+        return files
+
+    def getFingerprint(self, cache=None):
+        """ This function returns a hash of the settings of the calculation
+            which does not depend on the order the settings were given in.
+            Calculations with the same fingerprint will give the same results. """
+
+        # Sort by key rather than priority so that settings with equal priority are always in the same order too.
+        settings = sorted(self.settings, key=lambda setting: (setting.file, setting.key))
+
+        lines = []
+
+        for setting in settings:
+            lines += getSettingLines(sttng=setting, maxSettingLength=0, cache=cache)
+
+        return sha256('\n'.join(lines).encode()).hexdigest()
+
+    def getDigest(self):
+        """ This function returns a hash of everything about the calculation,
+            results included, so it can be told when the calculation has changed """
+
+        digest = sha256()
+
+        for key, value in sorted(self.__getstate__().items()):
+            if key == 'settings' and value is not None:
+                parts = [setting.getCacheKey() for setting in value]
+
+            elif isinstance(value, list) and value and all(isinstance(result, Result) for result in value):
+                # Results are hashed by their raw values as there can be a lot of them.
+                parts = [(result.key, result.unit, getattr(result, 'element', None), getattr(result, 'ion', None),
+                          result.value.tobytes()) for result in value]
+
+            elif isinstance(value, Result):
+                parts = (value.key, value.unit, value.value.tobytes())
+
+            else:
+                parts = toHashable(value)
+
+            digest.update(f'{key}={parts!r};'.encode())
+
+        return digest.hexdigest()
 
     def getFortFile(self, i=90, lines=True):
         assert isinstance(i, int)
@@ -770,47 +1161,53 @@ class Calculation:
 
         return lines
 
-    def getCompletedTime(self):
-        """ This function will work out (in seconds) how long it will take this calculation to complete """
+    def getRuns(self):
+        """ This function gets the index of every run in the castep file of the
+            calculation, one for each time it was continued or restarted, as a
+            dictionary of arrays (see getRunIndex in data) """
 
-        assert self.getStatus() == 'completed', 'Calculation not complete so cannot get completed time'
+        self.setName(strict=True)
 
-        castepFile = f'{self.directory}{self.name}.castep'
+        return getRunIndex(file_=f'{self.directory}{self.name}.castep')
 
-        assert Path(castepFile).is_file(), 'Cannot find castep file to get completed time'
+    def getTotalRunTime(self):
+        """ This function adds up (in seconds) the total times of every run of
+            the calculation that finished. Runs that were stopped before they
+            finished don't have a total time so aren't included. """
 
-        with open(castepFile) as f:
-            castepLines = f.read().splitlines()
+        runs = self.getRuns()
 
-        castepLines = self.getFinalRunLines(lines=castepLines)
+        totalTimes = runs['totalTime'][runs['completed']]
 
-        castepLines.reverse()  # Total time at the end so quicker to reverse lines and go backwards.
+        return float(totalTimes[~isnan(totalTimes)].sum())
 
-        for line in castepLines:
-            line = line.strip().lower()
+    def getCompletedTime(self):
+        """ This function will work out (in seconds) how long it will take this calculation to complete """
+
+        assert self.getStatus() == 'completed', 'Calculation not complete so cannot get completed time'
+
+        totalTime = self.getRunSummary()['totalTime']
 
-            if line.startswith('total time'):
+        if isnan(totalTime):
+            raise ValueError(f'Cannot find total time in castep file {self.directory}{self.name}.castep')
 
-                # Check for sure it is indeed the total time printed at the end of the file.
-                parts = line.split()
+        return totalTime
 
-                if len(parts) <= 2 or parts[2] != '=':
-                    continue
+    def getRunSummary(self):
+        """ This function gets the final energy, timings, peak memory and
+            parallel efficiency written at the end of the last run of the
+            calculation (see getRunSummary in results). Only the last run is
+            read, going straight to it with the run index. """
 
-                index = line.index('=')
+        self.setName(strict=True)
 
-                assert index != -1, f'Error in total time in castep file {castepFile}'
+        castepFile = f'{self.directory}{self.name}.castep'
 
-                line = line[index+1:].strip()
+        assert findFile(file_=castepFile) is not None, 'Cannot find castep file to get run summary'
 
-                line = line[:-1].strip()
+        castepLines = getRunLines(file_=castepFile)
 
-                try:
-                    return float(line)
-                except ValueError:
-                    raise ValueError(f'Error in total time in castep file {castepFile}')
-        else:
-            raise ValueError(f'Cannot find total time in castep file {castepFile}')
+        return getRunSummary(lines=castepLines)
 
     def getRunningTime(self):
         """ This function will work out how long (in seconds) this calculation has been running for """
@@ -826,28 +1223,22 @@ class Calculation:
 
         castepFile = f'{self.directory}{self.name}.castep'
 
-        if not Path(castepFile).is_file():
+        if findFile(file_=castepFile) is None:
             return None
         #assert Path(castepFile).is_file(), 'Cannot find castep file to get running time'
 
-        with open(castepFile) as f:
-            castepLines = f.read().splitlines()
+        index = getRunIndex(file_=castepFile)
 
-        castepLines = self.getFinalRunLines(lines=castepLines)
-
-        for line in castepLines:
-            line = line.strip()
+        if len(index['start']) == 0:
+            raise ValueError('Cannot find any run started line in lines')
 
-            if line.lower().startswith('run started:'):
-                line = line[12:].strip()  # len('Run started:') = 12
+        startTime = index['start'][-1]
 
-                try:
-                    return datetime.strptime(line, '%a, %d %b %Y %H:%M:%S %z').timestamp()
-                except ValueError:
-                    pass
-        else:
+        if isnan(startTime):
             raise ValueError(f'Cannot find start time in castep file {castepFile}')
 
+        return float(startTime)
+
     def getSubTime(self):
         """ This function will find the sub time as a timestamp """
 
@@ -856,12 +1247,12 @@ class Calculation:
 
         subFile = f'{self.directory}{self.name}.sub'
 
-        if not Path(subFile).is_file():
+        if findFile(file_=subFile) is None:
             return None
 
         #assert Path(subFile).is_file(), 'Cannot find sub file to get submitted time'
 
-        with open(subFile) as f:
+        with openFile(file_=subFile) as f:
             subLines = f.read().splitlines()
 
         subLines.reverse()  # Most recent submit will be last if there are multiple
@@ -900,10 +1291,10 @@ class Calculation:
         if self.directory is None:
             return 'no directory specified'
 
-        if not Path(self.directory).is_dir():
+        if not isDirectory(directory=self.directory):
             return 'not yet created'
 
-        if any((self.name in file_ and '.err' in file_) for file_ in listdir(self.directory)):
+        if any((self.name in file_ and '.err' in file_) for file_ in listDirectory(directory=self.directory)):
             return 'errored'
 
         self.setName(strict=False)
@@ -914,33 +1305,34 @@ class Calculation:
         subFile = f'{self.directory}{self.name}.sub'
         castepFile = f'{self.directory}{self.name}.castep'
 
-        if Path(castepFile).is_file():
-            with open(castepFile) as f:
-                castepLines = f.read().splitlines()
+        if findFile(file_=castepFile) is not None:
+            # Only the last run counts as there will be one for each continuation.
+            completed = getRunIndex(file_=castepFile)['completed']
 
-            castepLines = self.getFinalRunLines(lines=castepLines)
+            if len(completed) == 0:
+                raise ValueError('Cannot find any run started line in lines')
 
-            castepLines.reverse()  # Total time will be at the end of the file so will speed up the next loop.
+            return 'completed' if completed[-1] else 'running'
 
-            for line in castepLines:
-                line = line.strip().lower()
+        elif findFile(file_=subFile) is not None:
+            return 'submitted'
 
-                if line.startswith('total time'):
-                    # Check for sure it is indeed the total time printed at the end of the file.
-                    parts = line.split()
+        else:
+            return 'created'
 
-                    if len(parts) <= 2 or parts[2] != '=':
-                        continue
+    def loadResults(self):
+        """ This function reads in any results of the calculation still in a
+            model store, after which the calculation no longer needs the store """
 
-                    return 'completed'
+        if self.resultStore is None:
+            return
 
-            return 'running'
+        for name, attribute in vars(Calculation).items():
+            if isinstance(attribute, StoredResult):
+                getattr(self, name)
 
-        elif Path(subFile).is_file():
-            return 'submitted'
-
-        else:
-            return 'created'
+        self.resultStore = None
+        self.resultIndex = None
 
     def printNMR(self, **kwargs):
         element = kwargs.get('element', None)
@@ -1166,7 +1558,7 @@ class Calculation:
             s = next(sttng for sttng in s if sttng is not None)
 
         else:
-            s, = getSettings(setting, settings=self.settings)
+            s = getSettings(setting, settings=self.settings)
 
             if s is None:
                 raise ValueError(f'Cannot find setting {setting} to rotate')
@@ -1307,6 +1699,44 @@ class Calculation:
             with open(queueFile, 'a') as f:
                 f.write(f'{self.name}  {directory.resolve()}\n')
 
+    def linkResults(self, directory=None, name=None, test=False):
+        """ This function symlinks the output files of an identical calculation
+            that has already completed into the directory of this calculation """
+
+        assert isinstance(directory, str)
+        assert isinstance(name, str)
+        assert isinstance(test, bool)
+
+        if self.directory is None:
+            raise ValueError('Cannot link results when there is no directory specified')
+
+        self.setName(strict=True)
+
+        if not Path(directory).is_dir():
+            raise NotADirectoryError(f'Cannot find directory {directory} to link results from')
+
+        Path(self.directory).mkdir(parents=True, exist_ok=True)
+
+        for file_ in sorted(Path(directory).iterdir()):
+            # Only want the outputs e.g. .castep, .magres, -out.cell and not the inputs or sub file.
+            if not file_.name.startswith(name) or not file_.is_file():
+                continue
+
+            suffix = file_.name[len(name):]
+
+            if suffix[:1] not in ('.', '-') or suffix in ('.cell', '.param', '.sub'):
+                continue
+
+            link = Path(f'{self.directory}{self.name}{suffix}')
+
+            if link.exists():
+                continue
+
+            if test:
+                print(f'|-> {link} <-| will be linked to {file_.resolve()}')
+            else:
+                link.symlink_to(file_.resolve())
+
     def setName(self, strict=False):
         assert isinstance(strict, bool)
 
@@ -1345,8 +1775,54 @@ class Calculation:
 
             self.settings = [setting for setting in self.settings if setting.key != settingToDeleteKey]
 
+    def getProfile(self):
+        """ This function gets the profile of the calculation as a dictionary of
+            arrays (see getProfile in results). If castep wrote separate profile
+            files then the first one (that of the root node) is read, otherwise
+            the profile is read from the last run in the castep file. """
+
+        self.setName(strict=True)
+
+        assert self.directory is not None, 'Calculation does not have a directory to find profile in'
+
+        profileFiles = sorted(filter(set(stripCompression(file_=f) for f in listDirectory(directory=self.directory)), f'{self.name}*.profile'))
+
+        if profileFiles:
+            lines = getFileLines(file_=f'{self.directory}{profileFiles[0]}')
+
+        else:
+            lines = getRunLines(file_=f'{self.directory}{self.name}.castep')
+
+        return getProfile(lines=lines)
+
+    def getSCF(self):
+        """ This function gets every SCF cycle of the last run of the
+            calculation as a dictionary of arrays (see getSCF in results) """
+
+        self.setName(strict=True)
+
+        assert self.directory is not None, 'Calculation does not have a directory to find castep file in'
+
+        lines = getRunLines(file_=f'{self.directory}{self.name}.castep')
+
+        return getSCF(lines=lines)
+
+    def getDensity(self, cache=False):
+        """ This function reads the formatted density of the calculation,
+            written when write_formatted_density is on. Densities can be
+            large so are not kept with the calculation; with cache the grid
+            is saved as a .npy beside the .den_fmt file, so that reading it
+            again is just memory mapping (see readDensity in results). """
+
+        assert isinstance(cache, bool)
+
+        self.setName(strict=True)
+
+        assert self.directory is not None, 'Calculation does not have a directory to find density in'
+
+        return readDensity(file_=f'{self.directory}{self.name}.den_fmt', cache=cache)
+
     def addProf(self, *args, **kwargs):
-        # TODO: profiling
         full = kwargs.get('full', False)
 
         assert isinstance(full, bool)
@@ -1366,3 +1842,71 @@ class Calculation:
 
             if 'PROF: * :ENDPROF' not in develCode.lines:
                 develCode.lines.append('PROF: * :ENDPROF')
+
+
+class SummedResult:
+    """ A result of a density group, the sum of those of its x, y and z
+        calculations, which is only worked out when first accessed """
+
+    def __init__(self):
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+
+        value = sumTensors(*(getattr(member, self.name) for member in instance.members))
+
+        # Now it is an instance attribute we won't come back here.
+        instance.__dict__[self.name] = value
+
+        return value
+
+
+class DensityGroup(Calculation):
+    """ The x, y and z density calculations of a group combined into one
+        calculation. Everything but the name, directory and hyperfine results
+        is shared with the x calculation rather than copied, and the summed
+        hyperfine results are only worked out when they are needed. """
+
+    hyperfineDipolarBareTensors = SummedResult()
+    hyperfineDipolarAugTensors = SummedResult()
+    hyperfineDipolarAug2Tensors = SummedResult()
+    hyperfineDipolarTensors = SummedResult()
+    hyperfineFermiTensors = SummedResult()
+    hyperfineZFCTensors = SummedResult()
+    hyperfineTotalTensors = SummedResult()
+
+    def __init__(self, cX=None, cY=None, cZ=None):
+        assert all(isinstance(c, Calculation) for c in (cX, cY, cZ))
+
+        summed = {name for name, attribute in vars(DensityGroup).items() if isinstance(attribute, SummedResult)}
+
+        # Share the x calculation's attributes, apart from any hyperfine results it has already read in.
+        self.__dict__.update({key: value for key, value in vars(cX).items() if key not in summed})
+
+        self.members = (cX, cY, cZ)
+
+        name = cX.name
+
+        if cX.name == cY.name == cZ.name:
+            pass
+        else:
+            if cX.name is not None:
+                name = f'x:{cX.name} '
+
+            if cY.name is not None:
+                name += f'y:{cY.name} '
+
+            if cZ.name is not None:
+                name += f'z:{cZ.name} '
+
+        if name is not None:
+            name = name.strip()
+
+        self.name = name
+
+        self.directory = f'{cX.directory[:-2]}xyz/'
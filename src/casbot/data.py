@@ -1,6 +1,16 @@
+from bz2 import open as bz2Open
 from collections import Counter
-from numpy import array, empty
+from datetime import datetime
+from gzip import open as gzipOpen
+from io import TextIOWrapper
+from json import dump as jsonDump, load as jsonLoad
+from lzma import open as lzmaOpen
+from numpy import array, empty, nan, ndarray
+from os import listdir
+from os.path import isfile
 from pathlib import Path
+from re import compile as regexCompile, IGNORECASE, MULTILINE
+from zipfile import ZipFile
 
 
 # Variables for running calculations.
@@ -174,14 +184,85 @@ bohrebyhartree = 1.0
 pmbyvolt       = picometre / electronvolt
 
 
-'''
-unitConversions = {'ang': {'ang': 1.0, 'bohr': bohr / angstrom},
-                   'bohr': {'ang': angstrom / bohr, 'bohr': 1.0},
+# Size of each unit in atomic units, by every name it can be converted from or to:
+# the names of the constants above (in lower case) and the names castep uses.
+unitSizes = {# ! Lengths.
+             'bohr': bohr, 'metre': metre, 'centimetre': centimetre, 'nanometre': nanometre,
+             'angstrom': angstrom, 'picometre': picometre,
 
-                   'amfd': {'amfd': 1.0, 'tesla': tesla / amfd},
-                   'tesla': {'amfd': amfd / tesla, 'tesla': 1.0}
-                   }
-'''
+             # ! Masses.
+             'emass': eMass, 'amu': amu, 'kg': kg, 'gram': gram,
+
+             # ! Times.
+             'aut': aut, 'second': second, 'millisecond': millisecond, 'microsecond': microsecond,
+             'nanosecond': nanosecond, 'picosecond': picosecond, 'femtosecond': femtosecond,
+
+             # ! Charges.
+             'echarge': eCharge, 'coulomb': coulomb,
+
+             # ! Electric dipole moments.
+             'debye': debye,
+
+             # ! Spins.
+             'espin': eSpin, 'hbar': hbar,
+
+             # ! Magnetic dipole moments.
+             'magneton': magneton,
+
+             # ! Energies.
+             'hartree': hartree, 'millihartree': millihartree, 'electronvolt': electronvolt,
+             'millielectronvolt': millielectronvolt, 'rydberg': rydberg, 'millirydberg': millirydberg,
+             'joule': joule, 'erg': erg, 'kilojoulepermole': kilojoulepermole, 'kilocalpermole': kilocalpermole,
+             'hertz': hertz, 'megahertz': megahertz, 'gigahertz': gigahertz, 'terahertz': terahertz,
+             'wavenumber': wavenumber, 'kelvin': kelvin,
+
+             # ! Entropy.
+             'joulebymolebykelvin': joulebymolebykelvin, 'caloriebymolebykelvin': caloriebymolebykelvin,
+
+             # ! Forces.
+             'hartreebybohr': hartreebybohr, 'evbyang': eVbyang, 'newton': newton, 'dyne': dyne,
+
+             # ! Velocities.
+             'auv': auv, 'angperps': angperps, 'angperfs': angperfs, 'bohrperps': bohrperps,
+             'bohrperfs': bohrperfs, 'metrepersecond': metrepersecond,
+
+             # ! Pressures.
+             'hartreebybohr3': hartreebybohr3, 'evbyang3': evbyang3, 'pascal': pascal, 'megapascal': megapascal,
+             'gigapascal': gigapascal, 'terapascal': terapascal, 'petapascal': petapascal,
+             'atmosphere': atmosphere, 'bar': bar, 'megabar': megabar,
+
+             # ! Reciprocal length.
+             'invbohr': invbohr, 'invmetre': invmetre, 'invnanometre': invnanometre,
+             'invangstrom': invangstrom, 'invpicometre': invpicometre,
+
+             # ! Force constants.
+             'hartreebybohr2': hartreebybohr2, 'evbyang2': evbyang2, 'newtonbymetre': newtonbymetre,
+             'dynebycentimetre': dynebycentimetre,
+
+             # ! Volumes.
+             'bohr3': bohr3, 'metre3': metre3, 'centimetre3': centimetre3, 'nanometre3': nanometre3,
+             'angstrom3': angstrom3, 'picometre3': picometre3,
+
+             # ! Magnetic resonance.
+             'acu': acu, 'ampere': ampere, 'acd': acd, 'amperemetre2': amperemetre2, 'amfd': amfd,
+             'tesla': tesla, 'gauss': gauss, 'agr': agr, 'radsectesla': radsectesla, 'mhztesla': mhztesla,
+             'bohr2': bohr2, 'fm2': fm2, 'barn': barn,
+
+             # ! IR intensities.
+             'e2byamu': e2byamu, 'd2byamuang2': d2byamuang2, 'kmbymol': kmbymol,
+
+             # ! Electric field.
+             'hartreebybohrbye': hartreebybohrbye, 'evbyangbye': eVbyangbye, 'newtonbycoulomb': newtonbycoulomb,
+
+             # ! NLO Susceptibility  (1 / Efield).
+             'bohrebyhartree': bohrebyhartree, 'pmbyvolt': pmbyvolt,
+
+             # Castep names.
+             'ang': angstrom, 'ev': electronvolt, 'ha': hartree, 'j': joule, 'ry': rydberg, 'mhz': megahertz,
+             'ev/ang': eVbyang, '1/ang': invangstrom, 'hbar/2': eSpin}
+
+# Conversions worked out so far, by (from unit, to unit).
+unitConversions = {}
 
 
 # Periodic table of elements.
@@ -197,6 +278,9 @@ elements = ['h' ,
             'ac', 'th', 'pa', 'u' , 'np', 'pu', 'am', 'cm', 'bk', 'cf', 'es', 'fm', 'md', 'no', 'lr',
             'rf', 'db', 'sg', 'bh', 'hs', 'mt', 'ds', 'rg', 'cn', 'nh', 'fl', 'mc', 'lv', 'ts', 'og' ]
 
+# Nicely capitalised elements in the same order, so an element can be stored as its index in elements.
+niceElements = [element[:1].upper() + element[1:] for element in elements]
+
 
 def getElement(element=''):
     if element is None:
@@ -424,50 +508,386 @@ def getAllowedUnits(unitType=None, strict=True):
     return getFromDict(key=unitType, dct=unitTypeToUnit, strict=strict)
 
 
-def getFileLines(file_=None):
+# Compressed files are read through these in place of open.
+compressionOpeners = {'.gz': gzipOpen,
+                      '.bz2': bz2Open,
+                      '.xz': lzmaOpen}
+
+
+def stripCompression(file_=None):
+    """ This function removes the compression extension (if any) from a file name """
+
     assert isinstance(file_, str)
 
-    assert Path(file_).is_file(), f'Cannot find file {file_}'
+    for extension in compressionOpeners:
+        if file_.endswith(extension):
+            return file_[:-len(extension)]
 
-    with open(file_) as f:
+    return file_
+
+
+# Each zip archive of calculations read (see Model.archive), with its modification time and size when opened,
+# the open archive, its file names and the names in each of its directories.
+archives = {}
+
+
+def getArchive(archiveFile=None):
+    """ This function opens a zip archive of calculations, or gets it if it is
+        already open and hasn't changed. The archive's own index of where each
+        file is means any one can be read without going through the rest. """
+
+    stat = Path(archiveFile).stat()
+
+    cached = archives.get(archiveFile, None)
+
+    if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        return cached[2:]
+
+    if cached is not None:
+        cached[2].close()
+
+    archive = ZipFile(archiveFile)
+
+    members = set(archive.namelist())
+    directories = {}
+
+    for member in members:
+        parts = member.split('/')
+
+        # The directories above each file are in the archive too.
+        for num in range(len(parts)):
+            directories.setdefault('/'.join(parts[:num]), set()).add(parts[num])
+
+    directories = {directory: sorted(names) for directory, names in directories.items()}
+
+    archives[archiveFile] = (stat.st_mtime_ns, stat.st_size, archive, members, directories)
+
+    return archive, members, directories
+
+
+def splitArchivePath(path=None):
+    """ This function splits a path inside a zip archive, e.g. proj.zip/001/H.castep,
+        into the archive and the path within it. Returns None, None if the path is
+        not in an archive. """
+
+    parts = path.split('/')
+
+    for num, part in enumerate(parts):
+        if part.endswith('.zip'):
+            archiveFile = '/'.join(parts[:num+1])
+
+            if Path(archiveFile).is_file():
+                return archiveFile, '/'.join(p for p in parts[num+1:] if p and p != '.')
+
+    return None, None
+
+
+def isDirectory(directory=None):
+    """ This function checks for a directory, which can be one in a zip archive """
+
+    assert isinstance(directory, str)
+
+    if Path(directory).is_dir():
+        return True
+
+    archiveFile, inside = splitArchivePath(path=directory)
+
+    return archiveFile is not None and inside in getArchive(archiveFile=archiveFile)[2]
+
+
+def listDirectory(directory=None):
+    """ This function lists the names in a directory, which can be one in a zip archive """
+
+    assert isinstance(directory, str)
+
+    if Path(directory).is_dir():
+        return listdir(directory)
+
+    archiveFile, inside = splitArchivePath(path=directory)
+
+    assert archiveFile is not None, f'Cannot find directory {directory}'
+
+    names = getArchive(archiveFile=archiveFile)[2].get(inside, None)
+
+    assert names is not None, f'Cannot find directory {directory}'
+
+    return list(names)
+
+
+def locateFile(file_=None):
+    """ This function finds a file, or if it has been compressed (see
+        compressionOpeners) then the compressed file. The file can also be in
+        a zip archive. Returns the path found (None if the file isn't there)
+        along with the archive and the path within it if it is in one. """
+
+    assert isinstance(file_, str)
+
+    if isfile(file_):
+        return file_, None, None
+
+    for extension in compressionOpeners:
+        if isfile(f'{file_}{extension}'):
+            return f'{file_}{extension}', None, None
+
+    archiveFile, inside = splitArchivePath(path=file_)
+
+    if archiveFile is not None:
+        members = getArchive(archiveFile=archiveFile)[1]
+
+        for extension in ('',) + tuple(compressionOpeners):
+            if f'{inside}{extension}' in members:
+                return f'{file_}{extension}', archiveFile, f'{inside}{extension}'
+
+    return None, None, None
+
+
+def findFile(file_=None):
+    """ This function finds a file (see locateFile), returning None if it isn't there """
+
+    return locateFile(file_=file_)[0]
+
+
+def getFileStat(file_=None):
+    """ This function gets the modification time (in ns) and size of a file
+        found with findFile. Files in a zip archive have the archive's time. """
+
+    if isfile(file_):
+        stat = Path(file_).stat()
+
+        return stat.st_mtime_ns, stat.st_size
+
+    archiveFile, inside = splitArchivePath(path=file_)
+
+    return Path(archiveFile).stat().st_mtime_ns, getArchive(archiveFile=archiveFile)[0].getinfo(inside).file_size
+
+
+def openFile(file_=None, mode='r'):
+    """ This function opens a file for reading, or its compressed file if it
+        has been compressed. Compressed files are decompressed as they are
+        read rather than all at once. Files in a zip archive are read
+        straight from it. """
+
+    assert mode in ('r', 'rb'), 'Can only open files for reading'
+
+    found, archiveFile, inside = locateFile(file_=file_)
+
+    assert found is not None, f'Cannot find file {file_}'
+
+    opener = compressionOpeners.get(found[found.rfind('.'):], None)
+
+    if archiveFile is None:
+        stream = found
+
+        if opener is None:
+            return open(found, mode)
+
+    else:
+        stream = getArchive(archiveFile=archiveFile)[0].open(inside)
+
+        if opener is None:
+            return stream if mode == 'rb' else TextIOWrapper(stream)
+
+    return opener(stream, 'rt' if mode == 'r' else mode)
+
+
+def getFileLines(file_=None):
+    assert isinstance(file_, str)
+
+    with openFile(file_=file_) as f:
         lines = f.read().splitlines()
 
     return lines
 
 
-def unitConvert(value=None, fromUnit=None, toUnit=None):
-    assert isinstance(value, (int, float))
-    assert isinstance(fromUnit, str)
-    assert isinstance(toUnit, str)
+# Start and total time lines of castep runs, as found by Calculation.getFinalRunLines and getStatus.
+runPattern = regexCompile(rb'^[ \t]*run started:[ \t]*(?P<start>[^\r\n]*?)[ \t]*\r?$|'
+                          rb'^[ \t]*total time\S*[ \t]+=(?=\s|$)[ \t]*(?P<total>[^\s]*)', IGNORECASE | MULTILINE)
 
-    fromUnit = fromUnit.strip().lower()
-    toUnit = toUnit.strip().lower()
+runChunkSize = 1 << 24
+
+# Run index of each castep file read, with the modification time and size it was read at.
+runIndexes = {}
+
+
+def scanRuns(f=None, offset=0):
+    """ This function finds each run in an open castep file from offset,
+        returning the offset, start time and total time (NaN if the run
+        didn't finish) of each along with whether it completed. The file is
+        read in chunks of whole lines so it is never all in memory. """
+
+    runs = []
+
+    remainder = b''
 
-    '''
-    conversions = unitConversions.get(fromUnit, None)
+    while True:
+        chunk = f.read(runChunkSize)
 
-    if conversions is None:
-        raise ValueError(f'Do not know unit {fromUnit} to convert from')
+        finished = not chunk
 
-    conversion = conversions.get(toUnit, None)
+        chunk = remainder + chunk
+
+        # Any unfinished line is carried over to the next chunk.
+        if not finished:
+            end = chunk.rfind(b'\n') + 1
+            chunk, remainder = chunk[:end], chunk[end:]
+
+        for match in runPattern.finditer(chunk):
+            if match.group('start') is not None:
+                try:
+                    startTime = datetime.strptime(match.group('start').decode(), '%a, %d %b %Y %H:%M:%S %z').timestamp()
+                except ValueError:
+                    startTime = nan
+
+                runs.append([offset + match.start(), startTime, nan, False])
+
+            elif runs:
+                runs[-1][3] = True
+
+                try:
+                    runs[-1][2] = float(match.group('total').decode().rstrip('s'))
+                except ValueError:
+                    pass
+
+        offset += len(chunk)
+
+        if finished:
+            return runs
+
+
+def getRunIndex(file_=None):
+    """ This function gets an index of every run in a castep file, as there
+        is one for each time a calculation is continued or restarted. Returns
+        a dictionary of arrays of the byte offset of each run, its start time,
+        total time and end time as timestamps (NaN if not known) and whether
+        it completed. The index is kept until the file changes, and if the
+        file has only grown then only its last run is read again. """
+
+    assert isinstance(file_, str)
+
+    found = findFile(file_=file_)
+
+    assert found is not None, f'Cannot find file {file_}'
+
+    mtime, size = getFileStat(file_=found)
+
+    cached = runIndexes.get(found, None)
+
+    if cached is not None and cached[0] == mtime and cached[1] == size:
+        return cached[2]
+
+    with openFile(file_=found, mode='rb') as f:
+        runs = None
+
+        # If the file has only been added to (e.g. castep is still running) then the runs before the last one are the same.
+        if cached is not None and cached[3] and cached[1] <= size:
+            lastOffset = cached[3][-1][0]
+
+            f.seek(lastOffset)
+            lastRuns = scanRuns(f=f, offset=lastOffset)
+
+            if lastRuns and lastRuns[0][0] == lastOffset:
+                runs = cached[3][:-1] + lastRuns
+
+            else:
+                f.seek(0)
+
+        if runs is None:
+            runs = scanRuns(f=f)
+
+    times = array([run[1:3] for run in runs], dtype=float).reshape(len(runs), 2)
+
+    index = {'offset': array([run[0] for run in runs], dtype=int),
+             'start': times[:, 0],
+             'totalTime': times[:, 1],
+             'end': times[:, 0] + times[:, 1],
+             'completed': array([run[3] for run in runs], dtype=bool)}
+
+    runIndexes[found] = (mtime, size, index, runs)
+
+    return index
+
+
+def getRunLines(file_=None, run=-1):
+    """ This function reads the lines of one run of a castep file (by default
+        the last), going straight to it with the run index """
+
+    assert isinstance(run, int)
+
+    offsets = getRunIndex(file_=file_)['offset']
+
+    if len(offsets) == 0:
+        raise ValueError('Cannot find any run started line in lines')
+
+    run = range(len(offsets))[run]
+
+    with openFile(file_=file_, mode='rb') as f:
+        f.seek(offsets[run])
+
+        data = f.read() if run == len(offsets) - 1 else f.read(offsets[run+1] - offsets[run])
+
+    return data.decode().splitlines()
+
+
+def readFingerprints(file_=None):
+    assert isinstance(file_, str)
+
+    # No index yet is the same as an empty index.
+    if not Path(file_).is_file():
+        return {}
+
+    with open(file_) as f:
+        fingerprints = jsonLoad(f)
+
+    assert isinstance(fingerprints, dict), f'Fingerprint index {file_} not recognised'
+
+    return fingerprints
+
+
+def writeFingerprints(file_=None, fingerprints=None):
+    assert isinstance(file_, str)
+    assert isinstance(fingerprints, dict)
+
+    # Write to a temporary file first so that the index is never left half written.
+    tmpFile = f'{file_}.tmp'
+
+    with open(tmpFile, 'w') as f:
+        jsonDump(fingerprints, f, indent=1, sort_keys=True)
+
+    Path(tmpFile).replace(file_)
+
+
+def getUnitConversion(fromUnit=None, toUnit=None):
+    """ This function returns the number to divide a value in one unit by to
+        get it in another, working it out only the first time it is needed """
+
+    conversion = unitConversions.get((fromUnit, toUnit), None)
 
     if conversion is None:
-        raise ValueError(f'Do not know unit {toUnit} to convert to')
-    '''
+        if fromUnit not in unitSizes:
+            raise NameError(f'Do not know unit {fromUnit} to convert from')
 
-    try:
-        fromUnit = eval(fromUnit)
-    except NameError:
-        raise NameError(f'Do not know unit {fromUnit} to convert from')
+        if toUnit not in unitSizes:
+            raise NameError(f'Do not know unit {toUnit} to convert to')
 
-    try:
-        toUnit = eval(toUnit)
-    except NameError:
-        raise NameError(f'Do not know unit {toUnit} to convert to')
+        conversion = unitSizes[toUnit] / unitSizes[fromUnit]
 
-    conversion = toUnit / fromUnit
+        unitConversions[(fromUnit, toUnit)] = conversion
+
+    return conversion
+
+
+def unitConvert(value=None, fromUnit=None, toUnit=None):
+    """ This function converts a value, or a whole array of values in one go,
+        from one unit to another """
+
+    assert isinstance(value, (int, float, ndarray))
+    assert isinstance(fromUnit, str)
+    assert isinstance(toUnit, str)
+
+    fromUnit = fromUnit.strip().lower()
+    toUnit = toUnit.strip().lower()
 
-    return value / conversion
+    return value / getUnitConversion(fromUnit=fromUnit, toUnit=toUnit)
 
 
 # Dummy class to return True for any equals call.
@@ -0,0 +1,235 @@
+import casbot.calculation
+import casbot.data
+import casbot.results
+import casbot.settings
+
+from builtins import open as builtinOpen, print as builtinPrint
+from contextlib import contextmanager
+from os import listdir, scandir
+from os.path import isfile
+from pathlib import Path
+from sys import modules
+from threading import Lock
+from time import perf_counter
+
+
+# What is timed and counted: (label, owner, attribute) where the owner is a module (whose function is replaced
+# wherever it has been imported in the instrumented modules) or a class (whose method is replaced).
+instrumentedTargets = [('stat', Path, 'stat'),
+                       ('listdir', None, listdir),
+                       ('isfile', None, isfile),
+                       ('scandir', None, scandir),
+
+                       ('parse getResult', casbot.results, 'getResult'),
+                       ('parse readSettings', casbot.settings, 'readSettings'),
+                       ('parse parseSettings', casbot.settings, 'parseSettings'),
+                       ('parse strListToArray', casbot.data, 'strListToArray'),
+                       ('parse getFinalRunLines', casbot.calculation.Calculation, 'getFinalRunLines'),
+                       ('parse getRunIndex', casbot.data, 'getRunIndex'),
+
+                       ('construct Calculation', casbot.calculation.Calculation, '__init__'),
+                       ('construct Setting', casbot.settings.Setting, '__init__'),
+                       ('construct Result', casbot.results.Result, '__init__')]
+
+# Calls and seconds of each label, and the bytes (characters for text files) read.
+statsCalls = {}
+statsSeconds = {}
+statsBytes = {'file read': 0}
+
+statsLock = Lock()
+
+# Everything replaced while collecting, so it can be put back: (owner, attribute, original).
+replaced = []
+
+
+def record(label=None, seconds=0.0, calls=1, bytes_=None):
+    with statsLock:
+        statsCalls[label] = statsCalls.get(label, 0) + calls
+        statsSeconds[label] = statsSeconds.get(label, 0.0) + seconds
+
+        if bytes_ is not None:
+            statsBytes[label] = statsBytes.get(label, 0) + bytes_
+
+
+def timed(function=None, label=None):
+    """ This function wraps a function so that its calls are counted and timed """
+
+    def wrapper(*args, **kwargs):
+        start = perf_counter()
+
+        try:
+            return function(*args, **kwargs)
+        finally:
+            record(label=label, seconds=perf_counter() - start)
+
+    wrapper.__name__ = getattr(function, '__name__', label)
+    wrapper.__doc__ = getattr(function, '__doc__', None)
+
+    return wrapper
+
+
+class CountedFile:
+    """ A file opened for reading whose reads are counted and timed """
+
+    def __init__(self, f=None):
+        self.f = f
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.f.close()
+
+    def __iter__(self):
+        for line in self.f:
+            record(label='file read', calls=0, bytes_=len(line))
+            yield line
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+    def countRead(self, method=None, *args):
+        start = perf_counter()
+        data = getattr(self.f, method)(*args)
+        record(label='file read', seconds=perf_counter() - start, calls=0,
+               bytes_=sum(map(len, data)) if isinstance(data, list) else len(data))
+        return data
+
+    def read(self, *args):
+        return self.countRead('read', *args)
+
+    def readline(self, *args):
+        return self.countRead('readline', *args)
+
+    def readlines(self, *args):
+        return self.countRead('readlines', *args)
+
+
+def countedOpen(file=None, mode='r', *args, **kwargs):
+    if any(char in mode for char in 'wax+'):
+        return builtinOpen(file, mode, *args, **kwargs)
+
+    start = perf_counter()
+    f = builtinOpen(file, mode, *args, **kwargs)
+    record(label='file read', seconds=perf_counter() - start)
+
+    return CountedFile(f=f)
+
+
+def timedPrint(*args, **kwargs):
+    start = perf_counter()
+
+    try:
+        builtinPrint(*args, **kwargs)
+    finally:
+        record(label='print', seconds=perf_counter() - start)
+
+
+def replace(owner=None, attribute=None, new=None):
+    replaced.append((owner, attribute, owner.__dict__.get(attribute, None) if isinstance(owner, type) else getattr(owner, attribute, None)))
+    setattr(owner, attribute, new)
+
+
+def startStats():
+    """ This function starts counting and timing file reads, stat, isfile,
+        listdir and scandir calls, parsing, object construction and printing.
+        Nothing is changed until this is called, so when it isn't there is no
+        cost. """
+
+    if replaced:
+        return
+
+    # File reads and printing are counted in all of casbot.
+    instrumentedModules = [module for name, module in list(modules.items())
+                           if (name == 'casbot' or name.startswith('casbot.')) and module is not None and name != __name__]
+
+    for module in instrumentedModules:
+        replace(owner=module, attribute='open', new=countedOpen)
+        replace(owner=module, attribute='print', new=timedPrint)
+
+    for label, owner, attribute in instrumentedTargets:
+        if isinstance(owner, type):
+            original = owner.__dict__[attribute]
+
+            if isinstance(original, staticmethod):
+                replace(owner=owner, attribute=attribute, new=staticmethod(timed(function=original.__func__, label=label)))
+            else:
+                replace(owner=owner, attribute=attribute, new=timed(function=original, label=label))
+
+            continue
+
+        # Functions are replaced everywhere they have been imported to.
+        original = getattr(owner, attribute) if owner is not None else attribute
+        wrapper = timed(function=original, label=label)
+
+        for module in instrumentedModules:
+            for name, value in list(vars(module).items()):
+                if value is original:
+                    replace(owner=module, attribute=name, new=wrapper)
+
+
+def stopStats():
+    """ This function stops collecting statistics, putting everything back as it was """
+
+    while replaced:
+        owner, attribute, original = replaced.pop()
+
+        if original is None:
+            delattr(owner, attribute)
+        else:
+            setattr(owner, attribute, original)
+
+
+def resetStats():
+    with statsLock:
+        statsCalls.clear()
+        statsSeconds.clear()
+        statsBytes.clear()
+        statsBytes['file read'] = 0
+
+
+def getStats():
+    """ This function returns the statistics collected so far as a dictionary
+        of each label to its calls, total seconds and (for reads) bytes """
+
+    with statsLock:
+        return {label: {'calls': calls, 'seconds': statsSeconds[label], **({'bytes': statsBytes[label]} if label in statsBytes else {})}
+                for label, calls in sorted(statsCalls.items())}
+
+
+def printStats():
+    stats = getStats()
+
+    if not stats:
+        builtinPrint('*** No statistics collected - use startStats() or collectStats() first ***')
+        return
+
+    longestLabel = max(len(label) for label in stats)
+
+    builtinPrint(f'{"":<{longestLabel}}  {"calls":>10s}  {"seconds":>10s}  {"bytes":>12s}')
+
+    for label, stat in stats.items():
+        bytes_ = f'{stat["bytes"]:>12d}' if 'bytes' in stat else f'{"":>12s}'
+
+        builtinPrint(f'{label:<{longestLabel}}  {stat["calls"]:>10d}  {stat["seconds"]:>10.4f}  {bytes_}')
+
+
+@contextmanager
+def collectStats(reset=True):
+    """ Context manager to collect statistics of everything done inside it,
+        e.g. with collectStats(): model.check() followed by printStats() """
+
+    assert isinstance(reset, bool)
+
+    if reset:
+        resetStats()
+
+    alreadyStarted = bool(replaced)
+
+    startStats()
+
+    try:
+        yield
+    finally:
+        if not alreadyStarted:
+            stopStats()
@@ -4,6 +4,7 @@ from casbot.settings import Keyword, Block,\
     shortcutToCells, shortcutToCellsAliases, shortcutToParams, shortcutToParamsAliases,\
     stringToVariableSettings
 
+from collections import Counter
 from difflib import SequenceMatcher
 
 
@@ -86,55 +87,108 @@ def help(*args):
             print('')
 
 
-def search(key=None):
-    assert isinstance(key, str) and key, 'Enter a string to search for'
+# Built the first time something is searched for.
+searchIndex = None
 
-    def f(lst, title):
-        hits = []
+# Most names from each group to compare properly against the search.
+searchCandidates = 64
+
+
+def getTrigrams(string=None):
+    string = f' {string} '
+
+    return {string[i:i+3] for i in range(len(string) - 2)}
 
-        for var in lst:
-            ratio = SequenceMatcher(a=key, b=var).ratio()
 
-            if ratio == 1.0:
-                #help(key=key)
-                #return
+def getSearchIndex():
+    """ This function builds (once) the index of everything that can be
+        searched for: for each group, its names, which names have each
+        trigram (three characters in a row) in them and the characters of
+        each name """
 
-                #hits = [var]
-                #break
+    global searchIndex
 
-                hits.append(var)
+    if searchIndex is None:
+        groups = {'cells': list(cellKnown),
+                  'params': list(paramKnown),
+                  'shortcuts': (list(shortcutToCells) +
+                                list(shortcutToCellsAliases) +
+                                list(shortcutToParams) +
+                                list(shortcutToParamsAliases)),
+                  'variable settings': list(stringToVariableSettings)}
 
-            elif ratio >= 0.5:
-                hits.append(var)
+        searchIndex = {}
 
-        if len(hits) > 0:
-            print(f'{title}:')
+        for title, names in groups.items():
+            postings = {}
 
-            for h in hits:
-                print(f'  {h}')
+            for num, name in enumerate(names):
+                for trigram in getTrigrams(name):
+                    postings.setdefault(trigram, []).append(num)
 
-            return True
+            searchIndex[title] = (names, postings, [Counter(name) for name in names])
 
-        else:
-            return False
+    return searchIndex
+
+
+def search(key=None, verbose=True):
+    """ This function finds the cells, params, shortcuts and variable settings
+        similar to the key, ranked best first. The names sharing the most
+        trigrams with the key are compared with it properly. So that nothing
+        is missed, as with short keys whose trigrams are padded with spaces,
+        every other name is too unless its length or characters mean it
+        can't be similar enough. If not verbose then returns a dictionary of
+        each group to its list of (name, ratio) hits. """
+
+    assert isinstance(key, str) and key, 'Enter a string to search for'
+    assert isinstance(verbose, bool)
 
     key = key.strip().lower()
 
-    hit = f(lst=cellKnown, title='cells')
+    trigrams = getTrigrams(key)
+    characters = Counter(key)
+
+    results = {}
+
+    for title, (names, postings, nameCharacters) in getSearchIndex().items():
+        shared = Counter(num for trigram in trigrams for num in postings.get(trigram, ()))
+
+        candidates = {num for num, _ in shared.most_common(searchCandidates)}
+
+        hits = []
+
+        for num, name in enumerate(names):
+            # Upper bounds of the ratio (as real_quick_ratio and quick_ratio of SequenceMatcher) from the lengths and
+            # the characters in common, which are much quicker than the ratio itself.
+            if num not in candidates:
+                length = len(key) + len(name)
+
+                if 2 * min(len(key), len(name)) < 0.5 * length or 2 * sum((characters & nameCharacters[num]).values()) < 0.5 * length:
+                    continue
+
+            ratio = SequenceMatcher(a=key, b=name).ratio()
+
+            if ratio >= 0.5:
+                hits.append((name, ratio))
+
+        hits.sort(key=lambda hit: -hit[1])
+
+        results[title] = hits
 
-    if hit: print('')
+    if not verbose:
+        return results
 
-    hit = f(lst=paramKnown, title='params')
+    printed = False
 
-    if hit: print('')
+    for title, hits in results.items():
+        if not hits:
+            continue
 
-    hit = f(lst=(list(shortcutToCells) +
-                 list(shortcutToCellsAliases) +
-                 list(shortcutToParams) +
-                 list(shortcutToParamsAliases)), title='shortcuts')
+        if printed: print('')
 
-    if hit: print('')
+        print(f'{title}:')
 
-    hit = f(lst=list(stringToVariableSettings), title='variable settings')
+        for name, _ in hits:
+            print(f'  {name}')
 
-    if hit: pass
+        printed = True
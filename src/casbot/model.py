@@ -1,13 +1,24 @@
-from casbot.calculation import Calculation, groupDensityCalculations
+from casbot.calculation import Calculation, findCalculationDirectories, groupDensityCalculations, readCalculation
+from casbot.data import findFile, getFileStat, listDirectory, openFile, readFingerprints, stripCompression, writeFingerprints
+from casbot.instrument import collectStats, getStats, printStats, resetStats
+from casbot.registry import Registry, timeColumns
+from casbot.results import runSummaryQuantities
+from casbot.settings import Keyword
+from casbot.store import getTable, loadStore, saveStore, tableQuantities
 
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from matplotlib.pyplot import plot, scatter, show, xscale, xlabel, ylabel
-from numpy import ndarray
-from numpy.linalg import norm
+from numpy import absolute, argsort, asarray, bincount, concatenate, diff, flatnonzero, full, isnan, logical_and, median, nan,\
+    nan_to_num, nanmean, nanmedian, ndarray, unique, zeros
+from os.path import abspath, commonpath, relpath
 from pathlib import Path
-from pickle import dump as pickleDump, load as pickleLoad
+from shutil import copyfileobj
+from pickle import dump as pickleDump, dumps as pickleDumps, load as pickleLoad, loads as pickleLoads, UnpicklingError
 from random import sample
+from time import localtime, perf_counter
 from tqdm import tqdm
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
 
 
 class Model:
@@ -17,6 +28,12 @@ class Model:
 
         self.name = name
 
+        # The file this model was last saved to or loaded from, and digests of its calculations at that point.
+        self.checkpoint = None
+
+        # SQLite mirror of the calculations for querying, made when first needed.
+        self.registry = None
+
         self.calculations = []
 
         if calculations is not None:
@@ -39,6 +56,14 @@ class Model:
     def __len__(self):
         return len(self.calculations)
 
+    def __getstate__(self):
+        state = dict(self.__dict__)
+
+        # The registry connection can't be pickled, it is remade when next queried.
+        state['registry'] = None
+
+        return state
+
     def analyse(self, *toAnalyse, passive=False, reset=True):
         assert all(isinstance(type_, str) for type_ in toAnalyse)
         assert isinstance(passive, bool)
@@ -145,9 +170,10 @@ class Model:
         for c in self.calculations:
             c.expectedSecToFinish = None
 
-    def create(self, force=False, passive=False):
+    def create(self, force=False, passive=False, workers=1):
         assert isinstance(force, bool)
         assert isinstance(passive, bool)
+        assert isinstance(workers, int) and workers >= 1, 'Number of workers should be a positive integer'
 
         if force and passive:
             raise ValueError('Cannot create model with force=True and passive=True - use one option as True only')
@@ -161,8 +187,28 @@ class Model:
         if not force and not passive and any(Path(calculation.directory).exists() for calculation in self.calculations):
             raise FileExistsError('Some directories already exist - use force=True to overwrite or passive=True to ignore')
 
-        for calculation in self.calculations:
-            calculation.create(force=force, passive=passive)
+        start = perf_counter()
+
+        # Most settings are shared across a sweep, so only format each distinct setting once.
+        cache = {}
+
+        if workers == 1:
+            created = [calculation.create(force=force, passive=passive, cache=cache) for calculation in self.calculations]
+
+        else:
+            # Creating directories and writing files is dominated by filesystem latency rather than CPU,
+            # so threads let many calculations wait on the filesystem at once.
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                created = list(executor.map(lambda calculation: calculation.create(force=force, passive=passive, cache=cache),
+                                            self.calculations))
+
+        seconds = perf_counter() - start
+
+        # Calculations skipped as passive aren't counted.
+        numCreated = sum(created)
+
+        print(f'*** Created {numCreated} calculations in {seconds:.2f} s '
+              f'({numCreated / max(seconds, 1.0e-9):.1f} calculations/s) ***')
 
     def edit(self, parameter=None, **kwargs):  # def edit(self, parameter=None, *names, **kwargs):
         assert isinstance(parameter, str)
@@ -249,94 +295,85 @@ class Model:
         assert len(args) in (1, 2), 'Can only plot 2 dimensions for now'
         assert all(isinstance(kwarg, str) for kwarg in kwargs)
 
-        knownPlots = {'bfield', 'nmriso', 'fermiiso', 'fermiisobfield', 'kpointspacing'}
-
         args = [arg.strip().lower() for arg in args]
 
         # Don't set args to a set as it randomly changes the ordering and thus the ordering of the returned x and y values.
 
-        assert not set(args) - knownPlots, f'Do not know how to plot {", ".join(set(args) - knownPlots)}'
+        assert not set(args) - set(tableQuantities), f'Do not know how to plot {", ".join(set(args) - set(tableQuantities))}'
 
         assert isinstance(calculations, list)
         assert all(isinstance(c, Calculation) for c in calculations)
 
-        # Generalised in case n dimensions is needed.
-        values = []  # Values of each argument for each calculation.
-
         # Settings for specific argument.
         kwargs = {key.strip().lower(): val for key, val in kwargs.items()}
         element = kwargs.get('element', None)
         ion = kwargs.get('ion', None)
 
-        for c in calculations:
-            cValues = []  # Values of each argument for this specific calculation.
-
-            for arg in args:
-                cValue = None  # Value of argument for this specific calculation.
-
-                if arg == 'bfield':
-                    # Due to the groupDensityCalculations, the bfield will only pick up one component if density = True.
-                    cValue = norm(c.getSettingValue('external_bfield'))
-
-                elif arg in ['nmriso']:
-                    if not c.nmrTotalTensors:
-                        continue
-
-                    assert isinstance(element, str), 'Enter element to get NMR total tensor for'
-                    assert isinstance(ion, int), 'Enter ion to get NMR total tensor for'
+        table = getTable(*args, calculations=calculations, element=element, ion=ion)
 
-                    element = element.strip()
+        # If we didn't find something for a calculation then ignore this point.
+        found = logical_and.reduce([~isnan(table[arg]) for arg in args])
 
-                    assert element, 'Enter element to get NMR total tensor for'
+        return [table[arg][found] for arg in args]
 
-                    elementTensors = [tensor for tensor in c.nmrTotalTensors if tensor.element.strip().lower() == element.lower()]
+    def table(self, *quantities, mask=None, element=None, ion=None):
+        """ This function returns a dictionary of an array for each quantity
+            asked for (see tableQuantities), with one value for each calculation
+            or for each one picked by the boolean mask. Values a calculation
+            doesn't have are NaN. The iso quantities are for the ion'th tensor
+            of the element, e.g. table('bfield', 'nmriso', element='H', ion=1). """
 
-                    assert elementTensors, f'Cannot find any NMR total tensors corresponding to element {element}'
+        calculations = self.calculations
 
-                    assert len(elementTensors) >= ion, f'Ion requested for NMR total tensor does not exist, found {len(elementTensors)} tensors'
+        if mask is not None:
+            mask = asarray(mask, dtype=bool)
 
-                    cValue = elementTensors[ion-1].iso  # -1 because of Python indexing.
+            assert mask.shape == (len(calculations),), f'Mask should be of length {len(calculations)} not {mask.shape}'
 
-                elif arg in ['fermiiso', 'fermiisobfield']:
-                    if not c.hyperfineFermiTensors:
-                        continue
+            calculations = [calculations[num] for num in flatnonzero(mask)]
 
-                    assert isinstance(element, str), 'Enter element to get Fermi tensor for'
-                    assert isinstance(ion, int), 'Enter ion to get Fermi tensor for'
+        return getTable(*quantities, calculations=calculations, element=element, ion=ion)
 
-                    element = element.strip()
+    def runSummary(self, workers=1, verbose=True):
+        """ This function gets the run summary (see runSummaryQuantities) at
+            the end of every completed calculation, reading only the end of each
+            castep file. Returns a dictionary of the directories and names of the
+            completed calculations and an array of each quantity. """
 
-                    assert element, 'Enter element to get Fermi tensor for'
+        assert isinstance(workers, int) and workers > 0
+        assert isinstance(verbose, bool)
 
-                    elementTensors = [tensor for tensor in c.hyperfineFermiTensors if tensor.element.strip().lower() == element.lower()]
+        calculations = [c for c in self.calculations if c.getStatus() == 'completed']
 
-                    assert elementTensors, f'Cannot find any Fermi tensors corresponding to element {element}'
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                summaries = list(executor.map(lambda c: c.getRunSummary(), calculations))
 
-                    assert len(elementTensors) >= ion, f'Ion requested for Fermi tensor does not exist, found {len(elementTensors)} tensors'
-
-                    cValue = elementTensors[ion-1].iso  # -1 because of Python indexing.
+        else:
+            summaries = [c.getRunSummary() for c in calculations]
 
-                    # If fermiisobfield then we want the Fermi iso value divided by the bfield.
-                    if arg == 'fermiisobfield':
-                        cValue /= norm(c.getSettingValue('external_bfield'))
+        table = {'directory': [c.directory for c in calculations],
+                 'name': [c.name for c in calculations]}
 
-                elif arg == 'kpointspacing':
-                    cValue = c.getSettingValue('kpoint_mp_spacing')
+        for quantity in runSummaryQuantities:
+            table[quantity] = asarray([summary[quantity] for summary in summaries], dtype=float).reshape(len(summaries))
 
-                cValues.append(cValue)
+        if verbose:
+            if not calculations:
+                print('*** No calculations have completed ***')
+                return table
 
-            # If we didn't find something correctly then we will have a None value - so ignore this point.
-            # Also, if we ignored a calculation because there was no value to find then our calcValues will not be the same lengths as the number of arguments asked for.
-            if any(val is None for val in cValues) or len(cValues) != len(args):
-                continue
+            longestDir = max(len(f'{c.directory}{c.name}') for c in calculations)
 
-            # Concatenate new values onto current stack of values.
-            values.append(cValues)
+            print(f'{"calculation":<{longestDir}}  {"energy (eV)":>18s}  {"init (s)":>9s}  {"calc (s)":>10s}  {"final (s)":>9s}  '
+                  f'{"total (s)":>10s}  {"memory (MB)":>11s}  {"parallel":>8s}')
 
-        # Each calculation's values are stored in a tuple in the values list. Zip the list together to return the x, y, etc. axis values individually.
-        values = zip(*values)  # We won't lose anything through zipping because of the len(cValues) != len(args) check above.
+            for num, c in enumerate(calculations):
+                print(f'{c.directory + c.name:<{longestDir}}  {table["finalEnergy"][num]:>18.9f}  {table["initialisationTime"][num]:>9.2f}  '
+                      f'{table["calculationTime"][num]:>10.2f}  {table["finalisationTime"][num]:>9.2f}  {table["totalTime"][num]:>10.2f}  '
+                      f'{table["peakMemory"][num] / 1024.0:>11.1f}  {table["parallelEfficiency"][num]:>7.0f}%')
 
-        return values  #axisValues if len(axisValues) > 1 else axisValues[0]  # length can't be 0
+        return table
 
     def print(self, *args, **kwargs):
         if len(args) == 0:
@@ -394,7 +431,8 @@ class Model:
                 calculation.printHyperfine(**kwargs)
                 print('')
 
-    def run(self, test=False, force=False, passive=False, shuffle=False, serial=None, bashAliasesFile=None, notificationAlias=None):
+    def run(self, test=False, force=False, passive=False, shuffle=False, serial=None, bashAliasesFile=None, notificationAlias=None,
+            fingerprintFile=None, duplicates='skip'):
         assert isinstance(test, bool)
         assert isinstance(force, bool)
         assert isinstance(passive, bool)
@@ -409,11 +447,21 @@ class Model:
         if notificationAlias is not None:
             assert isinstance(notificationAlias, str)
 
+        if fingerprintFile is not None:
+            assert isinstance(fingerprintFile, str)
+
+        assert isinstance(duplicates, str)
+        assert duplicates.strip().lower() in ('skip', 'link'), 'Duplicates should be skipped (skip) or have their results linked (link)'
+
         calculations = [c for c in self.calculations if c.getStatus() not in ('completed', 'running', 'submitted')]
 
         if len(calculations) != len(self.calculations) and not passive:
             raise ValueError('Some calculations are complete, already running or submitted - use passive=True to skip them')
 
+        if fingerprintFile is not None:
+            calculations = self.removeDuplicates(calculations=calculations, fingerprintFile=fingerprintFile,
+                                                 duplicates=duplicates, test=test)
+
         if len(calculations) > 3 and not force:
             if test:
                 print('*** WARNING: this is a lot of calculations to run at once - use force=True to ignore on real run ***')
@@ -441,13 +489,20 @@ class Model:
         else:
             print(f'*** Ran {len(calculations)} calculations ***')
 
-    def sub(self, test=False, force=False, passive=False, shuffle=False, reverse=False, queueFile=None):
+    def sub(self, test=False, force=False, passive=False, shuffle=False, reverse=False, queueFile=None,
+            fingerprintFile=None, duplicates='skip'):
         assert isinstance(test, bool)
         assert isinstance(force, bool)
         assert isinstance(passive, bool)
         assert isinstance(shuffle, bool)
         assert isinstance(reverse, bool)
 
+        if fingerprintFile is not None:
+            assert isinstance(fingerprintFile, str)
+
+        assert isinstance(duplicates, str)
+        assert duplicates.strip().lower() in ('skip', 'link'), 'Duplicates should be skipped (skip) or have their results linked (link)'
+
         if not force:
             calculations = [c for c in self.calculations if c.getStatus() not in ('completed', 'running', 'submitted')]
 
@@ -462,6 +517,10 @@ class Model:
         if queueFile is not None:
             assert isinstance(queueFile, str)
 
+        if fingerprintFile is not None:
+            calculations = self.removeDuplicates(calculations=calculations, fingerprintFile=fingerprintFile,
+                                                 duplicates=duplicates, test=test)
+
         calculations = sample(calculations, k=len(calculations)) if shuffle else calculations
 
         if reverse:
@@ -477,29 +536,373 @@ class Model:
         else:
             print(f'*** Submitted {len(calculations)} calculations ***')
 
-    def save(self, file=None, overwrite=False):
+    def register(self, file=None, statuses=True, times=False):
+        """ This function mirrors the calculations into an SQLite registry (in
+            memory unless a file is given) so that they can be queried quickly.
+            Calling it again brings the registry up to date, only re-registering
+            calculations that have changed. Statuses and times have to be read
+            from the calculation directories so are refreshed when asked for. """
+
+        if getattr(self, 'registry', None) is None or (file is not None and self.registry.file != file):
+            self.registry = Registry(file=file)
+
+        start = perf_counter()
+
+        self.registry.update(calculations=self.calculations, statuses=statuses, times=times)
+
+        print(f'*** Registered {len(self.calculations)} calculations in {perf_counter() - start:.2f} s ***')
+
+    def query(self, refresh=False, **kwargs):
+        """ This function returns the calculations matching every keyword given,
+            e.g. query(status='completed', xcfunctional='PBE', element='H').
+            See Registry.query for what can be matched. The registry is made
+            the first time, and brought up to date if refresh or if times are
+            queried that haven't been read yet. """
+
+        assert isinstance(refresh, bool)
+
+        times = any(key in timeColumns for key in kwargs)
+
+        if refresh or getattr(self, 'registry', None) is None or (times and not self.registry.timesLoaded):
+            self.register(file=None if getattr(self, 'registry', None) is None else self.registry.file,
+                          times=times)
+
+        return [self.calculations[idx] for idx in self.registry.query(**kwargs)]
+
+    def updateFingerprints(self, file=None):
+        """ This function adds the fingerprints of all the completed calculations
+            to the fingerprint index, so that identical calculations in this or
+            other models can be skipped by sub and run """
+
+        assert isinstance(file, str)
+
+        fingerprints = readFingerprints(file_=file)
+
+        numAdded = 0
+
+        for calculation in self.calculations:
+            if calculation.getStatus() != 'completed':
+                continue
+
+            calculation.setName(strict=True)
+
+            fingerprint = calculation.getFingerprint()
+
+            # Keep the first calculation that completed with these settings.
+            if fingerprint in fingerprints:
+                continue
+
+            fingerprints[fingerprint] = {'directory': f'{Path(calculation.directory).resolve()}/',
+                                         'name': calculation.name}
+
+            numAdded += 1
+
+        writeFingerprints(file_=file, fingerprints=fingerprints)
+
+        print(f'Added {numAdded} completed calculations to fingerprint index {file} ({len(fingerprints)} in total)')
+
+    def removeDuplicates(self, calculations=None, fingerprintFile=None, duplicates='skip', test=False):
+        """ This function finds any of the calculations that have identical settings to a
+            completed calculation in the fingerprint index. These are either skipped or
+            have the results of the completed calculation linked into their directory.
+            The remaining calculations that still need doing are returned. """
+
+        assert isinstance(calculations, list)
+        assert all(isinstance(c, Calculation) for c in calculations)
+        assert isinstance(fingerprintFile, str)
+        assert isinstance(duplicates, str)
+        assert isinstance(test, bool)
+
+        duplicates = duplicates.strip().lower()
+
+        assert duplicates in ('skip', 'link'), 'Duplicates should be skipped (skip) or have their results linked (link)'
+
+        fingerprints = readFingerprints(file_=fingerprintFile)
+
+        if not fingerprints:
+            return calculations
+
+        remaining = []
+        numDuplicates = 0
+
+        for calculation in calculations:
+            calculation.setName(strict=False)
+
+            found = fingerprints.get(calculation.getFingerprint(), None)
+
+            # Make sure the completed calculation is still there and isn't this calculation.
+            if found is None or calculation.directory is None \
+                    or findFile(file_=f'{found["directory"]}{found["name"]}.castep') is None \
+                    or Path(found['directory']).resolve() == Path(calculation.directory).resolve():
+                remaining.append(calculation)
+                continue
+
+            numDuplicates += 1
+
+            if duplicates == 'link':
+                calculation.linkResults(directory=found['directory'], name=found['name'], test=test)
+            else:
+                print(f'*** Skipping {calculation.directory} as identical calculation completed in {found["directory"]} ***')
+
+        if numDuplicates:
+            print(f'*** Found {numDuplicates} calculations already completed elsewhere - '
+                  f'{"linked" if duplicates == "link" else "skipped"} ***')
+
+        return remaining
+
+    def save(self, file=None, overwrite=False, columnar=False, journal=False):
         assert isinstance(file, str)
         assert isinstance(overwrite, bool)
+        assert isinstance(columnar, bool)
+        assert isinstance(journal, bool)
 
-        assert not Path(file).is_file() or overwrite, f'File {file} exists - use overwrite=True to overwrite'
+        assert not (columnar and journal), 'Cannot journal columnar models'
 
-        with open(file, 'wb') as f:
-            pickleDump(self, f)
+        # If this model was last saved to or loaded from this file then only what has changed needs writing.
+        checkpoint = getattr(self, 'checkpoint', None)  # Models pickled before journalling have no checkpoint.
+
+        if journal and checkpoint is not None and checkpoint['file'] == file and Path(file).is_file():
+            written = self.appendJournal(file=file)
+
+            print(f'Model with {len(self.calculations)} calculations saved to {file} successfully '
+                  f'({written} calculations written to journal)')
+
+            return
+
+        assert not Path(file).exists() or overwrite, f'File {file} exists - use overwrite=True to overwrite'
+
+        if columnar:
+            # A directory of one table of calculations and stacked result arrays, which can be loaded lazily.
+            saveStore(model=self, directory=file)
+
+        else:
+            self.writeSnapshot(file=file)
 
         print(f'Model with {len(self.calculations)} calculations saved to {file} successfully')
 
     @staticmethod
-    def load(file=None):
+    def load(file=None, lazy=False):
         assert isinstance(file, str)
-        assert Path(file).is_file(), f'Cannot find file {file}'
+        assert isinstance(lazy, bool)
+        assert Path(file).exists(), f'Cannot find file {file}'
+
+        # Columnar models are saved as directories.
+        if Path(file).is_dir():
+            calculations, name = loadStore(directory=file, lazy=lazy)
 
-        with open(file, 'rb') as f:
-            model = pickleLoad(f)
+            model = Model(calculations=calculations, name=name)
+
+        else:
+            assert not lazy, 'Can only load columnar models lazily'
+
+            with open(file, 'rb') as f:
+                model = pickleLoad(f)
+
+            # Models pickled before journalling have no checkpoint.
+            if getattr(model, 'checkpoint', None) is not None:
+                model.checkpoint['file'] = file
+                model.replayJournal(file=file)
 
         print(f'Model with {len(model.calculations)} calculations loaded successfully')
 
         return model
 
+    def compact(self, file=None):
+        """ This function folds the journal back into the snapshot, so that
+            the file holds the whole model again and the journal is removed.
+            The model is written as it is now, so it should have been loaded
+            from (or saved to) the file first. """
+
+        if file is None:
+            assert getattr(self, 'checkpoint', None) is not None, 'Model has not been saved - enter a file to compact into'
+            file = self.checkpoint['file']
+
+        assert isinstance(file, str)
+
+        self.writeSnapshot(file=file)
+
+        print(f'Model with {len(self.calculations)} calculations compacted into {file} successfully')
+
+    def archive(self, file=None, overwrite=False, remove=False):
+        """ This function packs every file of the completed calculations (those
+            of their seed, e.g. .cell, .castep, .bands, -out.cell) into one zip
+            archive, so that a project is one file rather than thousands. The
+            directories are stored relative to the one they are all in, and
+            each calculation then points to its directory in the archive (e.g.
+            project.zip/001/), which can be given to processCalculations, and
+            its files are read straight from the archive. Compressed files are
+            stored decompressed. If remove then the archived files are deleted
+            from their directories. """
+
+        assert isinstance(file, str)
+        assert isinstance(overwrite, bool)
+        assert isinstance(remove, bool)
+
+        assert file.endswith('.zip'), 'Archive should be a .zip file'
+        assert not Path(file).exists() or overwrite, f'File {file} exists - use overwrite=True to overwrite'
+
+        calculations = [c for c in self.calculations if c.getStatus() == 'completed']
+
+        if not calculations:
+            print('*** No completed calculations to archive ***')
+            return
+
+        archived = []
+        members = set()
+
+        # Directories in the archive are relative to the one containing all of them.
+        root = commonpath([abspath(f'{c.directory}..') for c in calculations])
+
+        insides = [Path(relpath(abspath(c.directory), root)).as_posix() for c in calculations]
+
+        # Write to a temporary file first so a failed archive doesn't lose an old one.
+        tmpFile = Path(f'{file}.tmp')
+
+        with ZipFile(tmpFile, 'w', compression=ZIP_DEFLATED) as archive:
+            for c, inside in zip(calculations, insides):
+                for name in sorted(listDirectory(directory=c.directory)):
+                    uncompressed = stripCompression(file_=name)
+
+                    # Only the files of this calculation's seed, as calculations can share a directory.
+                    if not uncompressed.startswith(c.name) or uncompressed[len(c.name):][:1] not in ('.', '-') \
+                            or f'{inside}/{uncompressed}' in members:
+                        continue
+
+                    members.add(f'{inside}/{uncompressed}')
+
+                    info = ZipInfo(f'{inside}/{uncompressed}', date_time=localtime(getFileStat(file_=f'{c.directory}{name}')[0] / 1e9)[:6])
+                    info.compress_type = ZIP_DEFLATED
+
+                    with openFile(file_=f'{c.directory}{name}', mode='rb') as source, archive.open(info, 'w') as destination:
+                        copyfileobj(source, destination)
+
+                    archived.append(Path(f'{c.directory}{name}'))
+
+        tmpFile.replace(file)
+
+        for c, inside in zip(calculations, insides):
+            c.directory = f'{file}/{inside}/'
+
+        if remove:
+            for archivedFile in archived:
+                if archivedFile.is_file():
+                    archivedFile.unlink()
+
+        print(f'{len(calculations)} completed calculations archived to {file} successfully ({len(archived)} files)')
+
+    def writeSnapshot(self, file=None):
+        """ This function pickles the whole model to the file, along with a
+            digest of each calculation so that later saves can tell which have
+            changed, and removes any journal that went with the file """
+
+        self.checkpoint = {'file': file,
+                           'digests': [c.getDigest() for c in self.calculations]}
+
+        # Write to a temporary file first so a failed save doesn't lose the old snapshot.
+        tmpFile = Path(f'{file}.tmp')
+
+        with open(tmpFile, 'wb') as f:
+            pickleDump(self, f)
+
+        tmpFile.replace(file)
+
+        Path(f'{file}.journal').unlink(missing_ok=True)
+
+    def appendJournal(self, file=None):
+        """ This function appends the calculations that have been added or
+            changed since the last checkpoint to the journal of the file.
+            Returns the number of calculations written. """
+
+        digests = self.checkpoint['digests']
+
+        newDigests = []
+        changed = {}
+
+        for num, calculation in enumerate(self.calculations):
+            digest = calculation.getDigest()
+
+            if num >= len(digests) or digest != digests[num]:
+                changed[num] = (digest, pickleDumps(calculation))
+
+            newDigests.append(digest)
+
+        if not changed and len(newDigests) == len(digests):
+            return 0
+
+        record = {'name': self.name,
+                  'length': len(self.calculations),
+                  'calculations': changed}
+
+        with open(f'{file}.journal', 'ab') as f:
+            pickleDump(record, f)
+
+        self.checkpoint['digests'] = newDigests
+
+        return len(changed)
+
+    def replayJournal(self, file=None):
+        journalFile = Path(f'{file}.journal')
+
+        if not journalFile.is_file():
+            return
+
+        digests = self.checkpoint['digests']
+
+        with open(journalFile, 'rb') as f:
+            while True:
+                try:
+                    record = pickleLoad(f)
+
+                except EOFError:
+                    break
+
+                except UnpicklingError:
+                    print(f'*** Ignoring incomplete record at end of journal {journalFile} ***')
+                    break
+
+                length = record['length']
+
+                del self.calculations[length:]
+                del digests[length:]
+
+                # Calculations added since the snapshot are always in the record, so come in order.
+                for num, (digest, data) in sorted(record['calculations'].items()):
+                    calculation = pickleLoads(data)
+
+                    if num < len(self.calculations):
+                        self.calculations[num] = calculation
+                        digests[num] = digest
+                    else:
+                        self.calculations.append(calculation)
+                        digests.append(digest)
+
+                self.name = record['name']
+
+        self.species = self.getSpecies(calculations=self.calculations, strict=False)
+
+    @staticmethod
+    def stats(reset=False):
+        """ This function prints and returns the statistics collected so far of
+            file reads, stat, isfile, listdir and scandir calls, parsing,
+            object construction and printing. They are only collected while inside Model.collectStats()
+            (or between startStats() and stopStats()), e.g.
+                with model.collectStats():
+                    model.check()
+                model.stats() """
+
+        assert isinstance(reset, bool)
+
+        stats = getStats()
+
+        printStats()
+
+        if reset:
+            resetStats()
+
+        return stats
+
+    collectStats = staticmethod(collectStats)
+
     def updateSettings(self, *settings):
         for calculation in self.calculations:
             calculation.updateSettings(*settings)
@@ -509,6 +912,209 @@ class Model:
             calculation.removeSettings(*settingsToDeleteKeys)
 
     def addProf(self, *args, **kwargs):
-        # TODO: profiling
         for calculation in self.calculations:
             calculation.addProf(*args, **kwargs)
+
+    @staticmethod
+    def getGroupLabels(calculations=None, by=None):
+        """ This function labels each calculation by its values of the keywords
+            in by, so that calculations with the same settings can be grouped.
+            If by is not given then the keywords that differ between the
+            calculations are used. """
+
+        assert isinstance(calculations, list)
+
+        keywords = [{s.key: str(s.value) for s in c.settings if isinstance(s, Keyword)} for c in calculations]
+
+        if by is None:
+            allKeys = sorted(set(key for k in keywords for key in k))
+            by = [key for key in allKeys if len(set(k.get(key, None) for k in keywords)) > 1]
+
+        else:
+            assert isinstance(by, (list, tuple))
+            assert all(isinstance(key, str) for key in by)
+
+            by = [key.strip().lower() for key in by]
+
+        return [', '.join(f'{key}={k.get(key, None)}' for key in by) or 'all' for k in keywords]
+
+    def profileReport(self, by=None, top=10):
+        """ This function adds up the profiles of the completed calculations
+            (run with addProf) in groups of calculations with the same values
+            of the keywords in by, and prints the top subroutines of each group
+            ranked by self time (or total time if castep didn't write self
+            times). If by is not given then the calculations are grouped by the
+            keywords that differ between them. Returns a dictionary of each
+            group to arrays of its ranked subroutines, calls and times. """
+
+        assert isinstance(top, int) and top > 0
+
+        calculations = [c for c in self.calculations if c.getStatus() == 'completed']
+
+        assert calculations, 'No calculations have completed'
+
+        groups = {}
+
+        for c, label in zip(calculations, self.getGroupLabels(calculations=calculations, by=by)):
+            profile = c.getProfile()
+
+            if len(profile['names']) == 0:
+                continue
+
+            groups.setdefault(label, []).append(profile)
+
+        if not groups:
+            print('*** No profiles found - use addProf before running calculations ***')
+            return {}
+
+        report = {}
+
+        for label, profiles in sorted(groups.items()):
+            names, inverse = unique(concatenate([p['names'] for p in profiles]), return_inverse=True)
+
+            selfTimes = concatenate([p['self'] for p in profiles])
+            haveSelf = not isnan(selfTimes).all()
+
+            calls = bincount(inverse, weights=concatenate([p['calls'] for p in profiles]), minlength=len(names)).astype(int)
+            total = bincount(inverse, weights=concatenate([p['total'] for p in profiles]), minlength=len(names))
+            selfTotal = bincount(inverse, weights=nan_to_num(selfTimes), minlength=len(names))
+
+            order = argsort(-(selfTotal if haveSelf else total), kind='stable')[:top]
+
+            report[label] = {'calculations': len(profiles),
+                             'names': names[order],
+                             'calls': calls[order],
+                             'total': total[order],
+                             'self': selfTotal[order] if haveSelf else full(len(order), nan)}
+
+            ranked = selfTotal if haveSelf else total
+            allTime = ranked.sum()
+
+            print(f'*** {label} ({len(profiles)} calculation{"" if len(profiles) == 1 else "s"}) ***')
+
+            longestName = max(len(name) for name in names[order])
+
+            print(f'      {"subroutine":<{longestName}}  {"calls":>10s}  {"self (s)":>10s}  {"total (s)":>10s}  {"share":>7s}')
+
+            for rank, num in enumerate(order, 1):
+                share = 100.0 * ranked[num] / allTime if allTime else 0.0
+
+                selfString = f'{selfTotal[num]:>10.2f}' if haveSelf else f'{"-":>10s}'
+
+                print(f'  {rank:>2d}  {names[num]:<{longestName}}  {calls[num]:>10d}  {selfString}  {total[num]:>10.2f}  {share:>6.1f}%')
+
+            print('')
+
+        return report
+
+    def scfDiagnostics(self, by=None, threshold=3.5):
+        """ This function finds the completed calculations whose SCF runs take
+            unusually many cycles, or whose cycles take unusually long, compared
+            to the other calculations with the same values of the keywords in by
+            (by default the keywords that differ between them). A calculation is
+            flagged when the robust z-score (from the median and median absolute
+            deviation of its group) of its mean cycles per SCF run or median
+            cycle time is above the threshold. Returns a dictionary of each group
+            to the calculations in it and their arrays. """
+
+        assert isinstance(threshold, (int, float)) and threshold > 0
+
+        calculations = [c for c in self.calculations if c.getStatus() == 'completed']
+
+        assert calculations, 'No calculations have completed'
+
+        groups = {}
+
+        for c, label in zip(calculations, self.getGroupLabels(calculations=calculations, by=by)):
+            scf = c.getSCF()
+
+            cycles = scf['cycle'] > 0
+
+            if not cycles.any():
+                continue
+
+            # Timer is cumulative so each cycle's time is the difference from the row before.
+            cycleTimes = diff(scf['timer'])[(diff(scf['block']) == 0) & cycles[1:]]
+
+            groups.setdefault(label, []).append((c, cycles.sum() / len(unique(scf['block'][cycles])),
+                                                 median(cycleTimes) if len(cycleTimes) else nan))
+
+        if not groups:
+            print('*** No SCF cycles found in completed calculations ***')
+            return {}
+
+        def getOutliers(values):
+            centre = nanmedian(values)
+            spread = nanmedian(absolute(values - centre))
+
+            # Scaled to be comparable to a standard deviation. If most of the group are the same then the mean
+            # absolute deviation is used instead.
+            scale = spread / 0.6745 if spread > 0 else 1.253314 * nanmean(absolute(values - centre))
+
+            if len(values) < 3 or not scale > 0:
+                return zeros(len(values), dtype=bool)
+
+            return nan_to_num((values - centre) / scale) > threshold
+
+        report = {}
+
+        for label, rows in sorted(groups.items()):
+            cycles = asarray([row[1] for row in rows], dtype=float)
+            cycleTimes = asarray([row[2] for row in rows], dtype=float)
+
+            report[label] = {'calculations': [row[0] for row in rows],
+                             'cycles': cycles,
+                             'cycleTimes': cycleTimes,
+                             'slowCycles': getOutliers(cycles),
+                             'slowCycleTimes': getOutliers(cycleTimes)}
+
+            flagged = flatnonzero(report[label]['slowCycles'] | report[label]['slowCycleTimes'])
+
+            print(f'*** {label} ({len(rows)} calculation{"" if len(rows) == 1 else "s"}, median {nanmedian(cycles):.1f} cycles '
+                  f'of {nanmedian(cycleTimes):.2f}s) ***')
+
+            for num in flagged:
+                c = rows[num][0]
+
+                reasons = ([f'{cycles[num]:.1f} cycles per SCF'] if report[label]['slowCycles'][num] else []) + \
+                          ([f'{cycleTimes[num]:.2f}s per cycle'] if report[label]['slowCycleTimes'][num] else [])
+
+                print(f'  {c.directory}{c.name}: {", ".join(reasons)}')
+
+            if len(flagged) == 0:
+                print('  No outliers')
+
+            print('')
+
+        return report
+
+
+def discoverCalculations(root=None, pattern='*', workers=1, name=None):
+    """ This function finds every calculation under root, i.e. every directory
+        with a cell or param file in whose path relative to root matches the
+        pattern, and returns a model of them. The tree is walked once, and the
+        cell and param files are read by a pool of workers processes as
+        reading settings is limited by the CPU rather than the filesystem. """
+
+    assert isinstance(workers, int) and workers >= 1, 'Number of workers should be a positive integer'
+
+    start = perf_counter()
+
+    found = findCalculationDirectories(root=root, pattern=pattern)
+
+    directories = [directory for directory, _ in found]
+    fileNames = [names for _, names in found]
+
+    if workers == 1 or len(found) < 2:
+        calculations = list(map(readCalculation, directories, fileNames))
+
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            calculations = list(executor.map(readCalculation, directories, fileNames,
+                                             chunksize=max(1, len(found) // (4 * workers))))
+
+    seconds = perf_counter() - start
+
+    print(f'*** Discovered {len(calculations)} calculations under {root} in {seconds:.2f} s ***')
+
+    return Model(calculations=calculations, name=name)
@@ -0,0 +1,211 @@
+from casbot.settings import ElementThreeVectorFloatBlock, Keyword, cellKnown, paramKnown
+
+from numpy import ndarray
+from sqlite3 import connect
+
+
+registryColumns = ('name', 'directory', 'status', 'submitTime', 'startTime', 'endTime')
+
+timeColumns = ('submitTime', 'startTime', 'endTime')
+
+registrySchema = '''
+CREATE TABLE IF NOT EXISTS calculations (idx INTEGER PRIMARY KEY, digest TEXT,
+                                         name TEXT, directory TEXT, status TEXT,
+                                         submitTime REAL, startTime REAL, endTime REAL);
+CREATE INDEX IF NOT EXISTS calculationsName ON calculations (name);
+CREATE INDEX IF NOT EXISTS calculationsDirectory ON calculations (directory);
+CREATE INDEX IF NOT EXISTS calculationsStatus ON calculations (status);
+CREATE INDEX IF NOT EXISTS calculationsSubmitTime ON calculations (submitTime);
+CREATE INDEX IF NOT EXISTS calculationsStartTime ON calculations (startTime);
+CREATE INDEX IF NOT EXISTS calculationsEndTime ON calculations (endTime);
+
+CREATE TABLE IF NOT EXISTS settings (idx INTEGER, key TEXT, value TEXT);
+CREATE INDEX IF NOT EXISTS settingsKeyValue ON settings (key, value, idx);
+CREATE INDEX IF NOT EXISTS settingsIdx ON settings (idx);
+
+CREATE TABLE IF NOT EXISTS elements (idx INTEGER, element TEXT);
+CREATE INDEX IF NOT EXISTS elementsElement ON elements (element, idx);
+CREATE INDEX IF NOT EXISTS elementsIdx ON elements (idx);
+'''
+
+
+def toRegistryValue(value=None):
+    """ This function turns a setting value into the text stored in the
+        registry, lower case and with numbers written the same way however
+        they were given, so that 500 matches a cut off energy of 500.0 """
+
+    if isinstance(value, bool):
+        return str(value).lower()
+
+    elif isinstance(value, (int, float)):
+        return repr(float(value))
+
+    else:
+        return str(value).strip().lower()
+
+
+def getCalculationTimes(calculation=None, status=None):
+    """ This function gets the submit, start and end times of a calculation
+        as timestamps, with None for any that are not known yet """
+
+    submitTime = startTime = endTime = None
+
+    try:
+        submitTime = calculation.getSubTime()
+
+        if status in ('running', 'completed'):
+            startTime = calculation.getStartTime()
+
+        if status == 'completed' and startTime is not None:
+            endTime = startTime + calculation.getCompletedTime()
+
+    except (AssertionError, ValueError):
+        pass
+
+    return submitTime, startTime, endTime
+
+
+class Registry:
+    """ An SQLite mirror of the calculations of a model, with indexed columns
+        for the directory, name, status and times of each calculation along
+        with its keywords and elements, so that calculations can be found
+        without going through every one of them. A file can be given to keep
+        the registry between sessions, otherwise it is kept in memory. """
+
+    def __init__(self, file=None):
+        if file is None:
+            file = ':memory:'
+
+        assert isinstance(file, str)
+
+        self.file = file
+
+        self.connection = connect(file, check_same_thread=False)
+        self.connection.executescript(registrySchema)
+
+        # Whether the times of every calculation have been read since its status was.
+        self.timesLoaded = False
+
+    def update(self, calculations=None, statuses=True, times=False):
+        """ This function brings the registry up to date with the calculations.
+            Calculations that have not changed since they were last registered
+            keep their rows. Statuses (and times) are read from the calculation
+            directories so are only refreshed when asked for. """
+
+        assert isinstance(calculations, list)
+        assert isinstance(statuses, bool)
+        assert isinstance(times, bool)
+
+        assert statuses or not times, 'Cannot refresh times without refreshing statuses'
+
+        known = dict(self.connection.execute('SELECT idx, digest FROM calculations'))
+
+        changed = False
+
+        with self.connection:
+            # Calculations removed from the end of the model.
+            for table in ('calculations', 'settings', 'elements'):
+                self.connection.execute(f'DELETE FROM {table} WHERE idx >= ?', (len(calculations),))
+
+            for num, calculation in enumerate(calculations):
+                digest = calculation.getDigest()
+
+                if known.get(num, None) == digest:
+                    continue
+
+                changed = True
+
+                self.connection.execute('DELETE FROM settings WHERE idx = ?', (num,))
+                self.connection.execute('DELETE FROM elements WHERE idx = ?', (num,))
+
+                self.connection.execute('INSERT OR REPLACE INTO calculations (idx, digest, name, directory) VALUES (?, ?, ?, ?)',
+                                        (num, digest, calculation.name, calculation.directory))
+
+                self.connection.executemany('INSERT INTO settings (idx, key, value) VALUES (?, ?, ?)',
+                                            [(num, s.key, toRegistryValue(s.value)) for s in calculation.settings
+                                             if isinstance(s, Keyword) and not isinstance(s.value, ndarray)])
+
+                elements = set()
+
+                for s in calculation.settings:
+                    if isinstance(s, ElementThreeVectorFloatBlock):
+                        elements.update(element.lower() for element in s.getElements())
+
+                self.connection.executemany('INSERT INTO elements (idx, element) VALUES (?, ?)',
+                                            [(num, element) for element in sorted(elements)])
+
+            if statuses:
+                rows = []
+
+                for num, calculation in enumerate(calculations):
+                    status = calculation.getStatus()
+
+                    # The name can be set by getting the status.
+                    rows.append((calculation.name, status, num))
+
+                self.connection.executemany('UPDATE calculations SET name = ?, status = ? WHERE idx = ?', rows)
+
+            if times:
+                rows = [getCalculationTimes(calculation=calculation, status=status) + (num,)
+                        for (_, status, num), calculation in zip(rows, calculations)]
+
+                self.connection.executemany('UPDATE calculations SET submitTime = ?, startTime = ?, endTime = ? WHERE idx = ?', rows)
+
+        if statuses:
+            self.timesLoaded = times
+        elif changed:
+            self.timesLoaded = False
+
+    def query(self, **kwargs):
+        """ This function returns the indices of the calculations matching
+            every keyword given. Name, directory and status match their
+            columns, element matches any element in the positions, and
+            anything else matches the value of that keyword in the settings.
+            A list or tuple matches any of its values, apart from the times
+            where a tuple of two is the (earliest, latest) range. """
+
+        conditions = []
+        parameters = []
+
+        for key, value in kwargs.items():
+            assert isinstance(key, str)
+            assert key in registryColumns or key == 'element' or key.strip().lower() in cellKnown + paramKnown, \
+                f'Cannot query {key}, not a registry column, element or known setting'
+
+            values = list(value) if isinstance(value, (list, tuple)) else [value]
+
+            assert len(values) > 0, f'No values given to query {key}'
+
+            if key in timeColumns:
+                if isinstance(value, tuple):
+                    assert len(value) == 2, f'Range of {key} should be (earliest, latest)'
+
+                    earliest, latest = value
+
+                    conditions.append(f'c.{key} >= ?' if latest is None else
+                                      f'c.{key} <= ?' if earliest is None else
+                                      f'c.{key} BETWEEN ? AND ?')
+                    parameters += [v for v in value if v is not None]
+
+                else:
+                    conditions.append(f'c.{key} IN ({", ".join("?" * len(values))})')
+                    parameters += values
+
+            elif key in registryColumns:
+                conditions.append(f'c.{key} IN ({", ".join("?" * len(values))})')
+                parameters += values
+
+            elif key == 'element':
+                conditions.append(f'c.idx IN (SELECT idx FROM elements WHERE element IN ({", ".join("?" * len(values))}))')
+                parameters += [str(v).strip().lower() for v in values]
+
+            else:
+                conditions.append(f'c.idx IN (SELECT idx FROM settings WHERE key = ? AND value IN ({", ".join("?" * len(values))}))')
+                parameters += [key.strip().lower()] + [toRegistryValue(v) for v in values]
+
+        where = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+
+        return [idx for idx, in self.connection.execute(f'SELECT c.idx FROM calculations AS c{where} ORDER BY c.idx', parameters)]
+
+    def close(self):
+        self.connection.close()
@@ -1,9 +1,13 @@
 from casbot.data import getElement, getIon,\
     getUnit, getFromDict,\
     PrintColors,\
-    strListToArray
+    strListToArray,\
+    findFile, getFileStat, openFile
 
-from numpy import ndarray
+from io import BytesIO
+from numpy import arange, argsort, array, full, load, loadtxt, nan, ndarray, save
+from pathlib import Path
+from re import compile as regexCompile
 
 
 NMRresults = ['nmr_core', 'nmr_bare', 'nmr_dia', 'nmr_para', 'nmr_total']
@@ -259,6 +263,583 @@ def getResult(resultToGet=None, lines=None):
         raise ValueError(f'Do not know how to get result {resultToGet}')
 
 
+# A row of a castep profile: the subroutine, its number of calls, total time, time per call and (if there) self time,
+# with the times possibly ending in s. With FULL_TRACE the rows are drawn as a call tree (e.g. |  o-> name) instead.
+profileRowPattern = regexCompile(r'^\|?\s*(?P<tree>(?:\|\s*)*[o+`\\]->\s*)?(?P<name><?[A-Za-z_][\w:%.]*>?)\s+(?P<calls>\d+)'
+                                 r'\s+(?P<total>\d+\.\d*)s?\s+(?P<perCall>\d+\.\d*)s?(?:\s+(?P<self>\d+\.\d*)s?)?[\s|]*$')
+
+# Borders and empty lines of the boxes drawn around a profile, e.g. +-----+, |=====| or |     |.
+profileBorderPattern = regexCompile(r'^[\s|+=\-]*$')
+
+
+def getProfile(lines=None):
+    """ This function gets the profile written by castep when it is run with
+        PROF in the devel_code (see Calculation.addProf). Only the profile
+        tables are read, from their header (with the calls and time columns)
+        to the first line that isn't a row or border, along with the call
+        tree written with FULL_TRACE, which is used if there is no table.
+        Subroutines that appear more than once in the table or call tree have
+        their calls and times added together. Returns a dictionary of arrays
+        of the subroutine names, calls, total times and self times (NaN if
+        not written). """
+
+    assert isinstance(lines, list)
+    assert all(isinstance(line, str) for line in lines)
+
+    tables = {}
+    trees = {}
+
+    inTable = False
+
+    for line in lines:
+        line = line.strip()
+
+        if inTable and profileBorderPattern.match(line):
+            continue
+
+        match = profileRowPattern.match(line)
+
+        # Only rows after a table header are counted, so other lines with a name and numbers aren't mistaken for
+        # them. Rows of a call tree can be anywhere, but they all start with the tree drawing.
+        if match is None or not (inTable or match.group('tree') is not None):
+            lower = line.lower()
+
+            inTable = 'calls' in lower and 'time' in lower
+
+            continue
+
+        profile = tables if inTable else trees
+
+        name = match.group('name')
+        selfTime = match.group('self')
+
+        calls, totalTime, selfTotal = profile.get(name, (0, 0.0, 0.0))
+
+        profile[name] = (calls + int(match.group('calls')),
+                         totalTime + float(match.group('total')),
+                         selfTotal + (nan if selfTime is None else float(selfTime)))
+
+    profile = tables if tables else trees
+
+    return {'names': array(list(profile), dtype=str),
+            'calls': array([p[0] for p in profile.values()], dtype=int),
+            'total': array([p[1] for p in profile.values()], dtype=float),
+            'self': array([p[2] for p in profile.values()], dtype=float)}
+
+
+def getSCF(lines=None):
+    """ This function gets every SCF cycle from the tables castep writes
+        (tagged <-- SCF), one table for each SCF run, e.g. each step of a
+        geometry optimisation. Returns a dictionary of arrays of the SCF run
+        (block) and cycle (0 for the initial row) of each row, along with its
+        energy, Fermi energy, energy gain per atom and timer. Anything not
+        written, like the energy gain of the initial row, is NaN. The timer
+        is the time since castep started so cycle times are its differences. """
+
+    assert isinstance(lines, list)
+    assert all(isinstance(line, str) for line in lines)
+
+    blocks = []
+    cycles = []
+    values = []
+
+    block = -1
+    hasFermi = True
+
+    for line in lines:
+        arrow = line.rfind('<-- SCF')
+
+        if arrow == -1:
+            continue
+
+        parts = line[:arrow].split()
+
+        if not parts:
+            continue
+
+        if parts[0] == 'SCF' and parts[1:2] == ['loop']:
+            block += 1
+            hasFermi = 'Fermi' in parts
+            continue
+
+        if parts[0] == 'Initial':
+            cycle = 0
+
+        elif parts[0].isdigit():
+            cycle = int(parts[0])
+
+        else:
+            continue
+
+        # The initial row has no energy gain, and the Fermi energy is only written for some runs.
+        numbers = parts[1:]
+
+        if len(numbers) < 2 + hasFermi:
+            continue
+
+        blocks.append(max(block, 0))
+        cycles.append(cycle)
+        values.append((numbers[0],
+                       numbers[1] if hasFermi else 'nan',
+                       numbers[-2] if cycle > 0 and len(numbers) >= 3 + hasFermi else 'nan',
+                       numbers[-1]))
+
+    values = array(values, dtype=float).reshape(-1, 4)
+
+    return {'block': array(blocks, dtype=int),
+            'cycle': array(cycles, dtype=int),
+            'energy': values[:, 0],
+            'fermi': values[:, 1],
+            'gain': values[:, 2],
+            'timer': values[:, 3]}
+
+
+runSummaryQuantities = ('finalEnergy', 'initialisationTime', 'calculationTime', 'finalisationTime', 'totalTime',
+                        'peakMemory', 'parallelEfficiency')
+
+
+def getRunSummary(lines=None):
+    """ This function gets the summary castep writes at the end of a run in
+        one pass over its lines: the final energy (eV), the initialisation,
+        calculation, finalisation and total times (s), the peak memory use
+        (kB) and the overall parallel efficiency (%). The last of each is
+        taken, and anything not written (e.g. if the run has not finished)
+        is NaN. """
+
+    assert isinstance(lines, list)
+    assert all(isinstance(line, str) for line in lines)
+
+    summary = dict.fromkeys(runSummaryQuantities, nan)
+
+    times = {'initialisation time': 'initialisationTime',
+             'calculation time': 'calculationTime',
+             'finalisation time': 'finalisationTime',
+             'total time': 'totalTime'}
+
+    for line in lines:
+        line = line.strip().lower()
+
+        if not line:
+            continue
+
+        if line.startswith('final energy'):
+            # Final energy, E = ... eV or Final energy = ... eV.
+            index = line.find('=')
+
+            if index != -1:
+                summary['finalEnergy'] = float(line[index+1:].split()[0])
+
+        elif line.startswith(tuple(times)):
+            parts = line.split()
+
+            # Check for sure it is one of the times printed at the end of the run.
+            if len(parts) <= 3 or parts[2] != '=':
+                continue
+
+            summary[times[' '.join(parts[:2])]] = float(parts[3].rstrip('s'))
+
+        elif line.startswith('peak memory use'):
+            index = line.find('=')
+
+            if index != -1:
+                summary['peakMemory'] = float(line[index+1:].split()[0])
+
+        elif line.startswith('overall parallel efficiency rating'):
+            index = line.rfind('(')
+
+            if index != -1:
+                summary['parallelEfficiency'] = float(line[index+1:].split('%')[0])
+
+    return summary
+
+
+def getBands(lines=None):
+    """ This function reads the lines of a .bands file. The header gives the
+        number of k-points, spins, electrons and bands, the Fermi energies and
+        the cell, after which each k-point has its line followed by a block of
+        eigenvalues for each spin. As every k-point block is the same length,
+        all the eigenvalues (and k-points) are picked out and converted in one
+        go. K-points are sorted back into order as castep can write them in
+        any order. """
+
+    assert isinstance(lines, list)
+    assert all(isinstance(line, str) for line in lines)
+
+    assert len(lines) >= 9, 'Bands file too short for header'
+
+    def getHeaderValues(num, text):
+        assert lines[num].strip().lower().startswith(text), f'Expected {text} on line {num+1} of bands file'
+        return lines[num].split()[len(text.split()):]
+
+    numKpoints = int(getHeaderValues(0, 'number of k-points')[0])
+    numSpins = int(getHeaderValues(1, 'number of spin components')[0])
+    electrons = array(getHeaderValues(2, 'number of electrons'), dtype=float)
+    numBands = array(getHeaderValues(3, 'number of eigenvalues'), dtype=int)
+
+    fermiEnergies = array(lines[4].split()[-numSpins:], dtype=float)
+
+    assert lines[5].strip().lower().startswith('unit cell vectors'), 'Expected unit cell vectors on line 6 of bands file'
+
+    cell = array(' '.join(lines[6:9]).split(), dtype=float).reshape(3, 3)
+
+    assert (numBands == numBands[0]).all(), 'Cannot read bands files with different numbers of bands for each spin'
+    numBands = int(numBands[0])
+
+    blockLength = 1 + numSpins * (1 + numBands)
+
+    body = lines[9:9 + numKpoints * blockLength]
+
+    assert len(body) == numKpoints * blockLength, f'Expected {numKpoints} k-points in bands file'
+
+    # Line of each eigenvalue within the body: skip the k-point line and each spin component line.
+    offsets = (1 + arange(numSpins)[:, None] * (1 + numBands) + 1 + arange(numBands)[None, :]).reshape(-1)
+    eigenLines = (arange(numKpoints)[:, None] * blockLength + offsets[None, :]).reshape(-1)
+
+    eigenvalues = array(' '.join([body[num] for num in eigenLines.tolist()]).split(), dtype=float)
+    eigenvalues = eigenvalues.reshape(numKpoints, numSpins, numBands)
+
+    kpointLines = [body[num] for num in range(0, len(body), blockLength)]
+
+    assert all(line.strip().lower().startswith('k-point') for line in kpointLines), 'Error in k-point lines of bands file'
+
+    kpoints = array(' '.join(line.split(maxsplit=1)[1] for line in kpointLines).split(), dtype=float).reshape(numKpoints, 5)
+
+    order = argsort(kpoints[:, 0], kind='stable')
+
+    return Bands(kpoints=kpoints[order, 1:4],
+                 weights=kpoints[order, 4],
+                 eigenvalues=eigenvalues[order].transpose(1, 0, 2).copy(),
+                 fermiEnergies=fermiEnergies,
+                 electrons=electrons,
+                 cell=cell)
+
+
+class Bands:
+    """ The band structure of a calculation from its .bands file, in atomic
+        units. The eigenvalues are a (spins, kpoints, bands) array. """
+
+    def __init__(self, kpoints=None, weights=None, eigenvalues=None, fermiEnergies=None, electrons=None, cell=None):
+        assert isinstance(kpoints, ndarray) and kpoints.ndim == 2 and kpoints.shape[1] == 3
+        assert isinstance(weights, ndarray) and weights.shape == (kpoints.shape[0],)
+        assert isinstance(eigenvalues, ndarray) and eigenvalues.ndim == 3 and eigenvalues.shape[1] == kpoints.shape[0]
+        assert isinstance(fermiEnergies, ndarray) and fermiEnergies.shape == (eigenvalues.shape[0],)
+        assert isinstance(electrons, ndarray) and electrons.ndim == 1 and 1 <= electrons.size <= eigenvalues.shape[0]
+        assert isinstance(cell, ndarray) and cell.shape == (3, 3)
+
+        self.kpoints = kpoints
+        self.weights = weights
+        self.eigenvalues = eigenvalues
+        self.fermiEnergies = fermiEnergies
+        self.electrons = electrons
+        self.cell = cell
+
+        self.unit = 'ha'
+
+        self.numSpins, self.numKpoints, self.numBands = eigenvalues.shape
+
+    def __str__(self):
+        return f'{self.numKpoints} k-points, {self.numSpins} spin{"" if self.numSpins == 1 else "s"}, {self.numBands} bands, ' \
+               f'Fermi energ{"y" if self.numSpins == 1 else "ies"} {" ".join(f"{e:.6f}" for e in self.fermiEnergies)} {self.unit}'
+
+
+def growBuffer(buffer=None, steps=None):
+    """ This function doubles the number of steps a buffer can hold when it is full """
+
+    if steps < len(buffer):
+        return buffer
+
+    grown = full((2 * len(buffer),) + buffer.shape[1:], nan)
+    grown[:len(buffer)] = buffer
+
+    return grown
+
+
+def getGeometry(lines=None):
+    """ This function reads a .geom file of a geometry optimisation or
+        molecular dynamics run in one pass. The lines can be a list or an open
+        file, which is then streamed rather than read in all at once. Each
+        step's energy, cell, stress, positions and forces are tagged <-- E, h,
+        S, R and F; the lines of a step are gathered and converted together
+        into buffers that grow as needed, so no objects are made per atom.
+        Steps without a stress have NaN stresses. """
+
+    stepsCapacity = 16
+
+    stepNumbers = full(stepsCapacity, nan)
+    energies = full((stepsCapacity, 2), nan)
+    lattices = full((stepsCapacity, 3, 3), nan)
+    stresses = full((stepsCapacity, 3, 3), nan)
+    positions = None
+    forces = None
+
+    elements = None
+    ions = None
+
+    steps = 0
+    step = None
+    tagged = {'E': [], 'h': [], 'S': [], 'R': [], 'F': []}
+
+    def addStep():
+        nonlocal stepNumbers, energies, lattices, stresses, positions, forces, elements, ions, steps
+
+        if not tagged['R']:
+            return
+
+        atomPositions = ' '.join(tagged['R']).split()
+
+        if elements is None:
+            elements = array(atomPositions[0::5], dtype=str)
+            ions = array(atomPositions[1::5], dtype=int)
+
+            positions = full((stepsCapacity, len(elements), 3), nan)
+            forces = full((stepsCapacity, len(elements), 3), nan)
+
+        assert len(atomPositions) == 5 * len(elements), f'Different number of atoms in step {step} of geom file'
+
+        stepNumbers = growBuffer(buffer=stepNumbers, steps=steps)
+        energies = growBuffer(buffer=energies, steps=steps)
+        lattices = growBuffer(buffer=lattices, steps=steps)
+        stresses = growBuffer(buffer=stresses, steps=steps)
+        positions = growBuffer(buffer=positions, steps=steps)
+        forces = growBuffer(buffer=forces, steps=steps)
+
+        stepNumbers[steps] = step
+
+        energy = array(' '.join(tagged['E']).split(), dtype=float)
+        energies[steps, :len(energy)] = energy[:2]
+
+        lattices[steps] = array(' '.join(tagged['h']).split(), dtype=float).reshape(3, 3)
+
+        if tagged['S']:
+            stresses[steps] = array(' '.join(tagged['S']).split(), dtype=float).reshape(3, 3)
+
+        positions[steps] = array([atomPositions[2::5], atomPositions[3::5], atomPositions[4::5]], dtype=float).T
+
+        if tagged['F']:
+            atomForces = ' '.join(tagged['F']).split()
+
+            assert len(atomForces) == 5 * len(elements), f'Different number of forces in step {step} of geom file'
+
+            forces[steps] = array([atomForces[2::5], atomForces[3::5], atomForces[4::5]], dtype=float).T
+
+        steps += 1
+
+        for tag in tagged:
+            tagged[tag].clear()
+
+    inHeader = False
+
+    for line in lines:
+        if inHeader:
+            inHeader = not line.strip().upper().startswith('END HEADER')
+            continue
+
+        arrow = line.rfind('<--')
+
+        if arrow != -1:
+            # The whole tag, as hv (lattice velocities) isn't h. Anything else, e.g. velocities (V), temperature (T)
+            # and pressure (P), is not kept.
+            tag = tagged.get(line[arrow+3:].strip(), None)
+
+            if tag is not None:
+                tag.append(line[:arrow])
+
+            continue
+
+        line = line.strip()
+
+        if not line:
+            continue
+
+        if line.upper().startswith('BEGIN HEADER'):
+            inHeader = True
+            continue
+
+        # Step number (or time for molecular dynamics) starts a new step.
+        addStep()
+        step = float(line.split()[0])
+
+    addStep()
+
+    assert steps > 0, 'No steps in geom file'
+
+    return Geometry(steps=stepNumbers[:steps].copy(),
+                    energies=energies[:steps, 0].copy(),
+                    enthalpies=energies[:steps, 1].copy(),
+                    lattices=lattices[:steps].copy(),
+                    stresses=stresses[:steps].copy(),
+                    positions=positions[:steps].copy(),
+                    forces=forces[:steps].copy(),
+                    elements=elements,
+                    ions=ions)
+
+
+class Geometry:
+    """ Every step of a geometry optimisation or molecular dynamics run from
+        its .geom file, in atomic units. Energies and enthalpies are (steps,)
+        arrays, lattices (rows are the cell vectors) and stresses (steps, 3, 3)
+        and positions and forces (steps, atoms, 3), with the element and ion
+        number of each atom. """
+
+    def __init__(self, steps=None, energies=None, enthalpies=None, lattices=None, stresses=None, positions=None, forces=None,
+                 elements=None, ions=None):
+        assert isinstance(steps, ndarray) and steps.ndim == 1
+        assert isinstance(energies, ndarray) and energies.shape == steps.shape
+        assert isinstance(enthalpies, ndarray) and enthalpies.shape == steps.shape
+        assert isinstance(lattices, ndarray) and lattices.shape == steps.shape + (3, 3)
+        assert isinstance(stresses, ndarray) and stresses.shape == steps.shape + (3, 3)
+        assert isinstance(elements, ndarray) and elements.ndim == 1
+        assert isinstance(ions, ndarray) and ions.shape == elements.shape
+        assert isinstance(positions, ndarray) and positions.shape == steps.shape + elements.shape + (3,)
+        assert isinstance(forces, ndarray) and forces.shape == positions.shape
+
+        self.steps = steps
+        self.energies = energies
+        self.enthalpies = enthalpies
+        self.lattices = lattices
+        self.stresses = stresses
+        self.positions = positions
+        self.forces = forces
+        self.elements = elements
+        self.ions = ions
+
+        self.numSteps = len(steps)
+        self.numAtoms = len(elements)
+
+    def __str__(self):
+        return f'{self.numSteps} step{"" if self.numSteps == 1 else "s"} of {self.numAtoms} atom{"" if self.numAtoms == 1 else "s"}, ' \
+               f'final energy {self.energies[-1]:.8f} ha'
+
+
+densityChunkSize = 1 << 26
+
+
+def readDensity(file_=None, cache=False):
+    """ This function reads a formatted density (.den_fmt) file. The header
+        gives the cell, number of spins and the grid, and each line of the
+        body is the grid point followed by the charge (and spin) there. The
+        body is decoded in large chunks straight into the grid. If cache then
+        the grid is saved as a .npy beside the file, which is memory mapped
+        instead on later reads while it is newer than the file. """
+
+    assert isinstance(file_, str)
+    assert isinstance(cache, bool)
+
+    found = findFile(file_=file_)
+
+    assert found is not None, f'Cannot find file {file_}'
+
+    cacheFile = Path(f'{file_}.npy')
+
+    with openFile(file_=file_, mode='rb') as f:
+        header = []
+
+        while True:
+            line = f.readline()
+
+            assert line, f'No end of header in density file {file_}'
+
+            line = line.decode().strip()
+            header.append(line)
+
+            if line.upper().startswith('END HEADER'):
+                break
+
+        lattice = None
+        numSpins = None
+        grid = None
+
+        for num, line in enumerate(header):
+            if line.lower().startswith('real lattice'):
+                lattice = array([l.split()[:3] for l in header[num+1:num+4]], dtype=float)
+
+            elif line.lower().endswith('! nspins'):
+                numSpins = int(line.split()[0])
+
+            elif '! fine fft grid' in line.lower():
+                grid = tuple(int(n) for n in line.split()[:3])
+
+        assert lattice is not None and lattice.shape == (3, 3), f'Cannot find lattice in density file {file_}'
+        assert numSpins is not None, f'Cannot find number of spins in density file {file_}'
+        assert grid is not None, f'Cannot find grid in density file {file_}'
+
+        if cache and cacheFile.is_file() and cacheFile.stat().st_mtime_ns >= getFileStat(file_=found)[0]:
+            values = load(cacheFile, mmap_mode='r')
+
+            assert values.shape[:3] == grid, f'Cached density {cacheFile} does not match {file_}'
+
+        else:
+            values = None
+            remainder = b''
+
+            while True:
+                chunk = f.read(densityChunkSize)
+
+                finished = not chunk
+
+                chunk = remainder + chunk
+
+                # Any unfinished line is carried over to the next chunk.
+                if not finished:
+                    end = chunk.rfind(b'\n') + 1
+                    chunk, remainder = chunk[:end], chunk[end:]
+
+                if chunk and not chunk.isspace():
+                    # Grid point followed by the charge and spin(s).
+                    rows = loadtxt(BytesIO(chunk), dtype=float, comments=None, ndmin=2)
+
+                    if values is None:
+                        assert rows.shape[1] > 3, f'No density values in density file {file_}'
+
+                        values = full(grid + (rows.shape[1] - 3,), nan)
+
+                    assert rows.shape[1] == values.shape[3] + 3, f'Different number of columns in density file {file_}'
+
+                    indices = rows[:, :3].astype(int) - 1
+
+                    values[indices[:, 0], indices[:, 1], indices[:, 2]] = rows[:, 3:]
+
+                if finished:
+                    break
+
+            assert values is not None, f'No density values in density file {file_}'
+
+            if cache:
+                save(cacheFile, values)
+
+    return Density(lattice=lattice, numSpins=numSpins, values=values)
+
+
+class Density:
+    """ A density on the fine grid of a calculation from its .den_fmt file.
+        The values are a (nx, ny, nz, components) array of the charge then
+        the spin (if any) at each point, in electrons per grid point times
+        the number of grid points, and the lattice is in angstroms. """
+
+    def __init__(self, lattice=None, numSpins=None, values=None):
+        assert isinstance(lattice, ndarray) and lattice.shape == (3, 3)
+        assert isinstance(numSpins, int)
+        assert isinstance(values, ndarray) and values.ndim == 4
+
+        self.lattice = lattice
+        self.numSpins = numSpins
+        self.values = values
+
+        self.grid = values.shape[:3]
+
+    @property
+    def charge(self):
+        return self.values[..., 0]
+
+    @property
+    def spin(self):
+        return self.values[..., 1:] if self.values.shape[3] > 1 else None
+
+    def __str__(self):
+        return f'{self.numSpins} spin{"" if self.numSpins == 1 else "s"} on a {" x ".join(str(n) for n in self.grid)} grid, ' \
+               f'{float(self.charge.sum()) / self.charge.size:.6f} electrons'
+
+
 class Result:
     def __init__(self, key=None):
         assert isinstance(key, str)
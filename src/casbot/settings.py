@@ -1,21 +1,35 @@
 from casbot.data import assertBetween, assertCount, \
-    Any, elements, \
+    Any, elements, niceElements, \
     getUnit, getFromDict, \
-    stringToValue
+    stringToValue, \
+    openFile
 
-from collections import Counter
-from numpy import array, ndarray, dot, set_printoptions
-from pathlib import Path
+from numpy import argsort, array, bincount, empty, loadtxt, ndarray, dot, set_printoptions, unique
+from re import compile as regexCompile, MULTILINE
 
 set_printoptions(precision=15)
 
 
-def getSettingLines(sttng=None, maxSettingLength=0):
+def getSettingLines(sttng=None, maxSettingLength=0, cache=None):
     """ TODO: integrate this into getSettings """
 
     assert isinstance(sttng, (Keyword, Block)), f'Setting {sttng} not a class of Keyword or Block'
     assert isinstance(maxSettingLength, int)
 
+    # Settings with the same content are formatted once and then the lines are reused.
+    if cache is not None:
+        assert isinstance(cache, dict)
+
+        cacheKey = (sttng.getCacheKey(), maxSettingLength)
+
+        lines = cache.get(cacheKey, None)
+
+        if lines is None:
+            lines = getSettingLines(sttng=sttng, maxSettingLength=maxSettingLength)
+            cache[cacheKey] = lines
+
+        return lines
+
     if isinstance(sttng, Keyword):
         spaces = max(len(sttng.key), maxSettingLength)
         return [f'{sttng.key:<{spaces}s} : {sttng}']
@@ -27,6 +41,31 @@ def getSettingLines(sttng=None, maxSettingLength=0):
         raise TypeError(f'Setting {sttng} not a class of Keyword or Block')
 
 
+def toHashable(value):
+    """ This function turns a setting value (or any object made of them)
+        into something hashable, using the raw bytes of any arrays as they
+        are quick to hash """
+
+    if isinstance(value, ndarray):
+        return value.dtype.str, value.shape, value.tobytes()
+
+    elif isinstance(value, (list, tuple)):
+        return tuple(toHashable(v) for v in value)
+
+    elif isinstance(value, dict):
+        return tuple(sorted((k, toHashable(v)) for k, v in value.items()))
+
+    elif hasattr(value, '__dict__'):
+        return type(value).__name__, toHashable(vars(value))
+
+    elif isinstance(value, float):
+        # As 0.0 == -0.0 but they are written differently.
+        return value.hex()
+
+    else:
+        return value
+
+
 def getSettings(*keys, settings=None, attr=None):
     assert all(isinstance(key, str) for key in keys)
     assert isinstance(settings, list)
@@ -93,6 +132,102 @@ def checkForUnit(lines=None, unitLine=0):
     return unit
 
 
+def stripComments(lines=None):
+    """ Strips whitespace and comments from lines of a cell or
+        param file, ignoring any lines that are then empty """
+
+    assert isinstance(lines, list)
+
+    # Most lines, especially large numeric blocks, have no comments at all so don't search each line unless we need to.
+    text = '\n'.join(lines)
+
+    if '!' not in text and '#' not in text:
+        return [line for line in map(str.strip, lines) if line]
+
+    stripped = []
+
+    for line in map(str.strip, lines):
+        # Ignore empty lines and whole line comments.
+        if not line or line[0] in '!#':
+            continue
+
+        # Check for comments. These will go from left to right, so don't need to worry about multiple.
+        for commentFlag in '!#':
+            comment = line.find(commentFlag)
+
+            # Remove it if need be.
+            if comment != -1:
+                line = line[:comment].strip()
+
+        stripped.append(line)
+
+    return stripped
+
+
+def decodeBlockLines(key=None, lines=None, columns=3, element=False, dtype=float):
+    """ This function decodes the lines of a numeric block, optionally
+        with an element at the start of each line, into an array of
+        element codes (indices into elements) and a (len(lines), columns)
+        array. All the numbers are converted to an array in one go rather
+        than line by line, which matters for blocks with thousands of
+        atoms in them. """
+
+    assert isinstance(key, str)
+    assert isinstance(lines, list)
+    assert isinstance(columns, int) and columns > 0
+    assert isinstance(element, bool)
+
+    width = columns + 1 if element else columns
+
+    elementCodes = empty(0, dtype=int) if element else None
+
+    if len(lines) == 0:
+        return elementCodes, empty((0, columns), dtype=dtype)
+
+    try:
+        # Convert all the numbers in one go.
+        arr = loadtxt(lines, dtype=dtype, comments=None, usecols=range(1, width) if element else None, ndmin=2)
+
+        assert arr.shape == (len(lines), columns)
+
+        # Skipping the element column means long lines would get through, so check the total number of parts too.
+        if element:
+            assert len(' '.join(lines).split()) == width * len(lines)
+
+    except (AssertionError, ValueError):
+        # Go back through line by line to find the offending line so we can give a useful error.
+        for line in lines:
+            parts = line.split()
+
+            assert len(parts) > 0, f'Error in {key} on line {line}'
+
+            assert len(parts) == width, f'Shape error in {key} on line {line}'
+
+            try:
+                array(parts[1:] if element else parts, dtype=dtype)
+            except ValueError:
+                raise ValueError(f'Error in {key} on line {line}')
+
+        raise ValueError(f'Error in {key}')
+
+    if element:
+        elementsRead = [line.split(None, 1)[0] for line in lines]
+
+        # Only need to check and look up each distinct element once.
+        codes = {}
+
+        for el in set(elementsRead):
+            lowerEl = el.lower()
+
+            assert lowerEl in elements, f'Element {lowerEl} not known'
+
+            codes[el] = elements.index(lowerEl)
+
+        elementCodes = array([codes[el] for el in elementsRead], dtype=int)
+
+    return elementCodes, arr
+
+
 class Setting:
     def __init__(self, key=None):
         assert isinstance(key, str), 'Key for setting should be a string'
@@ -116,6 +251,10 @@ class Setting:
     def __repr__(self):
         return self.key
 
+    def getCacheKey(self):
+        """ A hashable summary of everything that affects how this setting is written """
+        return type(self).__name__, self.key, self.unit, toHashable(self.value)
+
     def getValue(self):
         return self.value
 
@@ -260,23 +399,15 @@ class Block(Setting):
             assert isinstance(lines, list), 'Lines for block should be a list'
             assert all(isinstance(line, str) for line in lines), 'Each line for the block should be a string'
 
-            lines = [line.strip() for line in lines if line.strip() and not line.strip().startswith('#') and not line.strip().startswith('!')]
-
-            self.lines = []
-
-            for line in lines:
-                # Check for comment.
-                comment = line.find('!')
-
-                # Remove it if need be.
-                if comment != -1:
-                    line = line[:comment].strip()
-
-                self.lines.append(line)
+            self.lines = stripComments(lines=lines)
 
     def __str__(self):
         return '; '.join(self.lines)
 
+    def getCacheKey(self):
+        # Blocks that don't parse their lines into a value are written straight from their lines.
+        return type(self).__name__, self.key, self.unit, toHashable(self.value if self.value else self.lines)
+
     def getLines(self):
         return self.lines
 
@@ -326,6 +457,13 @@ class ElementFloatBlock(Block):
 
 
 class ElementThreeVectorFloatBlock(Block):
+    """ The atoms are stored as one (N, 3) array of positions and one (N,)
+        array of element codes (indices into elements) rather than as a
+        list of (element, vector) pairs, so that large cells can be
+        rotated, counted and written without looping over every atom """
+
+    lineFormat = '{:<3s}  {:>15.12f}   {:>15.12f}   {:>15.12f}'
+
     def __init__(self, key=None, lines=None):
         super().__init__(key=key, lines=lines)
 
@@ -343,44 +481,83 @@ class ElementThreeVectorFloatBlock(Block):
                 self.unit = potentialUnit
                 linesToRead = linesToRead[1:]
 
-            for line in linesToRead:
-                parts = line.split()
+            self.elementCodes, self.positions = decodeBlockLines(key=self.key, lines=linesToRead, columns=3, element=True)
 
-                assert len(parts) > 0, f'Error in {key} on line {line}'
+    def __setstate__(self, state):
+        # Blocks pickled before the positions were stored as arrays will have their (element, vector) pairs as the value.
+        value = state.pop('value', None)
 
-                element = parts[0].strip().lower()
+        self.__dict__.update(state)
 
-                assert element in elements, f'Element {element} not known'
+        if value is not None:
+            self.value = value
 
-                element = element[0].upper() + element[1:].lower()
+    @property
+    def value(self):
+        return list(zip(self.getElements(), self.positions))
 
-                try:
-                    value = array(parts[1:], dtype=float)
-                except ValueError:
-                    raise ValueError(f'Error in {key} on line {line}')
+    @value.setter
+    def value(self, value):
+        value = [] if value is None else value
 
-                assert value.shape == (3,), f'Shape error in {key} on line {line}'
+        assert isinstance(value, list)
 
-                self.value.append((element, value))
+        elementCodes = []
+
+        for element, _ in value:
+            assert isinstance(element, str)
+
+            element = element.strip().lower()
+
+            assert element in elements, f'Element {element} not known'
+
+            elementCodes.append(elements.index(element))
+
+        self.elementCodes = array(elementCodes, dtype=int)
+        self.positions = array([vector for _, vector in value], dtype=float).reshape(len(value), 3)
 
     def __str__(self):
         return '; '.join(self.getLines())
 
+    def getCacheKey(self):
+        return type(self).__name__, self.key, self.unit, toHashable(self.elementCodes), toHashable(self.positions)
+
+    def getElements(self):
+        return [niceElements[code] for code in self.elementCodes.tolist()]
+
     def getLines(self):
         unitPart = [self.unit] if self.unit is not None else []
-        return unitPart + [f'{element:<3s}  ' + '   '.join('{:>15.12f}' for _ in range(len(vector))).format(*vector) for (element, vector) in self.value]
+
+        if len(self.positions) == 0:
+            return unitPart
+
+        # Put the elements and positions side by side and format every atom in one go.
+        table = empty((len(self.positions), 4), dtype=object)
+        table[:, 0] = self.getElements()
+        table[:, 1:] = self.positions
+
+        lines = '\n'.join([self.lineFormat] * len(table)).format(*table.ravel().tolist())
+
+        return unitPart + lines.split('\n')
 
     def findName(self):
-        if not self.value:
+        if len(self.elementCodes) == 0:
             return None
 
-        return ''.join([f'{element}{"" if num == 1 else num}' for element, num in Counter(list(zip(*self.value))[0]).items()])
+        # Elements in the order they first appear, along with how many of each there are.
+        codes, firstAppearances = unique(self.elementCodes, return_index=True)
+        codes = codes[argsort(firstAppearances)]
+
+        counts = bincount(self.elementCodes)
+
+        return ''.join([f'{niceElements[code]}{"" if counts[code] == 1 else counts[code]}' for code in codes.tolist()])
 
     def rotate(self, rotationMatrix=None):
         assert isinstance(rotationMatrix, ndarray)
         assert rotationMatrix.shape == (3, 3)
 
-        self.value = [(element, dot(rotationMatrix, vector)) for element, vector in self.value]
+        # Equivalent to dot(rotationMatrix, vector) for every atom.
+        self.positions = self.positions @ rotationMatrix.T
 
     # TODO: consider fractional coordinates
     '''
@@ -421,15 +598,9 @@ class ThreeVectorFloatBlock(Block):
                 self.unit = potentialUnit
                 linesToRead = linesToRead[1:]
 
-            for line in linesToRead:
-                try:
-                    value = array(line.split(), dtype=float)
-                except ValueError:
-                    raise ValueError(f'Error in {key} on line {line}')
+            _, values = decodeBlockLines(key=self.key, lines=linesToRead, columns=3)
 
-                assert value.shape == (3,), f'Shape error in {key} on line {line}'
-
-                self.value.append(value)
+            self.value = list(values)
 
     def __str__(self):
         return '; '.join(self.getLines())
@@ -449,15 +620,9 @@ class ThreeVectorFloatWeightedBlock(Block):
     def __init__(self, key=None, lines=None):
         super().__init__(key=key, lines=lines)
 
-        for line in self.lines:
-            try:
-                value = array(line.split(), dtype=float)
-            except ValueError:
-                raise ValueError(f'Error in {key} on line {line}')
-
-            assert value.shape == (4,), f'Shape error in {key} on line {line}'
+        _, values = decodeBlockLines(key=self.key, lines=self.lines, columns=4)
 
-            self.value.append(value)
+        self.value = list(values)
 
     def __str__(self):
         return '; '.join(self.getLines())
@@ -470,15 +635,9 @@ class ThreeVectorIntBlock(Block):
     def __init__(self, key=None, lines=None):
         super().__init__(key=key, lines=lines)
 
-        for line in self.lines:
-            try:
-                value = array(line.split(), dtype=int)
-            except ValueError:
-                raise ValueError(f'Error in {key} on line {line}')
+        _, values = decodeBlockLines(key=self.key, lines=self.lines, columns=3, dtype=int)
 
-            assert value.shape == (3,), f'Shape error in {key} on line {line}'
-
-            self.value.append(value)
+        self.value = list(values)
 
     def __str__(self):
         return '; '.join(self.getLines())
@@ -3082,6 +3241,9 @@ defaultShortcut = {'defaults': [ThreeVectorIntBlock(key='cell_constraints', line
 
 stringToSettings = shortcutToCells | shortcutToCellsAliases | shortcutToParams | shortcutToParamsAliases | defaultShortcut
 
+# Any line of a cell or param file starting with a '%' i.e. '%block species_pot' or '%endblock species_pot'.
+blockLinePattern = regexCompile(r'^[ \t]*%(.*)$', MULTILINE)
+
 
 def setting(key=None, *args, **kwargs):
     assert isinstance(key, str)
@@ -3099,138 +3261,124 @@ def setting(key=None, *args, **kwargs):
 
 def readSettings(file_=None):
     assert isinstance(file_, str)
-    assert Path(file_).is_file(), f'Cannot find file {file_} when reading settings'
+    # This checks the file (or a compressed copy of it) is there.
+    with openFile(file_=file_) as f:
+        text = f.read()
 
-    with open(file_) as f:
-        lines = f.read().splitlines()
+    return parseSettings(text=text, file_=file_)
 
-    # Strip lines and ignore empty ones.
-    lines = [line.strip() for line in lines if line.strip()]
 
-    # Ignore whole line comments.
-    lines = [line for line in lines if not line.startswith('#') and not line.startswith('!')]
+def parseSettings(text=None, file_=None):
+    """ This function reads the settings from the text of a cell
+        or param file. The file is only used for error messages. """
 
-    settingKey = ''  # What setting are we looking at?
-    inBlock = False  # Are we in a block i.e. '%block species_pot'
-    blockLines = []  # What are the lines of the block we are in?
+    assert isinstance(text, str)
 
-    settings = []  # All the settings we are going to get...
+    settingKey = None  # What block are we in? i.e. '%block species_pot'
+    position = 0  # How far through the file have we read?
 
-    for line in lines:
+    settings = []  # All the settings we are going to get...
 
-        # Check for comment. This will go from left to right, so don't need to worry about multiple.
-        comment = line.find('!')
+    # Rather than going through the file line by line, jump straight between the '%' lines that start and end blocks.
+    # Everything outside a block is keywords, and everything inside a block is handed to that block in one go.
+    for match in blockLinePattern.finditer(text):
+        lines = text[position:match.start()].splitlines()
 
-        # Remove it if need be.
-        if comment != -1:
-            line = line[:comment].strip()
+        position = match.end()
 
-        # And do the same with the other comment flag.
-        comment = line.find('#')
+        # Get rid of the '%' and any comment - don't need capitalisation now.
+        line = stripComments(lines=[match.group(1)])
+        line = line[0].lower() if line else ''
 
-        # And remove.
-        if comment != -1:
-            line = line[:comment].strip()
+        if settingKey is None:
+            settings += readKeywords(lines=lines, file_=file_)
 
-        if inBlock:
-            # Don't lower() line before as we may want capitalisation.
-            if line.lower().startswith('%'):
+            # Check 'block' comes after.
+            if not line.startswith('block'):
+                raise ValueError(f'Error in block in line \'{line}\' of file {file_}')
 
-                # Get rid of the '%' - don't need capitalisation now
-                line = line[1:].strip().lower()
+            # Check that there is only one string after 'block'.
+            settingKeys = line[5:].split()
+            if len(settingKeys) != 1:
+                raise ValueError(f'Error in block in line \'{line}\' of file {file_}')
 
-                # Check 'endblock' comes after.
-                if line.startswith('endblock'):
-                    line = line[8:].strip()
+            # We have now entered a block.
+            settingKey = settingKeys[0]
 
-                    # Check that there is only one string after 'endblock'.
-                    settingKeys = line.split()
-                    if len(settingKeys) == 1:
-                        settingKeyOther = settingKeys[0]
-                    else:
-                        raise ValueError(f'Error in block in line \'{line}\' of file {file_}')
+        else:
+            # Check 'endblock' comes after.
+            if not line.startswith('endblock'):
+                raise ValueError(f'Error in block in line \'{line}\' of file {file_}')
 
-                    assert settingKey == settingKeyOther, f'Entered block {settingKey} but found endblock {settingKeyOther}'
+            # Check that there is only one string after 'endblock'.
+            settingKeys = line[8:].split()
+            if len(settingKeys) != 1:
+                raise ValueError(f'Error in block in line \'{line}\' of file {file_}')
 
-                    arguments = {'lines': blockLines}
+            settingKeyOther = settingKeys[0]
 
-                    newSetting = setting(key=settingKey, **arguments)
+            assert settingKey == settingKeyOther, f'Entered block {settingKey} but found endblock {settingKeyOther}'
 
-                    settings.append(newSetting)
+            # Don't lower() the lines of the block as we may want capitalisation.
+            newSetting = setting(key=settingKey, lines=lines)
 
-                    # We have now exited a block.
-                    inBlock = False
-                    blockLines = []
+            settings.append(newSetting)
 
-                else:
-                    raise ValueError(f'Error in block in line \'{line}\' of file {file_}')
-            else:
-                blockLines.append(line)
+            # We have now exited a block.
+            settingKey = None
 
-        else:
-            # Don't lower() line before as we may want capitalisation if it is not a block.
-            if line.lower().startswith('%'):
-
-                # Get rid of the '%' - don't need capitalisation now
-                line = line[1:].strip().lower()
+    # Anything after the last block is also keywords (unless the block was never ended).
+    if settingKey is None:
+        settings += readKeywords(lines=text[position:].splitlines(), file_=file_)
 
-                # Check 'block' comes after.
-                if line.startswith('block'):
-                    line = line[5:].strip()
+    return settings
 
-                    # We have now entered a block.
-                    inBlock = True
-                    blockLines = []
 
-                    # Check that there is only one string after 'block'.
-                    settingKeys = line.split()
-                    if len(settingKeys) == 1:
-                        settingKey = settingKeys[0]
-                    else:
-                        raise ValueError(f'Error in block in line \'{line}\' of file {file_}')
+def readKeywords(lines=None, file_=None):
+    """ This function reads the keywords (i.e. not blocks)
+        from some lines of a cell or param file """
 
-                else:
-                    raise ValueError(f'Error in block in line \'{line}\' of file {file_}')
+    assert isinstance(lines, list)
 
-            else:
-                # If we're here then we have a keyword.
+    settings = []
 
-                parts = line.split()
-                parts = [part.strip() for part in parts if part.strip() not in [':', '=']]
+    for line in stripComments(lines=lines):
+        parts = line.split()
+        parts = [part.strip() for part in parts if part.strip() not in [':', '=']]
 
-                if len(parts) == 1:
-                    # e.g. symmetry_generate
-                    key = parts[0].lower()
-                    value = True
+        if len(parts) == 1:
+            # e.g. symmetry_generate
+            key = parts[0].lower()
+            value = True
 
-                    arguments = {'value': value}
+            arguments = {'value': value}
 
-                elif len(parts) == 2:
-                    key = parts[0].lower()
-                    value = stringToValue(parts[1])
+        elif len(parts) == 2:
+            key = parts[0].lower()
+            value = stringToValue(parts[1])
 
-                    arguments = {'value': value}
+            arguments = {'value': value}
 
-                elif len(parts) == 3:
-                    key = parts[0].lower()
-                    value = stringToValue(parts[1])
-                    unit = parts[2]
+        elif len(parts) == 3:
+            key = parts[0].lower()
+            value = stringToValue(parts[1])
+            unit = parts[2]
 
-                    arguments = {'value': value, 'unit': unit}
+            arguments = {'value': value, 'unit': unit}
 
-                elif len(parts) == 4:
-                    # e.g. kpoints_mp_grid : 1 1 1
-                    key = parts[0].lower()
-                    value = stringToValue(' '.join(parts[1:]))
+        elif len(parts) == 4:
+            # e.g. kpoints_mp_grid : 1 1 1
+            key = parts[0].lower()
+            value = stringToValue(' '.join(parts[1:]))
 
-                    arguments = {'value': value}
+            arguments = {'value': value}
 
-                else:
-                    raise ValueError(f'Error in keyword {line} of file {file_}')
+        else:
+            raise ValueError(f'Error in keyword {line} of file {file_}')
 
-                newSetting = setting(key=key, **arguments)
+        newSetting = setting(key=key, **arguments)
 
-                settings.append(newSetting)
+        settings.append(newSetting)
 
     return settings
 
@@ -0,0 +1,419 @@
+from casbot.calculation import Calculation, DensityGroup
+from casbot.data import elements, niceElements
+from casbot.results import Bands, Force, Geometry, NMR, SpinDensity
+from casbot.settings import getSettingLines, getSettings, parseSettings
+
+from json import dump as jsonDump, load as jsonLoad
+from numpy import arange, array, concatenate, cumsum, diff, flatnonzero, full, load, nan, prod, repeat, save, searchsorted, trace, zeros
+from numpy.linalg import norm
+from pathlib import Path
+
+
+storeVersion = 1
+
+# Results of a calculation that are lists of tensors/vectors, with the shape of each one.
+tensorResults = {'nmrCoreTensors': (3, 3),
+                 'nmrBareTensors': (3, 3),
+                 'nmrDiaTensors': (3, 3),
+                 'nmrParaTensors': (3, 3),
+                 'nmrTotalTensors': (3, 3),
+
+                 'efgBareTensors': (3, 3),
+                 'efgIonTensors': (3, 3),
+                 'efgAugTensors': (3, 3),
+                 'efgAug2Tensors': (3, 3),
+                 'efgTotalTensors': (3, 3),
+
+                 'hyperfineDipolarBareTensors': (3, 3),
+                 'hyperfineDipolarAugTensors': (3, 3),
+                 'hyperfineDipolarAug2Tensors': (3, 3),
+                 'hyperfineDipolarTensors': (3, 3),
+                 'hyperfineFermiTensors': (3, 3),
+                 'hyperfineZFCTensors': (3, 3),
+                 'hyperfineTotalTensors': (3, 3),
+
+                 'forces': (3, 1)}
+
+# Results of a calculation that are objects made of arrays, with the class and the array attributes of each.
+arrayResults = {'bands': (Bands, ('kpoints', 'weights', 'eigenvalues', 'fermiEnergies', 'electrons', 'cell')),
+                'geometry': (Geometry, ('steps', 'energies', 'enthalpies', 'lattices', 'stresses', 'positions', 'forces',
+                                        'elements', 'ions'))}
+
+
+def elementToCode(element=None):
+    return -1 if element is None else elements.index(element.lower())
+
+
+def codeToElement(code=None):
+    return None if code == -1 else niceElements[code]
+
+
+def stackResults(calculations=None, attribute=None):
+    """ This function stacks one type of result of the calculations into
+        arrays: the values, the offsets of where each calculation's results
+        start, and the element codes and ions. Returns these along with the
+        key and unit shared by all of the results. """
+
+    assert attribute in tensorResults, f'Cannot stack {attribute}'
+
+    results = [getattr(c, attribute) for c in calculations]
+
+    offsets = concatenate([[0], cumsum([len(r) for r in results])]).astype(int)
+
+    tensors = [t for r in results for t in r]
+
+    keys = set(t.key for t in tensors)
+    units = set(t.unit for t in tensors)
+
+    assert len(keys) <= 1 and len(units) <= 1, f'Cannot stack {attribute} with different keys or units'
+
+    values = array([t.value for t in tensors], dtype=float).reshape(len(tensors), *tensorResults[attribute])
+
+    codes = array([elementToCode(t.element) for t in tensors], dtype=int)
+    ions = array([-1 if t.ion is None else int(t.ion) for t in tensors], dtype=int)
+
+    return values, offsets, codes, ions, keys.pop() if keys else None, units.pop() if units else None
+
+
+def getResultColumns(calculations=None, attribute=None):
+    """ This function gets the stacked values, offsets and element codes of
+        one type of result of the calculations. If the calculations were all
+        loaded lazily from the same model store, and the results haven't been
+        read in yet, then the rows are taken straight from the store. Density
+        groups share the store of their x calculation, so never are. """
+
+    store = calculations[0].resultStore if calculations else None
+
+    if store is None or any(c.resultStore is not store or attribute in vars(c) or isinstance(c, DensityGroup) for c in calculations):
+        values, offsets, codes, _, _, _ = stackResults(calculations=calculations, attribute=attribute)
+
+        return values, offsets, codes
+
+    storeOffsets = store.getArray(name=attribute, column='offsets')
+
+    indices = array([c.resultIndex for c in calculations], dtype=int)
+
+    starts = storeOffsets[indices]
+    counts = storeOffsets[indices + 1] - starts
+
+    offsets = concatenate([[0], cumsum(counts)]).astype(int)
+
+    # Row of the store for every result of every calculation, in order.
+    rows = arange(offsets[-1]) - repeat(offsets[:-1] - starts, counts)
+
+    return store.getArray(name=attribute, column='values')[rows], offsets, store.getArray(name=attribute, column='elements')[rows]
+
+
+def getIonIsos(calculations=None, attribute=None, element=None, ion=None):
+    """ This function gets the iso value of a tensor for each calculation,
+        that of the ion'th tensor (counting from 1) of the element. If a
+        calculation doesn't have that tensor then its value is NaN. """
+
+    assert isinstance(element, str) and element.strip(), f'Enter element to get {attribute} iso for'
+    assert isinstance(ion, int) and ion >= 1, f'Enter ion to get {attribute} iso for'
+
+    values, offsets, codes = getResultColumns(calculations=calculations, attribute=attribute)
+
+    isos = full(len(calculations), nan)
+
+    owners = repeat(arange(len(calculations)), diff(offsets))
+
+    selected = flatnonzero(codes == elementToCode(element.strip()))
+    owners = owners[selected]
+
+    # How many tensors of this element come before each one in its own calculation (owners is sorted).
+    ranks = arange(len(selected)) - searchsorted(owners, owners)
+
+    picked = ranks == ion - 1
+
+    isos[owners[picked]] = trace(values[selected[picked]], axis1=1, axis2=2) / 3.0
+
+    return isos
+
+
+def getSettingColumn(calculations=None, key=None):
+    """ This function gets the value of a setting for each calculation as
+        an array of flattened floats, padded with NaN where it is not set """
+
+    values = [getSettings(key, settings=c.settings, attr='value') for c in calculations]
+
+    values = [array(v, dtype=float).reshape(-1) if v is not None else array([]) for v in values]
+
+    width = max((v.size for v in values), default=0)
+
+    column = full((len(calculations), max(width, 1)), nan)
+
+    for num, value in enumerate(values):
+        column[num, :value.size] = value
+
+    return column
+
+
+tableQuantities = ('bfield', 'kpointspacing', 'nmriso', 'fermiiso', 'fermiisobfield')
+
+
+def getTable(*quantities, calculations=None, element=None, ion=None):
+    """ This function builds an array of each quantity asked for, with one
+        value per calculation (NaN where the calculation doesn't have it).
+        The iso quantities are for the ion'th tensor of the element. """
+
+    assert all(isinstance(quantity, str) for quantity in quantities)
+    assert isinstance(calculations, list)
+
+    quantities = [quantity.strip().lower() for quantity in quantities]
+
+    assert not set(quantities) - set(tableQuantities), f'Do not know how to tabulate {", ".join(set(quantities) - set(tableQuantities))}'
+
+    table = {}
+
+    for quantity in quantities:
+        if quantity == 'bfield':
+            bfields = getSettingColumn(calculations=calculations, key='external_bfield')[:, :3]
+
+            table[quantity] = norm(bfields, axis=1)
+
+        elif quantity == 'kpointspacing':
+            table[quantity] = getSettingColumn(calculations=calculations, key='kpoint_mp_spacing')[:, 0]
+
+        elif quantity == 'nmriso':
+            table[quantity] = getIonIsos(calculations=calculations, attribute='nmrTotalTensors', element=element, ion=ion)
+
+        elif quantity in ('fermiiso', 'fermiisobfield'):
+            table[quantity] = getIonIsos(calculations=calculations, attribute='hyperfineFermiTensors', element=element, ion=ion)
+
+            # If fermiisobfield then we want the Fermi iso value divided by the bfield.
+            if quantity == 'fermiisobfield':
+                bfields = getSettingColumn(calculations=calculations, key='external_bfield')[:, :3]
+
+                table[quantity] /= norm(bfields, axis=1)
+
+    return table
+
+
+def saveStore(model=None, directory=None):
+    """ This function saves a model as a directory of columns rather than one
+        pickle. The calculations and their settings go in one table, and each
+        type of result is stacked into arrays with offsets marking where each
+        calculation's results start, so they can be memory mapped on loading.
+        The settings are stored as they would be written to the cell and param
+        files. """
+
+    assert isinstance(directory, str)
+
+    calculations = model.calculations
+
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    # Settings common to many calculations are only formatted once.
+    cache = {}
+
+    table = {'version': storeVersion,
+             'name': model.name,
+             'calculations': {'name': [c.name for c in calculations],
+                              'directory': [c.directory for c in calculations],
+                              'settings': ['\n'.join(line for s in c.settings for line in getSettingLines(sttng=s, cache=cache))
+                                           for c in calculations]},
+             'results': {}}
+
+    for attribute in tensorResults:
+        values, offsets, codes, ions, key, unit = stackResults(calculations=calculations, attribute=attribute)
+
+        table['results'][attribute] = {'key': key, 'unit': unit}
+
+        save(directory / f'{attribute}.values.npy', values)
+        save(directory / f'{attribute}.offsets.npy', offsets)
+        save(directory / f'{attribute}.elements.npy', codes)
+        save(directory / f'{attribute}.ions.npy', ions)
+
+    # Spin densities are either scalar or vector (or not there at all).
+    spinDensities = full((len(calculations), 3), nan)
+    spinSizes = zeros(len(calculations), dtype=int)
+
+    for num, c in enumerate(calculations):
+        if c.spinDensity is not None:
+            spinSizes[num] = c.spinDensity.size
+            spinDensities[num, :c.spinDensity.size] = c.spinDensity.value.flatten()
+
+    save(directory / 'spinDensity.values.npy', spinDensities)
+    save(directory / 'spinDensity.sizes.npy', spinSizes)
+
+    # Fractional positions are a list of (element, vector) pairs (or not there at all).
+    positions = [c.positionsFrac for c in calculations]
+
+    save(directory / 'positionsFrac.present.npy', array([p is not None for p in positions], dtype=bool))
+
+    positions = [[] if p is None else p for p in positions]
+
+    save(directory / 'positionsFrac.offsets.npy', concatenate([[0], cumsum([len(p) for p in positions])]).astype(int))
+    save(directory / 'positionsFrac.elements.npy', array([elementToCode(el) for p in positions for el, _ in p], dtype=int))
+    save(directory / 'positionsFrac.values.npy', array([v for p in positions for _, v in p], dtype=float).reshape(-1, 3))
+
+    # Each array of these results is flattened and stacked, along with its shape in each calculation.
+    for attribute, (_, fields) in arrayResults.items():
+        results = [getattr(c, attribute) for c in calculations]
+
+        table['results'][attribute] = {'fields': list(fields)}
+
+        save(directory / f'{attribute}.present.npy', array([r is not None for r in results], dtype=bool))
+
+        results = [r for r in results if r is not None]
+
+        for field in fields:
+            arrays = [getattr(r, field) for r in results]
+
+            save(directory / f'{attribute}.{field}.shapes.npy', array([a.shape for a in arrays], dtype=int) if arrays else zeros((0, 0), dtype=int))
+            save(directory / f'{attribute}.{field}.values.npy', concatenate([a.reshape(-1) for a in arrays]) if arrays else zeros(0))
+
+    with open(directory / 'model.json', 'w') as f:
+        jsonDump(table, f)
+
+
+def loadStore(directory=None, lazy=False):
+    """ This function loads a model saved with saveStore. If lazy then the
+        results are memory mapped and each result of each calculation is
+        only read in when it is first accessed. Returns the calculations
+        and the name of the model. """
+
+    assert isinstance(directory, str)
+    assert isinstance(lazy, bool)
+
+    assert Path(f'{directory}/model.json').is_file(), f'Cannot find model store {directory}'
+
+    with open(f'{directory}/model.json') as f:
+        table = jsonLoad(f)
+
+    assert table.get('version', None) == storeVersion, f'Model store {directory} is not version {storeVersion}'
+
+    store = ResultStore(directory=directory, results=table['results'], mmap=lazy)
+
+    columns = table['calculations']
+
+    calculations = []
+
+    for num, (name, calcDirectory, settingsText) in enumerate(zip(columns['name'], columns['directory'], columns['settings'])):
+        calculation = Calculation(name=name,
+                                  directory=calcDirectory,
+                                  settings=parseSettings(text=settingsText, file_=f'{directory}/model.json'))
+
+        calculation.resultStore = store
+        calculation.resultIndex = num
+
+        calculations.append(calculation)
+
+    # If not lazy then read everything in now.
+    if not lazy:
+        for calculation in calculations:
+            calculation.loadResults()
+
+    return calculations, table['name']
+
+
+class ResultStore:
+    """ The stacked result arrays of a model store, opened as they are
+        needed, from which each calculation's results can be built """
+
+    def __init__(self, directory=None, results=None, mmap=True):
+        assert isinstance(directory, str)
+        assert isinstance(results, dict)
+        assert isinstance(mmap, bool)
+
+        self.directory = directory
+        self.results = results
+        self.mmapMode = 'r' if mmap else None
+
+        self.arrays = {}
+
+    def getArray(self, name=None, column=None):
+        arr = self.arrays.get((name, column), None)
+
+        if arr is None:
+            arr = load(f'{self.directory}/{name}.{column}.npy', mmap_mode=self.mmapMode)
+            self.arrays[(name, column)] = arr
+
+        return arr
+
+    def getOffsets(self, name=None, field=None):
+        """ This function gets where each calculation's array of a result starts in the stacked values """
+
+        offsets = self.arrays.get((name, f'{field}.offsets'), None)
+
+        if offsets is None:
+            offsets = concatenate([[0], cumsum(prod(self.getArray(name=name, column=f'{field}.shapes'), axis=1))]).astype(int)
+            self.arrays[(name, f'{field}.offsets')] = offsets
+
+        return offsets
+
+    def getResult(self, name=None, index=None):
+        assert isinstance(name, str)
+        assert isinstance(index, int)
+
+        if name in tensorResults:
+            offsets = self.getArray(name=name, column='offsets')
+            start, end = int(offsets[index]), int(offsets[index+1])
+
+            if start == end:
+                return []
+
+            values = array(self.getArray(name=name, column='values')[start:end])
+            codes = self.getArray(name=name, column='elements')[start:end].tolist()
+            ions = self.getArray(name=name, column='ions')[start:end].tolist()
+
+            key = self.results[name]['key']
+            unit = self.results[name]['unit']
+
+            resultClass = Force if name == 'forces' else NMR
+
+            return [resultClass(key=key, value=value, unit=unit,
+                                element=codeToElement(code), ion=None if ion == -1 else str(ion))
+                    for value, code, ion in zip(values, codes, ions)]
+
+        elif name == 'spinDensity':
+            size = int(self.getArray(name=name, column='sizes')[index])
+
+            if size == 0:
+                return None
+
+            value = array(self.getArray(name=name, column='values')[index, :size]).reshape(size, 1)
+
+            return SpinDensity(key='spin_density', value=value, unit='hbar/2', shape=(size, 1))
+
+        elif name == 'positionsFrac':
+            if not self.getArray(name=name, column='present')[index]:
+                return None
+
+            offsets = self.getArray(name=name, column='offsets')
+            start, end = int(offsets[index]), int(offsets[index+1])
+
+            values = array(self.getArray(name=name, column='values')[start:end])
+            codes = self.getArray(name=name, column='elements')[start:end].tolist()
+
+            return [(codeToElement(code), value) for code, value in zip(codes, values)]
+
+        elif name in arrayResults:
+            # Stores saved before this result was kept have none.
+            if name not in self.results:
+                return None
+
+            present = self.getArray(name=name, column='present')
+
+            if not present[index]:
+                return None
+
+            # Position of this calculation amongst those with the result.
+            count = int(present[:index].sum())
+
+            resultClass, fields = arrayResults[name]
+
+            arrays = {}
+
+            for field in fields:
+                shape = tuple(int(n) for n in self.getArray(name=name, column=f'{field}.shapes')[count])
+                start = int(self.getOffsets(name=name, field=field)[count])
+
+                arrays[field] = array(self.getArray(name=name, column=f'{field}.values')[start:start+int(prod(shape))]).reshape(shape)
+
+            return resultClass(**arrays)
+
+        else:
+            raise ValueError(f'Result {name} not known to model store')